@@ -1,2 +1,22 @@
 import daemonize
 import dao
+import multipart
+import httpcache
+import cache
+import index
+import versions
+import proxy
+import scoreboard
+import export
+import blobs
+import metrics
+import executor
+import distmeta
+import jsonapi
+import mmindex
+import watcher
+import search
+import admission
+import storage
+import mirror
+import bundle
@@ -0,0 +1,221 @@
+"""
+Admission control: limits on how much upload and download work a worker
+takes on at once, so one CI job pushing dozens of big sdists can't run it
+out of memory or starve pip.
+
+Work is admitted through one of two lanes:
+
+    downloads  files being sent, up to settings['max_streaming_bytes'] of
+               them at once. Each download counts for the bytes it has to
+               send; one bigger than the whole budget counts as all of it,
+               so it's still sent, just on its own.
+    uploads    request bodies to SetupPyHandler, up to
+               settings['max_concurrent_uploads'] at once.
+
+A limit of 0 means no limit. Work that doesn't fit waits in its lane's
+queue, in order, for up to settings['admission_timeout'] seconds. Once
+settings['admission_queue_size'] are waiting, or when the wait runs out,
+it's turned away with a 503 and a Retry-After of
+settings['admission_retry_after'] seconds. A queue size of 0 turns work
+away as soon as it doesn't fit.
+
+Downloads come first: no upload is admitted while a download is waiting,
+whether or not there's an upload slot free.
+
+How much each lane has admitted and has waiting, and how much it's turned
+away, goes into the worker's region of core.metrics when there is one.
+
+"""
+import collections
+import logging
+import time
+
+import tornado.concurrent
+import tornado.ioloop
+
+DEFAULT_MAX_CONCURRENT_UPLOADS = 4
+DEFAULT_MAX_STREAMING_BYTES = 1024 * 1024 * 1024
+DEFAULT_ADMISSION_QUEUE_SIZE = 64
+DEFAULT_ADMISSION_TIMEOUT = 30
+DEFAULT_ADMISSION_RETRY_AFTER = 5
+
+DOWNLOADS = 'downloads'
+UPLOADS = 'uploads'
+
+
+class Overloaded(Exception):
+    """
+    Raised when a lane turns work away. 'reason' is 'full' or 'timed_out'.
+
+    """
+
+    def __init__(self, lane, reason, retry_after):
+        Exception.__init__(self, '%s %s' % (lane, reason))
+        self.lane = lane
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Permit(object):
+    """
+    What admitted work holds until it's done. Releasing it twice is
+    harmless, so handlers can release from every way a request ends.
+
+    """
+
+    def __init__(self, control, lane, weight, size):
+        self.control = control
+        self.lane = lane
+        self.weight = weight
+        self.size = size
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.control.release(self)
+
+
+class Lane(object):
+
+    def __init__(self, name, limit, by_bytes):
+        self.name = name
+        self.limit = limit
+        # Whether the limit is in bytes, rather than a count.
+        self.by_bytes = by_bytes
+        self.used = 0
+        # [future, weight, size, when, timeout], oldest first.
+        self.waiting = collections.deque()
+
+    def weight(self, size):
+        if not self.by_bytes:
+            return 1
+        if self.limit:
+            return min(size, self.limit)
+        return size
+
+    def fits(self, weight):
+        return not self.limit or self.used + weight <= self.limit
+
+
+class AdmissionControl(object):
+
+    def __init__(self, max_uploads, max_streaming_bytes, queue_size,
+                 timeout, retry_after, stats=None):
+        self.downloads = Lane(DOWNLOADS, max_streaming_bytes, True)
+        self.uploads = Lane(UPLOADS, max_uploads, False)
+        self.lanes = {DOWNLOADS: self.downloads, UPLOADS: self.uploads}
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.retry_after = retry_after
+        # A core.metrics.WorkerMetrics.
+        self.stats = stats
+
+    def record(self, lane, field, delta=1):
+        if self.stats is not None:
+            self.stats.admission(lane.name, field, delta)
+
+    def admissible(self, lane, weight):
+        if lane is self.uploads and self.downloads.waiting:
+            return False
+        return lane.fits(weight)
+
+    def acquire(self, name, size=0):
+        """
+        Admit work of 'size' bytes to lane 'name'. Returns a Future that
+        resolves to a Permit, or fails with Overloaded.
+
+        """
+        lane = self.lanes[name]
+        weight = lane.weight(size)
+        future = tornado.concurrent.Future()
+        now = time.time()
+        if not lane.waiting and self.admissible(lane, weight):
+            self.admit(lane, future, weight, size, now)
+            return future
+        if len(lane.waiting) >= self.queue_size:
+            self.record(lane, 'full')
+            logging.warning("Turning away %s: %d waiting", name,
+                            len(lane.waiting))
+            future.set_exception(Overloaded(name, 'full', self.retry_after))
+            return future
+
+        waiter = [future, weight, size, now, None]
+        waiter[4] = tornado.ioloop.IOLoop.current().add_timeout(
+            now + self.timeout, lambda: self.expire(lane, waiter))
+        lane.waiting.append(waiter)
+        self.record(lane, 'waiting')
+        return future
+
+    def admit(self, lane, future, weight, size, since):
+        lane.used += weight
+        self.record(lane, 'admitted')
+        self.record(lane, 'active')
+        self.record(lane, 'active_bytes', size)
+        self.record(lane, 'wait_sum', time.time() - since)
+        future.set_result(Permit(self, lane, weight, size))
+
+    def release(self, permit):
+        lane = permit.lane
+        lane.used -= permit.weight
+        self.record(lane, 'active', -1)
+        self.record(lane, 'active_bytes', -permit.size)
+        self.wake()
+
+    def expire(self, lane, waiter):
+        lane.waiting.remove(waiter)
+        self.record(lane, 'waiting', -1)
+        self.record(lane, 'timed_out')
+        self.record(lane, 'wait_sum', time.time() - waiter[3])
+        logging.warning("Turning away %s after waiting %ss", lane.name,
+                        self.timeout)
+        waiter[0].set_exception(Overloaded(lane.name, 'timed_out',
+                                           self.retry_after))
+        # Uploads may have been held up behind it.
+        self.wake()
+
+    def wake(self):
+        """
+        Admit whatever's waiting that fits now, downloads first.
+
+        """
+        io_loop = tornado.ioloop.IOLoop.current()
+        for lane in (self.downloads, self.uploads):
+            while lane.waiting and self.admissible(lane, lane.waiting[0][1]):
+                future, weight, size, since, timeout = lane.waiting.popleft()
+                io_loop.remove_timeout(timeout)
+                self.record(lane, 'waiting', -1)
+                self.admit(lane, future, weight, size, since)
+
+
+def refuse(handler, out):
+    """
+    Answer the request 'handler' is on with a 503 for Overloaded 'out'.
+
+    """
+    handler.clear()
+    handler.set_status(503)
+    handler.set_header('Retry-After', out.retry_after)
+    handler.finish('Too busy, try again in %ss\n' % out.retry_after)
+
+
+def admission_control(application):
+    """
+    The application's AdmissionControl, created on first use.
+
+    """
+    control = getattr(application, 'admission_control', None)
+    if control is None:
+        settings = application.settings
+        control = AdmissionControl(
+            settings.get('max_concurrent_uploads',
+                         DEFAULT_MAX_CONCURRENT_UPLOADS),
+            settings.get('max_streaming_bytes', DEFAULT_MAX_STREAMING_BYTES),
+            settings.get('admission_queue_size',
+                         DEFAULT_ADMISSION_QUEUE_SIZE),
+            settings.get('admission_timeout', DEFAULT_ADMISSION_TIMEOUT),
+            settings.get('admission_retry_after',
+                         DEFAULT_ADMISSION_RETRY_AFTER),
+            getattr(application, 'worker_metrics', None))
+        application.admission_control = control
+    return control
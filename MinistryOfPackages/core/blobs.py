@@ -0,0 +1,169 @@
+"""
+Putting uploaded files in place.
+
+Files are only ever published with a rename, so a client downloading one
+sees either the whole old file or the whole new one, never a partly
+written one.
+
+With a BlobStore, file contents are kept once each under their sha256,
+at <directory>/sha256/ab/cd/abcd..., and what's published in PackageDirs
+is a hard link to the blob. Uploading a file whose contents are already
+stored (a rebuild that came out byte-for-byte the same, say) costs no
+extra disk. The blob store has to be on the same filesystem as PackageDirs
+for the links to work; if it isn't, files are copied instead.
+
+A blob with a link count of 1 is no longer published anywhere.
+
+"""
+import errno
+import logging
+import os
+import shutil
+import tempfile
+
+FILE_MODE = 0o644
+
+DEFAULT_BLOB_DIR = 'var/blobs'
+
+
+def temp_beside(path):
+    """
+    A new, empty temp file in the same directory as 'path', so it can be
+    renamed over 'path'.
+
+    """
+    fd, temp = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.',
+                                dir=os.path.dirname(path))
+    os.close(fd)
+    return temp
+
+
+def makedirs_for(path):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError as out:
+            if out.errno != errno.EEXIST:
+                raise
+
+
+def move_atomic(src, dest):
+    """
+    Move 'src' to 'dest', replacing whatever's there in one step. Across
+    filesystems, that means copying to a temp file beside 'dest' first.
+
+    """
+    makedirs_for(dest)
+    try:
+        os.rename(src, dest)
+        return
+    except OSError as out:
+        if out.errno != errno.EXDEV:
+            raise
+    temp = temp_beside(dest)
+    try:
+        shutil.copyfile(src, temp)
+        os.chmod(temp, FILE_MODE)
+        os.rename(temp, dest)
+    except Exception:
+        os.unlink(temp)
+        raise
+    os.unlink(src)
+
+
+def link_beside(src, dest):
+    """
+    Hard link a temp file beside 'dest' to 'src', ready to be renamed over
+    'dest'. Falls back to a copy where links aren't possible. Returns the
+    temp file's path.
+
+    """
+    makedirs_for(dest)
+    temp = temp_beside(dest)
+    try:
+        os.unlink(temp)
+        try:
+            os.link(src, temp)
+        except OSError as out:
+            if out.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copyfile(src, temp)
+            os.chmod(temp, FILE_MODE)
+    except Exception:
+        if os.path.exists(temp):
+            os.unlink(temp)
+        raise
+    return temp
+
+
+def link_atomic(src, dest):
+    """
+    Hard link 'dest' to 'src', replacing whatever's at 'dest' in one step.
+    Falls back to a copy where links aren't possible.
+
+    """
+    temp = link_beside(src, dest)
+    try:
+        os.rename(temp, dest)
+    except Exception:
+        os.unlink(temp)
+        raise
+
+
+class BlobStore(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, sha256):
+        return os.path.join(self.directory, 'sha256', sha256[:2],
+                            sha256[2:4], sha256)
+
+    def add(self, temp_path, sha256):
+        """
+        Store the file at 'temp_path', whose sha256 hex digest is 'sha256',
+        taking ownership of it. If those contents are already stored, the
+        temp file is just removed. Returns the blob's path.
+
+        """
+        path = self.path(sha256)
+        if os.path.isfile(path):
+            logging.debug("Blob %s already stored", sha256)
+            os.unlink(temp_path)
+        else:
+            os.chmod(temp_path, FILE_MODE)
+            move_atomic(temp_path, path)
+        return path
+
+    def publish(self, temp_path, sha256, dest):
+        """
+        Store 'temp_path' and put its contents in place at 'dest'.
+
+        """
+        link_atomic(self.add(temp_path, sha256), dest)
+
+    def stage(self, temp_path, sha256, dest):
+        """
+        Store 'temp_path', and link its contents to a temp file beside
+        'dest', to be renamed over it when the caller's ready. Returns the
+        temp file's path.
+
+        """
+        return link_beside(self.add(temp_path, sha256), dest)
+
+
+def blob_store(application):
+    """
+    The application's BlobStore, or None if settings['blob_dir'] is empty.
+
+    """
+    store = getattr(application, 'blob_store', None)
+    if store is None:
+        settings = application.settings
+        directory = settings.get('blob_dir', DEFAULT_BLOB_DIR)
+        if not directory:
+            return None
+        store = BlobStore(os.path.join(settings['base_path'], directory))
+        application.blob_store = store
+    return store
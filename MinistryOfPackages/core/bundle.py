@@ -0,0 +1,315 @@
+"""
+Batch uploads: many distributions in one request body, with a manifest
+saying what they are.
+
+The body is a tar stream, or a multipart/form-data body with a part per
+file. Either way it's parsed as it arrives, and each file goes straight
+to a temp file, hashed on the way, the same as a setup.py upload. The
+manifest is a JSON object, the tar member manifest.json or the form field
+'manifest':
+
+    {"files": [
+        {"filename": "foo-1.0-py2.py3-none-any.whl",
+         "sha256": "<hex digest>",
+         "name": "foo", "version": "1.0",
+         "metadata": {"summary": "...", ...}},
+        ...
+    ]}
+
+Only filename and sha256 are required. An md5 can be given too, and
+filetype; name and version default to what the filename says, and
+metadata, for the release, to nothing beyond what's read out of the file.
+
+A file is only stored if it's in the manifest, and it's in the body, and
+its digests match.
+
+"""
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import tarfile
+import tempfile
+
+from MinistryOfPackages.core.dao import NON_METADATA_KEYS
+from MinistryOfPackages.core.distmeta import filetype
+from MinistryOfPackages.core.index import (is_distribution, is_safe_name,
+                                           split_filename)
+from MinistryOfPackages.core.multipart import MAX_FIELD_SIZE
+
+MANIFEST_NAME = 'manifest.json'
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+
+# Parser states
+HEADER, DATA, PADDING, END = range(4)
+
+
+class BundleError(Exception):
+    pass
+
+
+def pax_path(data):
+    """
+    The 'path' record from a pax extended header, or None.
+
+    """
+    pos = 0
+    try:
+        while pos < len(data):
+            length = int(data[pos:data.index(' ', pos)])
+            if length <= 0:
+                break
+            record = data[pos:pos + length]
+            pos += length
+            key, _, value = record.split(' ', 1)[1].partition('=')
+            if key == 'path':
+                return value.rstrip('\n')
+    except ValueError:
+        raise BundleError("Bad pax header")
+    return None
+
+
+class TarStreamParser(object):
+    """
+    Incremental parsing of an uncompressed tar stream, with the same
+    feed(), close() and cleanup() as core.multipart's
+    MultipartStreamParser. Regular files are spooled to temp files as they
+    come in and listed in self.files, with the same filename, filetemp,
+    filesize, filemd5 and filesha256 as a multipart file part. The
+    manifest member is kept in memory, and close() returns it as
+    {'manifest': <its contents>}. Anything else (directories, links) is
+    skipped.
+
+    """
+
+    def __init__(self, tmp_dir=None):
+        self.tmp_dir = tmp_dir
+        self.buf = ''
+        self.state = HEADER
+        self.args = {}
+        self.files = []
+        # What the member being read is going to: 'file', 'manifest',
+        # 'longname', 'pax' or None to skip it.
+        self.sink = None
+        self.remaining = 0
+        self.padding = 0
+        self.fileobj = None
+        self.hashes = None
+        self.chunks = None
+        # A long name from a GNU or pax header, for the member after it.
+        self.next_name = None
+
+    def feed(self, data):
+        self.buf += data
+        while self._step():
+            pass
+
+    def close(self):
+        if self.state not in (HEADER, END) or self.buf:
+            self.cleanup()
+            raise BundleError("Tar stream ended in the middle of a member")
+        return self.args
+
+    def cleanup(self):
+        if self.fileobj is not None and not self.fileobj.closed:
+            self.fileobj.close()
+        for spooled in self.files:
+            tmp = spooled['filetemp']
+            if os.path.exists(tmp):
+                logging.debug("Removing abandoned upload %s", tmp)
+                os.unlink(tmp)
+
+    def _step(self):
+        if self.state == HEADER:
+            if len(self.buf) < BLOCK_SIZE:
+                return False
+            block, self.buf = self.buf[:BLOCK_SIZE], self.buf[BLOCK_SIZE:]
+            if block == tarfile.NUL * BLOCK_SIZE:
+                # End of archive; whatever follows is padding.
+                self.state = END
+                return True
+            try:
+                info = tarfile.TarInfo.frombuf(block)
+            except tarfile.HeaderError as out:
+                raise BundleError("Bad tar header: %s" % out)
+            self._start_member(info)
+            self.state = DATA
+            return True
+
+        elif self.state == DATA:
+            if self.remaining:
+                if not self.buf:
+                    return False
+                data = self.buf[:self.remaining]
+                self.buf = self.buf[len(data):]
+                self.remaining -= len(data)
+                self._member_data(data)
+            if self.remaining:
+                return False
+            self._end_member()
+            self.state = PADDING
+            return True
+
+        elif self.state == PADDING:
+            skip = min(self.padding, len(self.buf))
+            self.buf = self.buf[skip:]
+            self.padding -= skip
+            if self.padding:
+                return False
+            self.state = HEADER
+            return True
+
+        # END
+        self.buf = ''
+        return False
+
+    def _start_member(self, info):
+        name = self.next_name or info.name
+        self.next_name = None
+        self.remaining = info.size
+        self.padding = -info.size % BLOCK_SIZE
+        self.sink = None
+        if info.type == tarfile.GNUTYPE_LONGNAME:
+            self.sink = 'longname'
+        elif info.type == tarfile.XHDTYPE:
+            self.sink = 'pax'
+        elif info.type in tarfile.REGULAR_TYPES:
+            filename = posixpath.basename(name)
+            if filename == MANIFEST_NAME:
+                self.sink = 'manifest'
+            else:
+                self.sink = 'file'
+                fd, path = tempfile.mkstemp(prefix='upload-',
+                                            dir=self.tmp_dir)
+                self.fileobj = os.fdopen(fd, 'wb')
+                self.hashes = {'filemd5': hashlib.md5(),
+                               'filesha256': hashlib.sha256()}
+                self.files.append({'filename': filename, 'filetemp': path})
+                logging.debug("Spooling '%s' to %s", filename, path)
+        if self.sink in ('longname', 'pax', 'manifest'):
+            if info.size > MAX_FIELD_SIZE:
+                raise BundleError("Tar member '%s' too large" % name)
+            self.chunks = []
+
+    def _member_data(self, data):
+        if self.sink == 'file':
+            self.fileobj.write(data)
+            for h in self.hashes.values():
+                h.update(data)
+        elif self.sink is not None:
+            self.chunks.append(data)
+
+    def _end_member(self):
+        if self.sink == 'file':
+            self.fileobj.close()
+            self.fileobj = None
+            spooled = self.files[-1]
+            spooled['filesize'] = os.path.getsize(spooled['filetemp'])
+            for k, h in self.hashes.items():
+                spooled[k] = h.hexdigest()
+            self.hashes = None
+        elif self.sink == 'manifest':
+            self.args['manifest'] = ''.join(self.chunks)
+        elif self.sink == 'longname':
+            self.next_name = ''.join(self.chunks).rstrip(tarfile.NUL)
+        elif self.sink == 'pax':
+            self.next_name = pax_path(''.join(self.chunks))
+        self.chunks = None
+        self.sink = None
+
+
+def parse_manifest(text):
+    """
+    The list of file entries in the manifest 'text'.
+
+    """
+    if text is None:
+        raise BundleError("No manifest")
+    try:
+        manifest = json.loads(text)
+    except ValueError as out:
+        raise BundleError("Bad manifest: %s" % out)
+    entries = manifest.get('files') if isinstance(manifest, dict) else None
+    if not isinstance(entries, list) or not entries:
+        raise BundleError("The manifest has no files")
+    for entry in entries:
+        if not isinstance(entry, dict) or not entry.get('filename'):
+            raise BundleError("Every file in the manifest needs a filename")
+        for key in ('filename', 'sha256', 'md5', 'name', 'version',
+                    'filetype'):
+            if not isinstance(entry.get(key) or '', basestring):
+                raise BundleError("%s for %r isn't a string" %
+                                  (key, entry['filename']))
+        if not isinstance(entry.get('metadata', {}), dict):
+            raise BundleError("metadata for %s isn't an object" %
+                              entry['filename'])
+    return entries
+
+
+def entry_error(entry, spooled):
+    filename = entry['filename']
+    if not is_safe_name(filename) or not is_distribution(filename):
+        return "not a distribution filename"
+    if spooled is None:
+        return "not in the upload"
+    if not entry.get('sha256'):
+        return "no sha256 in the manifest"
+    if entry['sha256'].strip().lower() != spooled['filesha256']:
+        return "sha256 doesn't match"
+    if entry.get('md5') and (entry['md5'].strip().lower() !=
+                             spooled['filemd5']):
+        return "md5 doesn't match"
+    return None
+
+
+def check_bundle(entries, files):
+    """
+    Match the manifest's 'entries' up with the spooled 'files'. Returns a
+    dict for each file named in either: filename, name, version, filetype,
+    metadata, 'spooled' (its entry from 'files', or None), and 'error'
+    saying why it can't be stored, or None if it can.
+
+    """
+    spooled = {}
+    seen = set()
+    duplicates = set()
+    for f in files:
+        if f['filename'] in spooled:
+            duplicates.add(f['filename'])
+        spooled[f['filename']] = f
+
+    items = []
+    for entry in entries:
+        filename = entry['filename']
+        guessed_name, guessed_version = split_filename(filename)
+        item = {'filename': filename,
+                'name': entry.get('name') or guessed_name,
+                'version': entry.get('version') or guessed_version,
+                'filetype': entry.get('filetype') or filetype(filename),
+                'metadata': dict(
+                    (k, v) for k, v in (entry.get('metadata') or {}).items()
+                    if k not in NON_METADATA_KEYS + ['name', 'version']),
+                'spooled': spooled.get(filename),
+                'error': None}
+        if filename in seen:
+            item['error'] = "in the manifest more than once"
+        elif filename in duplicates:
+            item['error'] = "in the upload more than once"
+        elif item['name'] is None or item['version'] is None:
+            item['error'] = "no telling its name and version"
+        elif not is_safe_name(item['name']):
+            # It's a directory name under PackageDirs.
+            item['error'] = "not a project name"
+        else:
+            item['error'] = entry_error(entry, item['spooled'])
+        seen.add(filename)
+        items.append(item)
+
+    for filename in sorted(set(spooled) - seen):
+        items.append({'filename': filename, 'name': None, 'version': None,
+                      'filetype': None, 'metadata': {},
+                      'spooled': spooled[filename],
+                      'error': "not in the manifest"})
+    return items
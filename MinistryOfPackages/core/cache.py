@@ -0,0 +1,74 @@
+"""
+In-process caches.
+
+"""
+import collections
+
+
+class LRUCache(object):
+    """
+    A bounded mapping that throws out the least recently used entry once
+    it's full. Every entry is stored along with a validator (an mtime, an
+    ETag, anything comparable), and get() only hands back a value if the
+    caller's current validator matches the stored one, so stale entries are
+    never served.
+
+    hits, misses and evictions are kept as plain counters; stats() returns
+    them along with the current size. If 'record' is given, it's called
+    with the counter's name each time one goes up, so they can be kept
+    somewhere other processes can see too (core.metrics). A maxsize of 0
+    turns the cache off.
+
+    """
+
+    def __init__(self, maxsize=256, record=None):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.record = record
+
+    def count(self, counter):
+        setattr(self, counter, getattr(self, counter) + 1)
+        if self.record is not None:
+            self.record(counter)
+
+    def get(self, key, validator):
+        try:
+            stored_validator, value = self.entries.pop(key)
+        except KeyError:
+            self.count('misses')
+            return None
+
+        if stored_validator != validator:
+            # Stale. It's already been popped, so it's gone.
+            self.count('misses')
+            return None
+
+        # Re-inserting moves it to the most-recently-used end.
+        self.entries[key] = (stored_validator, value)
+        self.count('hits')
+        return value
+
+    def put(self, key, validator, value):
+        if self.maxsize <= 0:
+            return
+        self.entries.pop(key, None)
+        self.entries[key] = (validator, value)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.count('evictions')
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self.entries),
+                'maxsize': self.maxsize}
@@ -1,56 +1,901 @@
-#import redis
+"""
+The data model: package metadata from 'register'/'upload', and the files
+that belong to each release.
+
+PyPIData is the interface the handlers use. Storage is delegated to a
+Backend; SQLiteBackend is the default and needs nothing but the standard
+library. RedisBackend is there for setups that already run Redis, and
+needs the redis module.
+
+Writes are queued and applied in batches, one transaction (or Redis
+MULTI/EXEC) per batch, so a burst of uploads pays for one fsync rather
+than one each. A batch goes out once 'batch_size' writes are waiting or
+'batch_delay' seconds after the first one, whichever is sooner. With no
+batch_delay every write is applied straight away, which is what command
+line tools want. Reads flush anything pending first.
+
+With a batch_delay, batches are applied on a writer thread of the
+backend's own, so an IOLoop is never stuck waiting on another process's
+write lock; only a read, or the end of a batch() block, waits for the
+writes it has to see. A batch that fails is put back at the head of the
+queue and tried again 'retry_delay' seconds later.
+
+Anything that keeps derived state (PyPIData's release indexes, for one)
+can register a listener on the backend to hear about each applied batch.
+
+"""
+import contextlib
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+import tornado.ioloop
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+from MinistryOfPackages.core.index import normalize_name, package_index
+from MinistryOfPackages.core.versions import ReleaseIndex
+
+# Metadata fields distutils knows about, for populate_initial_valid_metadata
+DISTUTILS_FIELDS = ['name', 'version', 'author', 'author_email',
+                    'maintainer', 'maintainer_email', 'home_page', 'license',
+                    'summary', 'description', 'keywords', 'platform',
+                    'download_url', 'classifiers', 'requires', 'provides',
+                    'obsoletes', 'metadata_version']
+
+CLASSIFIERS_URL = 'https://pypi.org/pypi?%3Aaction=list_classifiers'
+
+# Form fields that describe the request or the uploaded file rather than
+# the release.
+NON_METADATA_KEYS = [':action', 'protocol_version', 'filename', 'filetemp',
+                     'filesize', 'filemd5', 'filesha256', 'filetype',
+                     'content', 'md5_digest', 'sha256_digest',
+                     'blake2_256_digest', 'pyversion', 'comment']
+
+
+class Backend(object):
+    """
+    What a metadata store has to provide. Writes go through queue() and
+    are handed to apply() in batches; subclasses implement apply() and the
+    read methods.
+
+    Write operations are tuples, first element naming the operation:
+
+    ('release', normalized, name, version, metadata, upload_time)
+    ('update', normalized, version, fields)
+    ('file', normalized, name, version, filerecord)
+    ('remove_file', normalized, filename)
+    ('valid', kind, values)
+
+    apply() returns {normalized: (old_serial, new_serial)} for every
+    project the batch touched, which is passed to each of self.listeners
+    along with the ops themselves. An old_serial of None means the project
+    is new.
+
+    """
+
+    def __init__(self, batch_size=100, batch_delay=None, retry_delay=1):
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.retry_delay = retry_delay
+        self.pending = []
+        self.holding = 0
+        self.flush_timeout = None
+        self.listeners = []
+        # Where delayed batches are applied, and the one being applied
+        # there now, as (future, ops).
+        self.writer = ThreadPoolExecutor(1) if batch_delay else None
+        self.writing = None
+
+    def queue(self, op):
+        self.pending.append(op)
+        if self.holding:
+            return
+        if not self.batch_delay:
+            self.flush()
+        elif len(self.pending) >= self.batch_size:
+            self.flush_later()
+        elif self.flush_timeout is None:
+            self.flush_after(self.batch_delay)
+
+    def flush_after(self, delay):
+        io_loop = tornado.ioloop.IOLoop.current()
+        self.flush_timeout = io_loop.add_timeout(
+            datetime.timedelta(seconds=delay), self.flush_later)
+
+    def flush_later(self):
+        """
+        Start applying everything queued on the writer thread, once the
+        batch it's on now, if any, is done. If it fails, the writes go
+        back in the queue and we try again in retry_delay seconds.
+
+        """
+        if self.holding:
+            return
+        if self.flush_timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.flush_timeout)
+            self.flush_timeout = None
+        if self.writing is not None or not self.pending:
+            return
+        ops, self.pending = self.pending, []
+        logging.debug("Applying %d metadata writes", len(ops))
+        future = self.writer.submit(self.apply, ops)
+        self.writing = future, ops
+        tornado.ioloop.IOLoop.current().add_future(future, self.written)
+
+    def written(self, future):
+        if self.writing is None or self.writing[0] is not future:
+            # flush() has waited for it already.
+            return
+        try:
+            self.finish_writing()
+        except Exception as out:
+            logging.error("Applying %d metadata writes failed, trying again "
+                          "in %ss: %s", len(self.pending), self.retry_delay,
+                          out)
+            if self.flush_timeout is None:
+                self.flush_after(self.retry_delay)
+            return
+        if self.pending and self.flush_timeout is None:
+            # More came in while it was being written.
+            self.flush_after(self.batch_delay)
+
+    def finish_writing(self):
+        """
+        Wait for the batch on the writer thread, and tell the listeners
+        about it; if it failed, put its writes back at the head of the
+        queue and raise.
+
+        """
+        future, ops = self.writing
+        try:
+            changes = future.result()
+        except Exception:
+            self.pending[:0] = ops
+            raise
+        finally:
+            self.writing = None
+        for listener in self.listeners:
+            listener(changes, ops)
+
+    def flush(self):
+        """
+        Apply everything queued and wait for it, unless a batch() block is
+        open, in which case it waits for the block to end. If apply()
+        fails, nothing was written, and the writes stay queued for next
+        time.
+
+        """
+        if self.holding:
+            return
+        if self.flush_timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.flush_timeout)
+            self.flush_timeout = None
+        if self.writing is not None:
+            try:
+                self.finish_writing()
+            except Exception:
+                # Its writes are queued again, ahead of ours, and get
+                # another go with them.
+                pass
+        if not self.pending:
+            return
+        ops, self.pending = self.pending, []
+        logging.debug("Applying %d metadata writes", len(ops))
+        try:
+            if self.writer is not None:
+                changes = self.writer.submit(self.apply, ops).result()
+            else:
+                changes = self.apply(ops)
+        except Exception:
+            self.pending[:0] = ops
+            raise
+        for listener in self.listeners:
+            listener(changes, ops)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Everything queued inside the block is applied together when it
+        exits, or thrown away if it raises, or if applying it fails.
+
+        """
+        start = len(self.pending)
+        self.holding += 1
+        try:
+            yield
+        except Exception:
+            del self.pending[start:]
+            raise
+        finally:
+            self.holding -= 1
+        if not self.holding:
+            held = len(self.pending) - start
+            try:
+                self.flush()
+            except Exception:
+                # What was queued before the block is kept, as it would
+                # have been without it. A failed write from the writer
+                # thread may have been put back ahead of it all.
+                del self.pending[len(self.pending) - held:]
+                raise
+
+    def apply(self, ops):
+        raise NotImplementedError
+
+    def get_project(self, normalized):
+        """
+        Returns (name, serial) or None.
+
+        """
+        raise NotImplementedError
+
+    def get_changed_projects(self, since=0):
+        """
+        [(normalized, serial)] for every project whose serial is above
+        'since', so all of them for 0.
+
+        """
+        raise NotImplementedError
+
+    def get_releases(self, normalized):
+        """
+        Returns {version: metadata} for every release of a project.
+
+        """
+        raise NotImplementedError
+
+    def get_release(self, normalized, version):
+        raise NotImplementedError
+
+    def get_versions(self, normalized):
+        raise NotImplementedError
+
+    def get_files(self, normalized, version=None):
+        """
+        File records for one release, or all of them, newest first.
+
+        """
+        raise NotImplementedError
+
+    def get_file_digests(self, normalized=None):
+        """
+        {path: sha256_digest} for every file with a recorded digest, or
+        just those of one project.
+
+        """
+        raise NotImplementedError
+
+    def get_valid(self, kind):
+        raise NotImplementedError
+
+
+SQLITE_SCHEMA = [
+    # Version 1
+    """
+    CREATE TABLE projects (
+        normalized TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        serial INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX projects_serial ON projects (serial);
+
+    CREATE TABLE releases (
+        normalized TEXT NOT NULL,
+        version TEXT NOT NULL,
+        metadata TEXT NOT NULL,
+        upload_time REAL NOT NULL,
+        PRIMARY KEY (normalized, version)
+    );
+    CREATE INDEX releases_project_time ON releases (normalized, upload_time);
+    CREATE INDEX releases_upload_time ON releases (upload_time);
+
+    CREATE TABLE files (
+        filename TEXT PRIMARY KEY,
+        normalized TEXT NOT NULL,
+        version TEXT NOT NULL,
+        filetype TEXT,
+        url TEXT,
+        path TEXT,
+        size INTEGER,
+        md5_digest TEXT,
+        sha256_digest TEXT,
+        upload_time REAL NOT NULL
+    );
+    CREATE INDEX files_release ON files (normalized, version);
+    CREATE INDEX files_project_time ON files (normalized, upload_time);
+
+    CREATE TABLE valid_values (
+        kind TEXT NOT NULL,
+        value TEXT NOT NULL,
+        PRIMARY KEY (kind, value)
+    );
+    """,
+]
+
+FILE_COLUMNS = ['filename', 'version', 'filetype', 'url', 'path', 'size',
+                'md5_digest', 'sha256_digest', 'upload_time']
+
+
+class SQLiteBackend(Backend):
+    """
+    An SQLite database file shared by every process. It runs in WAL mode so
+    readers in one process don't block a writer in another.
+
+    Connections are opened lazily, per process, since they can't be
+    shared across a fork, and per thread, since the writer thread writes
+    while the IOLoop thread reads.
+
+    """
+
+    def __init__(self, path, **kwargs):
+        super(SQLiteBackend, self).__init__(**kwargs)
+        self.path = path
+        self.local = threading.local()
+
+    @property
+    def conn(self):
+        local = self.local
+        if getattr(local, 'conn', None) is None or local.pid != os.getpid():
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.migrate(conn)
+            local.conn = conn
+            local.pid = os.getpid()
+        return local.conn
+
+    def migrate(self, conn):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            current = conn.execute('PRAGMA user_version').fetchone()[0]
+            for version, script in enumerate(SQLITE_SCHEMA[current:],
+                                             current + 1):
+                logging.info("Upgrading %s to schema version %d",
+                             self.path, version)
+                for statement in script.split(';'):
+                    if statement.strip():
+                        conn.execute(statement)
+                conn.execute('PRAGMA user_version = %d' % version)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def apply(self, ops):
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            touched = {}
+            for op in ops:
+                getattr(self, 'apply_' + op[0])(conn, touched, *op[1:])
+            changes = {}
+            for normalized, name in touched.items():
+                old = self.get_project(normalized)
+                conn.execute('INSERT OR IGNORE INTO projects (normalized, '
+                             'name) VALUES (?, ?)', (normalized, name))
+                conn.execute('UPDATE projects SET serial = (SELECT '
+                             'COALESCE(MAX(serial), 0) + 1 FROM projects) '
+                             'WHERE normalized = ?', (normalized,))
+                changes[normalized] = (old and old[1],
+                                       self.get_project(normalized)[1])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return changes
+
+    def apply_release(self, conn, touched, normalized, name, version,
+                      metadata, upload_time):
+        touched[normalized] = name
+        conn.execute('INSERT OR IGNORE INTO releases (normalized, version, '
+                     'metadata, upload_time) VALUES (?, ?, ?, ?)',
+                     (normalized, version, '{}', upload_time))
+        conn.execute('UPDATE releases SET metadata = ? WHERE normalized = ? '
+                     'AND version = ?',
+                     (json.dumps(metadata), normalized, version))
+
+    def apply_update(self, conn, touched, normalized, version, fields):
+        row = conn.execute('SELECT metadata FROM releases WHERE '
+                           'normalized = ? AND version = ?',
+                           (normalized, version)).fetchone()
+        if row is None:
+            return
+        metadata = json.loads(row['metadata'])
+        metadata.update(fields)
+        touched[normalized] = metadata.get('name', normalized)
+        conn.execute('UPDATE releases SET metadata = ? WHERE normalized = ? '
+                     'AND version = ?',
+                     (json.dumps(metadata), normalized, version))
+
+    def apply_file(self, conn, touched, normalized, name, version, record):
+        touched[normalized] = name
+        conn.execute('INSERT OR IGNORE INTO releases (normalized, version, '
+                     'metadata, upload_time) VALUES (?, ?, ?, ?)',
+                     (normalized, version,
+                      json.dumps({'name': name, 'version': version}),
+                      record['upload_time']))
+        conn.execute('INSERT OR REPLACE INTO files (filename, normalized, '
+                     'version, filetype, url, path, size, md5_digest, '
+                     'sha256_digest, upload_time) VALUES '
+                     '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (record['filename'], normalized, version,
+                      record.get('filetype'), record.get('url'),
+                      record.get('path'), record.get('size'),
+                      record.get('md5_digest'), record.get('sha256_digest'),
+                      record['upload_time']))
+
+    def apply_remove_file(self, conn, touched, normalized, filename):
+        cursor = conn.execute('DELETE FROM files WHERE filename = ? AND '
+                              'normalized = ?', (filename, normalized))
+        if cursor.rowcount:
+            found = self.get_project(normalized)
+            touched[normalized] = found[0] if found else normalized
+
+    def apply_valid(self, conn, touched, kind, values):
+        conn.executemany('INSERT OR IGNORE INTO valid_values (kind, value) '
+                         'VALUES (?, ?)', [(kind, v) for v in values])
+
+    def get_project(self, normalized):
+        row = self.conn.execute('SELECT name, serial FROM projects WHERE '
+                                'normalized = ?', (normalized,)).fetchone()
+        if row is not None:
+            return row['name'], row['serial']
+
+    def get_changed_projects(self, since=0):
+        return [(row['normalized'], row['serial']) for row in
+                self.conn.execute('SELECT normalized, serial FROM projects '
+                                  'WHERE serial > ?', (since,))]
+
+    def get_releases(self, normalized):
+        rows = self.conn.execute('SELECT version, metadata FROM releases '
+                                 'WHERE normalized = ?', (normalized,))
+        return dict((row['version'], json.loads(row['metadata']))
+                    for row in rows)
+
+    def get_release(self, normalized, version):
+        row = self.conn.execute('SELECT metadata FROM releases WHERE '
+                                'normalized = ? AND version = ?',
+                                (normalized, version)).fetchone()
+        if row is not None:
+            return json.loads(row['metadata'])
+
+    def get_versions(self, normalized):
+        return [row['version'] for row in
+                self.conn.execute('SELECT version FROM releases WHERE '
+                                  'normalized = ?', (normalized,))]
+
+    def get_files(self, normalized, version=None):
+        sql = 'SELECT %s FROM files WHERE normalized = ?' % \
+            ', '.join(FILE_COLUMNS)
+        params = [normalized]
+        if version is not None:
+            sql += ' AND version = ?'
+            params.append(version)
+        sql += ' ORDER BY upload_time DESC'
+        return [dict(zip(FILE_COLUMNS, row))
+                for row in self.conn.execute(sql, params)]
+
+    def get_file_digests(self, normalized=None):
+        sql = ('SELECT path, sha256_digest FROM files WHERE path IS NOT NULL '
+               'AND sha256_digest IS NOT NULL')
+        params = []
+        if normalized is not None:
+            sql += ' AND normalized = ?'
+            params.append(normalized)
+        return dict((row['path'], row['sha256_digest'])
+                    for row in self.conn.execute(sql, params))
+
+    def get_valid(self, kind):
+        return [row['value'] for row in
+                self.conn.execute('SELECT value FROM valid_values WHERE '
+                                  'kind = ?', (kind,))]
+
+
+class RedisBackend(Backend):
+    """
+    Keys, following the layout in handlers/schema.txt where it applies:
+
+    pkg:<normalized>                    hash: name, serial
+    releases:<normalized>               zset: version scored by upload time
+    release:<normalized>:<version>      string: JSON metadata
+    files:<normalized>                  zset: filename scored by upload time
+    file:<filename>                     string: JSON file record
+    valid:<kind>                        set
+    serial                              counter shared by all projects
+    serials                             zset: normalized scored by serial
+
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, **kwargs):
+        if redis is None:
+            raise RuntimeError("The redis backend needs the redis module")
+        super(RedisBackend, self).__init__(**kwargs)
+        self.db = redis.StrictRedis(host=host, port=port, db=db)
+
+    def apply(self, ops):
+        """
+        The writes and the new serials go in one MULTI, so a reader never
+        sees a serial before the writes it stands for, or a higher serial
+        before a lower one. Serials are worked out from the counter as it
+        was beforehand, under WATCH, and if another process has handed
+        any out by the time we EXEC, we start again.
+
+        """
+        while True:
+            with self.db.pipeline(transaction=True) as pipe:
+                try:
+                    pipe.watch('serial')
+                    serial = int(pipe.get('serial') or 0)
+                    pipe.multi()
+                    touched = {}
+                    for op in ops:
+                        getattr(self, 'apply_' + op[0])(pipe, touched,
+                                                        *op[1:])
+                    changes = {}
+                    for normalized, name in sorted(touched.items()):
+                        key = 'pkg:%s' % normalized
+                        old = self.db.hget(key, 'serial')
+                        serial += 1
+                        pipe.hset(key, 'name', name)
+                        pipe.hset(key, 'serial', serial)
+                        pipe.execute_command('ZADD', 'serials', serial,
+                                             normalized)
+                        changes[normalized] = (old and int(old), serial)
+                    if touched:
+                        pipe.set('serial', serial)
+                    pipe.execute()
+                    return changes
+                except redis.WatchError:
+                    logging.debug("Serials moved on, applying %d metadata "
+                                  "writes again", len(ops))
+
+    def apply_release(self, pipe, touched, normalized, name, version,
+                      metadata, upload_time):
+        touched[normalized] = name
+        pipe.execute_command('ZADD', 'releases:%s' % normalized, 'NX',
+                             upload_time, version)
+        pipe.set('release:%s:%s' % (normalized, version),
+                 json.dumps(metadata))
+
+    def apply_update(self, pipe, touched, normalized, version, fields):
+        key = 'release:%s:%s' % (normalized, version)
+        current = self.db.get(key)
+        if current is None:
+            return
+        metadata = json.loads(current)
+        metadata.update(fields)
+        touched[normalized] = metadata.get('name', normalized)
+        pipe.set(key, json.dumps(metadata))
+
+    def apply_file(self, pipe, touched, normalized, name, version, record):
+        touched[normalized] = name
+        record = dict(record, version=version)
+        pipe.execute_command('ZADD', 'releases:%s' % normalized, 'NX',
+                             record['upload_time'], version)
+        pipe.setnx('release:%s:%s' % (normalized, version),
+                   json.dumps({'name': name, 'version': version}))
+        pipe.execute_command('ZADD', 'files:%s' % normalized,
+                             record['upload_time'], record['filename'])
+        pipe.set('file:%s' % record['filename'], json.dumps(record))
+
+    def apply_remove_file(self, pipe, touched, normalized, filename):
+        if self.db.zscore('files:%s' % normalized, filename) is None:
+            return
+        touched[normalized] = (self.db.hget('pkg:%s' % normalized, 'name') or
+                               normalized)
+        pipe.zrem('files:%s' % normalized, filename)
+        pipe.delete('file:%s' % filename)
+
+    def apply_valid(self, pipe, touched, kind, values):
+        if values:
+            pipe.sadd('valid:%s' % kind, *values)
+
+    def get_project(self, normalized):
+        name, serial = self.db.hmget('pkg:%s' % normalized, 'name', 'serial')
+        if name is not None:
+            return name, int(serial or 0)
+
+    def get_changed_projects(self, since=0):
+        if since:
+            return [(normalized, int(serial)) for normalized, serial in
+                    self.db.zrangebyscore('serials', '(%d' % since, '+inf',
+                                          withscores=True)]
+        # Projects last written before there was a serials zset aren't in
+        # it, so the full list comes from the keys.
+        changed = []
+        for key in self.db.scan_iter('pkg:*'):
+            serial = self.db.hget(key, 'serial')
+            changed.append((key[len('pkg:'):], int(serial or 0)))
+        return changed
+
+    def get_releases(self, normalized):
+        versions = self.db.zrange('releases:%s' % normalized, 0, -1)
+        if not versions:
+            return {}
+        values = self.db.mget(['release:%s:%s' % (normalized, v)
+                               for v in versions])
+        return dict((v, json.loads(m)) for v, m in zip(versions, values)
+                    if m is not None)
+
+    def get_release(self, normalized, version):
+        value = self.db.get('release:%s:%s' % (normalized, version))
+        if value is not None:
+            return json.loads(value)
+
+    def get_versions(self, normalized):
+        return self.db.zrange('releases:%s' % normalized, 0, -1)
+
+    def get_files(self, normalized, version=None):
+        filenames = self.db.zrevrange('files:%s' % normalized, 0, -1)
+        if not filenames:
+            return []
+        records = [json.loads(r) for r in
+                   self.db.mget(['file:%s' % f for f in filenames])
+                   if r is not None]
+        if version is not None:
+            records = [r for r in records if r['version'] == version]
+        return records
+
+    def get_file_digests(self, normalized=None):
+        if normalized is not None:
+            keys = ['file:%s' % f for f in
+                    self.db.zrange('files:%s' % normalized, 0, -1)]
+        else:
+            keys = list(self.db.scan_iter('file:*'))
+        digests = {}
+        for i in range(0, len(keys), 1000):
+            for value in self.db.mget(keys[i:i + 1000]):
+                record = json.loads(value) if value is not None else {}
+                if record.get('path') and record.get('sha256_digest'):
+                    digests[record['path']] = record['sha256_digest']
+        return digests
+
+    def get_valid(self, kind):
+        return list(self.db.smembers('valid:%s' % kind))
+
+
+BACKENDS = {'sqlite': SQLiteBackend,
+            'redis': RedisBackend}
+
+
+def make_backend(config, base_path, **overrides):
+    """
+    Build a Backend from the MetadataStore section of the config.
+
+    """
+    config = dict(config or {})
+    config.update(overrides)
+    kind = config.pop('backend', 'sqlite')
+    if kind == 'sqlite':
+        config['path'] = os.path.join(base_path,
+                                      config.get('path', 'var/ministry.db'))
+    return BACKENDS[kind](**config)
 
-#db = redis.Redis()
 
 class PyPIData(object):
 
+    """
+    Wherever 'version is None' means the latest version, that's latest by
+    PEP 440 ordering, pre-releases included. Each project's versions are
+    kept pre-parsed and sorted in a ReleaseIndex, built on first use and
+    updated in place as our own writes are applied. If the project's
+    serial shows some other process has changed it since, it's rebuilt.
+
+    """
+
+    def __init__(self, backend, index=None):
+        self.backend = backend
+        # A core.index.PackageIndex, for name lookups. We're where it gets
+        # its files' sha256 digests from.
+        self.index = index
+        self.releases = {}
+        backend.listeners.append(self.releases_changed)
+        if index is not None and index.digest_source is None:
+            index.digest_source = self.file_digests
+            index.fill_digests(index.projects)
+
+    def read(self):
+        # Reads should see our own writes, even ones still waiting to be
+        # batched; not those in an open batch() block, though, which is
+        # all or nothing.
+        self.backend.flush()
+        return self.backend
+
+    def batch(self):
+        return self.backend.batch()
+
+    def flush(self):
+        """
+        Apply every write still waiting to be batched, and wait for it;
+        for when the IOLoop is about to stop.
+
+        """
+        self.backend.flush()
+
     def find_pkg(self, pkg):
         """
         The idea here is to define a relatively efficient method of
-        finding packages in a case-insensitive way. This will probably
-        return the proper package name as stored in redis.
+        finding packages in a case-insensitive way. Returns the proper
+        package name, or None if there's no such package.
+
+        Names are compared PEP 503 normalized, via the package index if
+        there is one, otherwise via the data store.
 
         """
-        pass
+        if self.index is not None:
+            project = self.index.find(pkg)
+            if project is not None:
+                return project.name
+        found = self.read().get_project(normalize_name(pkg))
+        if found is not None:
+            return found[0]
+
+    def get_pkg_serial(self, pkg):
+        """
+        A number that goes up every time anything about the package
+        changes, or None for an unknown package.
+
+        """
+        found = self.read().get_project(normalize_name(pkg))
+        if found is not None:
+            return found[1]
 
     def get_pkg_meta(self, pkg):
         """
-        Return all metadata for a package. Don't forget to
-        make the search case-insensitive.
+        Return all metadata for a package, as {version: metadata}.
+        The search is case-insensitive.
+
+        """
+        return self.read().get_releases(normalize_name(pkg))
+
+    def release_index(self, pkg):
+        normalized = normalize_name(pkg)
+        found = self.read().get_project(normalized)
+        if found is None:
+            self.releases.pop(normalized, None)
+            return ReleaseIndex()
+        releases = self.releases.get(normalized)
+        if releases is None or releases.serial != found[1]:
+            releases = ReleaseIndex(self.backend.get_versions(normalized),
+                                    serial=found[1])
+            self.releases[normalized] = releases
+        return releases
+
+    def releases_changed(self, changes, ops):
+        for op in ops:
+            if op[0] not in ('release', 'file', 'remove_file'):
+                continue
+            normalized = op[1]
+            releases = self.releases.get(normalized)
+            # Removing a file the store had no record of changes nothing.
+            if releases is None or normalized not in changes:
+                continue
+            old_serial, new_serial = changes[normalized]
+            if releases.serial not in (old_serial, new_serial):
+                # Someone else got in first; rebuild it next time.
+                del self.releases[normalized]
+                continue
+            if op[0] != 'remove_file':
+                releases.add(op[3])
+            releases.serial = new_serial
+
+    def get_latest_version(self, pkg, stable=False):
+        """
+        The highest version of the package, or the highest that isn't a
+        pre-release if stable is True.
+
+        """
+        releases = self.release_index(pkg)
+        if stable:
+            return releases.latest_stable()
+        return releases.latest()
+
+    def get_versions(self, pkg):
+        """
+        All versions of the package, newest first.
 
         """
-        pass
+        return self.release_index(pkg).newest_first()
 
     def get_most_recent_tarball(self, pkg):
         """
         Get the name of the most recent tarball for package named 'pkg'.
 
         """
-        pass
+        sdists = dict((r['version'], r['filename']) for r in
+                      reversed(self.read().get_files(normalize_name(pkg)))
+                      if r['filetype'] == 'sdist')
+        for version in self.get_versions(pkg):
+            if version in sdists:
+                return sdists[version]
 
     def get_pkg_meta_field(self, pkg, field, version=None):
         """
         If version is None, return value for 'field' in latest version.
 
         """
-        pass
+        normalized = normalize_name(pkg)
+        if version is None:
+            version = self.get_latest_version(pkg)
+            if version is None:
+                return None
+        metadata = self.read().get_release(normalized, version)
+        if metadata is not None:
+            return metadata.get(field)
+
+    def get_pkg_files(self, pkg, version=None):
+        return self.read().get_files(normalize_name(pkg), version)
+
+    def file_digests(self, normalized=None, flush=True):
+        # Without the flush, this is safe to call off the IOLoop; writes
+        # still queued are missed, but the files they're for went into
+        # the index with their digests when they were uploaded.
+        backend = self.read() if flush else self.backend
+        return backend.get_file_digests(normalized)
 
     def get_pkg_download_url(self, pkg, version=None):
         """
         If version is None, get url for most recent version. Otherwise,
         return the url for the specified version.
 
+        Where a release has several files, the sdist wins, then whatever
+        was uploaded most recently.
+
         """
-        pass
+        normalized = normalize_name(pkg)
+        if version is None:
+            version = self.get_latest_version(pkg)
+            if version is None:
+                return None
+        files = self.read().get_files(normalized, version)
+        for record in files:
+            if record['filetype'] == 'sdist':
+                return record['url']
+        if files:
+            return files[0]['url']
 
-    def store_pkg_metadata(self, pkg, version):
+    def store_pkg_metadata(self, pkg, version, metadata):
         """
         Store all metadata for package. Should be called in the
         'upload' and 'register' setup.py commands, which both
         pass package metadata.
 
         """
-        pass
+        metadata = dict((k, v) for k, v in metadata.items()
+                        if k not in NON_METADATA_KEYS)
+        self.backend.queue(('release', normalize_name(pkg), pkg, version,
+                            metadata, time.time()))
+
+    def store_pkg_file(self, pkg, version, filename, **record):
+        """
+        Record a file belonging to a release. Keyword arguments can be
+        any of filetype, url, path, size, md5_digest and sha256_digest.
+
+        """
+        record['filename'] = filename
+        record.setdefault('upload_time', time.time())
+        self.backend.queue(('file', normalize_name(pkg), pkg, version,
+                            record))
+
+    def remove_pkg_file(self, pkg, filename):
+        """
+        Forget the record of a file that's gone. Its release stays.
+
+        """
+        self.backend.queue(('remove_file', normalize_name(pkg), filename))
 
     def update_pkg_metadata(self, pkg, version=None, **kwargs):
         """
@@ -59,27 +904,58 @@ class PyPIData(object):
         most recent version of the package.
 
         """
-        pass
+        normalized = normalize_name(pkg)
+        if version is None:
+            version = self.get_latest_version(pkg)
+            if version is None:
+                return
+        self.backend.queue(('update', normalized, version, kwargs))
 
     def populate_initial_valid_metadata(self):
         """
         If we find an empty data store upon startup, we'll populate a
-        redis list containing the metadata fields recognized by distutils.
+        list containing the metadata fields recognized by distutils.
 
         """
-        pass
+        if not self.read().get_valid('metadata'):
+            self.backend.queue(('valid', 'metadata', DISTUTILS_FIELDS))
 
     def populate_initial_valid_classifiers(self):
         """
         If we find an empty data store upon startup, we'll populate a list
         of valid classifiers as published at:
 
-        http://pypi.python.org/pypi?:action=list_classifiers
+        https://pypi.org/pypi?%3Aaction=list_classifiers
 
-        I intend to actuall call that url in the setup, so while pypi *does*
-        need to be available to do the initial population, it won't be
-        necessary in a running service. The alternative is to check the url
-        on an ongoing basis, which is clearly worse :)
+        PyPI *does* need to be available to do the initial population, but
+        it won't be necessary in a running service. The alternative is to
+        check the url on an ongoing basis, which is clearly worse :)
 
         """
-        pass
+        if self.read().get_valid('classifiers'):
+            return
+        import urllib2
+        try:
+            classifiers = urllib2.urlopen(CLASSIFIERS_URL).read().splitlines()
+        except IOError as out:
+            logging.error("Couldn't fetch classifiers from %s: %s",
+                          CLASSIFIERS_URL, out)
+            return
+        self.backend.queue(('valid', 'classifiers',
+                            [c.strip() for c in classifiers if c.strip()]))
+
+
+def pypi_data(application):
+    """
+    The application's PyPIData, configured from settings['MetadataStore'].
+
+    """
+    data = getattr(application, 'pypi_data', None)
+    if data is None:
+        settings = application.settings
+        config = dict(settings.get('MetadataStore') or {})
+        config.setdefault('batch_delay', 0.05)
+        backend = make_backend(config, settings['base_path'])
+        data = PyPIData(backend, package_index(application))
+        application.pypi_data = data
+    return data
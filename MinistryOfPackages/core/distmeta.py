@@ -0,0 +1,504 @@
+"""
+Package metadata read out of the distribution files themselves.
+
+What 'register' and 'upload' post is whatever the client felt like
+sending, and files copied into PackageDirs by hand come with nothing at
+all. Every sdist has a PKG-INFO and every wheel a .dist-info/METADATA,
+though, and those are the authoritative version. extract() opens a file
+and parses whichever it has, and works out the file's digests while it's
+at it.
+
+Opening archives is slow, CPU-heavy work, so it runs in other processes.
+In the server that's a MetadataExtractor per worker, fed by uploads and by
+index scans that turn up files the metadata store doesn't know about;
+results are written back on the IOLoop through PyPIData like any other
+metadata. bin/ministry_backfill.py does a whole tree at once.
+
+"""
+import contextlib
+import email.parser
+import errno
+import fcntl
+import functools
+import hashlib
+import logging
+import multiprocessing
+import os
+import tarfile
+import threading
+import time
+import zipfile
+
+import tornado.concurrent
+import tornado.ioloop
+
+from MinistryOfPackages.core.blobs import FILE_MODE, makedirs_for, temp_beside
+from MinistryOfPackages.core.index import METADATA_SUFFIX
+
+DEFAULT_METADATA_PROCESSES = 1
+
+# Held by whichever worker is extracting what an index scan found, so the
+# others don't all do the same files.
+SCAN_LOCK = 'var/metadata-scan.lock'
+
+READ_SIZE = 1024 * 1024
+
+# How often, in seconds, pool processes check that the worker that started
+# them is still there.
+PARENT_CHECK_INTERVAL = 5
+
+# Seconds without a single extract() finishing, while some are still
+# outstanding, before they're given up on: a pool process that dies takes
+# its task with it, and nothing ever says so.
+EXTRACT_TIMEOUT = 300
+
+# How often, in seconds, to look for extract()s that have failed.
+EXTRACT_CHECK_INTERVAL = 5
+
+FILETYPES = (('.whl', 'bdist_wheel'), ('.egg', 'bdist_egg'),
+             ('.exe', 'bdist_wininst'), ('.msi', 'bdist_msi'),
+             ('.rpm', 'bdist_rpm'))
+
+# Fields that can appear more than once, and the keys their lists are
+# stored under. Classifiers use the name distutils posts them as.
+MULTIPLE_USE = {'classifier': 'classifiers',
+                'platform': 'platform',
+                'supported-platform': 'supported_platform',
+                'requires': 'requires',
+                'provides': 'provides',
+                'obsoletes': 'obsoletes',
+                'requires-dist': 'requires_dist',
+                'provides-dist': 'provides_dist',
+                'obsoletes-dist': 'obsoletes_dist',
+                'requires-external': 'requires_external',
+                'project-url': 'project_urls',
+                'provides-extra': 'provides_extra',
+                'license-file': 'license_file',
+                'dynamic': 'dynamic'}
+
+# What distutils writes for fields nobody filled in.
+UNKNOWN = 'UNKNOWN'
+
+
+def filetype(filename):
+    lowered = filename.lower()
+    for ext, kind in FILETYPES:
+        if lowered.endswith(ext):
+            return kind
+    return 'sdist'
+
+
+def find_member(names, wanted):
+    """
+    The shallowest of 'names' whose last component is 'wanted' and that
+    sits exactly one directory down, which is where PKG-INFO and METADATA
+    live. Deeper copies (an sdist's .egg-info/PKG-INFO) are ignored.
+
+    """
+    found = [n for n in names
+             if n.count('/') == 1 and n.rsplit('/', 1)[1] == wanted]
+    return min(found, key=len) if found else None
+
+
+def read_metadata(path, filename=None):
+    """
+    The raw PKG-INFO or METADATA from the distribution at 'path', or None
+    if it doesn't have one we can get at. What kind of distribution it is
+    goes by 'filename' if that's given, for files still in temp files.
+
+    """
+    lowered = (filename or path).lower()
+    if lowered.endswith('.whl'):
+        with zipfile.ZipFile(path) as archive:
+            names = [n for n in archive.namelist()
+                     if n.split('/')[0].endswith('.dist-info')]
+            member = find_member(names, 'METADATA')
+            return archive.read(member) if member else None
+    if lowered.endswith(('.egg', '.zip')):
+        with zipfile.ZipFile(path) as archive:
+            member = find_member(archive.namelist(), 'PKG-INFO')
+            return archive.read(member) if member else None
+    if lowered.endswith(('.tar.gz', '.tgz', '.tar.bz2', '.tar')):
+        with contextlib.closing(tarfile.open(path)) as archive:
+            member = find_member(archive.getnames(), 'PKG-INFO')
+            if member is None:
+                return None
+            f = archive.extractfile(member)
+            return f.read() if f is not None else None
+    return None
+
+
+def parse_metadata(text):
+    """
+    Turn PKG-INFO/METADATA text into a metadata dict, keyed the way
+    SetupPyHandler gets them from distutils: lowercase, with '_' for '-'.
+    Fields that can repeat are lists.
+
+    """
+    message = email.parser.Parser().parsestr(text.decode('utf-8', 'replace'))
+    metadata = {}
+    for header, value in message.items():
+        field = header.lower()
+        value = value.strip()
+        if not value or value == UNKNOWN:
+            continue
+        if field in MULTIPLE_USE:
+            metadata.setdefault(MULTIPLE_USE[field], []).append(value)
+        else:
+            metadata[field.replace('-', '_')] = value
+
+    # Metadata 2.1 puts the description in the body. Before that it's a
+    # header, with continuation lines indented and often prefixed with '|'.
+    body = message.get_payload()
+    if body and body.strip():
+        metadata['description'] = body
+    elif 'description' in metadata:
+        lines = message['Description'].splitlines()
+        metadata['description'] = '\n'.join(
+            [lines[0].strip()] +
+            [line.lstrip()[1:] if line.lstrip().startswith('|')
+             else line.strip() for line in lines[1:]])
+    return metadata
+
+
+def extract(path, digests=True):
+    """
+    Everything we can learn from the file at 'path', as a dict: its
+    'metadata' (None if there wasn't any, with the reason in 'error'),
+    'size' and 'mtime', and unless 'digests' is False, 'md5_digest' and
+    'sha256_digest'. Never raises; this runs in pool processes.
+
+    """
+    result = {'path': path, 'metadata': None, 'error': None}
+    try:
+        st = os.stat(path)
+        result['size'] = st.st_size
+        result['mtime'] = st.st_mtime
+        if digests:
+            md5, sha256 = hashlib.md5(), hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(READ_SIZE), ''):
+                    md5.update(block)
+                    sha256.update(block)
+            result['md5_digest'] = md5.hexdigest()
+            result['sha256_digest'] = sha256.hexdigest()
+        text = read_metadata(path)
+        if text is None:
+            result['error'] = 'no PKG-INFO or METADATA'
+        else:
+            result['metadata'] = parse_metadata(text)
+    except Exception as out:
+        result['error'] = '%s: %s' % (out.__class__.__name__, out)
+    return result
+
+
+def write_metadata_file(path, source=None):
+    """
+    Put the METADATA of the wheel at 'path' beside it, as the metadata file
+    PEP 658 has installers fetch instead of the whole wheel. It's read from
+    'source' if given, so it can be written before the wheel is published
+    and the two never appear without each other.
+
+    Only wheels get one: their METADATA is what installers would use
+    anyway, where an sdist's PKG-INFO may not match what building it
+    produces. Returns True if there's a metadata file now.
+
+    """
+    if not path.lower().endswith('.whl'):
+        return False
+    metadata_path = path + METADATA_SUFFIX
+    temp = stage_metadata_file(path, source)
+    if temp is None:
+        # Don't leave one from an earlier upload of the same filename.
+        if os.path.exists(metadata_path):
+            os.unlink(metadata_path)
+        return False
+    try:
+        os.rename(temp, metadata_path)
+    except Exception:
+        os.unlink(temp)
+        raise
+    return True
+
+
+def stage_metadata_file(path, source=None):
+    """
+    write_metadata_file(), up to the point of renaming the metadata file
+    into place: returns the temp file beside it that's to be renamed, or
+    None if there's to be no metadata file.
+
+    """
+    if not path.lower().endswith('.whl'):
+        return None
+    metadata_path = path + METADATA_SUFFIX
+    try:
+        text = read_metadata(source or path, os.path.basename(path))
+    except Exception as out:
+        logging.error("Can't read METADATA from %s: %s", path, out)
+        text = None
+    if text is None:
+        return None
+
+    makedirs_for(metadata_path)
+    temp = temp_beside(metadata_path)
+    try:
+        with open(temp, 'wb') as f:
+            f.write(text)
+        os.chmod(temp, FILE_MODE)
+    except Exception:
+        os.unlink(temp)
+        raise
+    return temp
+
+
+def release_fields(metadata):
+    """
+    What from extracted 'metadata' should be merged into a release's
+    stored metadata. The name and version stay as they were stored, since
+    the archive's spelling of them can differ.
+
+    """
+    return dict((k, v) for k, v in metadata.items()
+                if k not in ('name', 'version'))
+
+
+def record_file(data, project_name, dist, result):
+    """
+    Queue the writes recording 'dist', a core.index.DistFile belonging to
+    'project_name' that the metadata store didn't know about, from its
+    extract() 'result'. Returns the version it was filed under, or None
+    if there's no telling what version it is.
+
+    """
+    metadata = result['metadata'] or {}
+    version = metadata.get('version') or dist.version
+    if version is None:
+        return None
+    data.store_pkg_file(project_name, version, dist.filename,
+                        filetype=filetype(dist.filename), url=dist.url,
+                        path=dist.path, size=result['size'],
+                        md5_digest=result['md5_digest'],
+                        sha256_digest=result['sha256_digest'],
+                        upload_time=result['mtime'])
+    if metadata:
+        data.update_pkg_metadata(project_name, version,
+                                 **release_fields(metadata))
+    dist.sha256 = result['sha256_digest']
+    return version
+
+
+def exit_with_parent():
+    """
+    Pool initializer: a thread that exits the process if its parent goes
+    away. Pools are cleaned up when a worker exits normally, but a worker
+    that's been killed leaves them waiting on their task queue forever.
+
+    """
+    parent = os.getppid()
+
+    def watch():
+        while True:
+            time.sleep(PARENT_CHECK_INTERVAL)
+            if os.getppid() != parent:
+                os._exit(0)
+    thread = threading.Thread(target=watch)
+    thread.daemon = True
+    thread.start()
+
+
+def try_lock(path):
+    """
+    The lock file at 'path', open and locked, or None if someone else has
+    it. Closing the file, or exiting, gives it up.
+
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    lockfile = open(path, 'a')
+    try:
+        fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as out:
+        lockfile.close()
+        if out.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return lockfile
+
+
+class MetadataExtractor(object):
+    """
+    A pool of 'processes' processes running extract(), for a server
+    worker. Create it before starting any threads or binding any sockets,
+    since the processes are forked straight away and inherit whatever the
+    worker has at that point.
+
+    """
+
+    def __init__(self, processes, lock_path):
+        self.pool = multiprocessing.Pool(processes,
+                                         initializer=exit_with_parent)
+        self.lock_path = lock_path
+        self.io_loop = None
+        # Files from the last scan still being extracted.
+        self.scanning = 0
+        # {Future: (AsyncResult, path)} for every extract() not back yet,
+        # and when the last one came back.
+        self.outstanding = {}
+        self.progress = time.time()
+        self.checker = None
+
+    def extract(self, path, digests=True):
+        """
+        extract() in a pool process. Returns a Future that resolves, on the
+        IOLoop, to its result, or to an exception if the pool process
+        raised or died.
+
+        """
+        if self.io_loop is None:
+            self.io_loop = tornado.ioloop.IOLoop.current()
+            self.checker = tornado.ioloop.PeriodicCallback(
+                self.check, EXTRACT_CHECK_INTERVAL * 1000)
+            self.checker.start()
+        future = tornado.concurrent.Future()
+        if not self.outstanding:
+            self.progress = time.time()
+        # The callback comes in on the pool's result thread. Python 2's
+        # apply_async has no error callback, so failures are left to
+        # check().
+        result = self.pool.apply_async(
+            extract, (path, digests),
+            callback=lambda result: self.io_loop.add_callback(
+                self.resolve, future, result))
+        self.outstanding[future] = (result, path)
+        return future
+
+    def resolve(self, future, result):
+        if self.outstanding.pop(future, None) is not None:
+            self.progress = time.time()
+            future.set_result(result)
+
+    def check(self):
+        """
+        Fail the futures of extract()s that raised, and if none has come
+        back for EXTRACT_TIMEOUT seconds, of all that are left.
+
+        """
+        stalled = time.time() - self.progress >= EXTRACT_TIMEOUT
+        for future, (result, path) in self.outstanding.items():
+            if result.ready():
+                if result.successful():
+                    # resolve() is on its way.
+                    continue
+                try:
+                    result.get(0)
+                except Exception as out:
+                    error = out
+            elif stalled:
+                error = RuntimeError("No result after %ds; the pool "
+                                     "process may have died" %
+                                     EXTRACT_TIMEOUT)
+            else:
+                continue
+            del self.outstanding[future]
+            future.set_exception(error)
+            logging.error("Extracting metadata from %s: %s", path, error)
+
+    def update_release(self, data, name, version, path):
+        """
+        Merge what's in the uploaded file at 'path' into the stored
+        metadata for release 'version' of 'name', once it's been read.
+
+        """
+        def done(future):
+            try:
+                result = future.result()
+            except Exception:
+                # check() has logged it.
+                return
+            if result['metadata'] is None:
+                logging.debug("No metadata from %s: %s", path,
+                              result['error'])
+                return
+            data.update_pkg_metadata(name, version,
+                                     **release_fields(result['metadata']))
+            logging.debug("Recorded metadata from %s", path)
+        future = self.extract(path, digests=False)
+        self.io_loop.add_future(future, done)
+
+    def watch(self, data):
+        """
+        Record every file data.index has that the metadata store doesn't
+        know about (so it has no sha256), now and after each rescan. A
+        shared index is left to whichever process scans it next, rather
+        than having every worker read all of it as it starts.
+
+        """
+        data.index.scan_listeners.append(
+            lambda projects: self.catch_up(data, projects))
+        if data.index.index_file is None:
+            self.catch_up(data, data.index.projects)
+
+    def catch_up(self, data, projects):
+        unknown = [(project.name, dist) for project in projects.values()
+                   for dist in project.files.values() if dist.sha256 is None]
+        if not unknown or self.scanning:
+            return
+        lockfile = try_lock(self.lock_path)
+        if lockfile is None:
+            logging.debug("Another worker is extracting metadata")
+            return
+
+        logging.info("Extracting metadata from %d unrecorded files",
+                     len(unknown))
+        self.scanning = len(unknown)
+
+        def done(project_name, dist, future):
+            try:
+                try:
+                    result = future.result()
+                except Exception:
+                    # check() has logged it, and the file's tried again
+                    # after the next scan.
+                    return
+                if result['error'] is not None:
+                    logging.error("Reading %s: %s", dist.path,
+                                  result['error'])
+                if 'sha256_digest' in result:
+                    record_file(data, project_name, dist, result)
+            finally:
+                self.scanning -= 1
+                if not self.scanning:
+                    # A pool process started in place of one that died
+                    # shares the lock file, so closing ours isn't enough.
+                    fcntl.flock(lockfile, fcntl.LOCK_UN)
+                    lockfile.close()
+
+        for project_name, dist in unknown:
+            future = self.extract(dist.path)
+            self.io_loop.add_future(
+                future, functools.partial(done, project_name, dist))
+
+    def shutdown(self):
+        if self.checker is not None:
+            self.checker.stop()
+        self.pool.terminate()
+
+
+def metadata_extractor(application):
+    """
+    The application's MetadataExtractor, or None if
+    settings['metadata_processes'] is 0.
+
+    """
+    extractor = getattr(application, 'metadata_extractor', None)
+    if extractor is None:
+        settings = application.settings
+        processes = settings.get('metadata_processes',
+                                 DEFAULT_METADATA_PROCESSES)
+        if not processes:
+            return None
+        extractor = MetadataExtractor(
+            processes, os.path.join(settings['base_path'], SCAN_LOCK))
+        application.metadata_extractor = extractor
+    return extractor
@@ -0,0 +1,76 @@
+"""
+A bounded pool of threads for blocking filesystem work.
+
+Handlers hand stat, listdir, open, read and write calls to the pool and
+yield the futures they get back, so one slow disk (or a cold NFS mount)
+stalls the requests waiting on it rather than the whole IOLoop. The pool
+has settings['io_threads'] threads; work beyond that waits its turn in the
+executor's queue.
+
+How deep that queue gets and how long work sits in it are what say
+whether the pool is big enough, so both go into the worker's region of
+core.metrics when there is one.
+
+Anything run here mustn't touch state the IOLoop thread owns without the
+GIL making it safe, and in particular mustn't use the metadata store,
+whose write queue belongs to the IOLoop thread (it has a writer thread
+of its own).
+
+"""
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_IO_THREADS = 8
+
+
+class IOExecutor(object):
+
+    def __init__(self, threads, stats=None):
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(threads)
+        # A core.metrics.WorkerMetrics. Pool threads and the IOLoop thread
+        # all record into it, so it's only touched under the lock.
+        self.stats = stats
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs) on a pool thread. Returns a
+        concurrent.futures.Future, which coroutines can yield.
+
+        """
+        if self.stats is not None:
+            with self.lock:
+                self.stats.io_submitted()
+        return self.pool.submit(self.run, time.time(), fn, args, kwargs)
+
+    def run(self, submitted, fn, args, kwargs):
+        started = time.time()
+        if self.stats is None:
+            return fn(*args, **kwargs)
+        with self.lock:
+            self.stats.io_started(started - submitted)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.stats.io_finished(time.time() - started)
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait)
+
+
+def io_executor(application):
+    """
+    The application's IOExecutor, created on first use.
+
+    """
+    executor = getattr(application, 'io_executor', None)
+    if executor is None:
+        executor = IOExecutor(
+            application.settings.get('io_threads', DEFAULT_IO_THREADS),
+            getattr(application, 'worker_metrics', None))
+        application.io_executor = executor
+    return executor
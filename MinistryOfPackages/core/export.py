@@ -0,0 +1,246 @@
+"""
+A static copy of the PEP 503 simple index, for a front end like nginx to
+serve without involving us at all.
+
+Under settings['static_export_dir'] we keep simple/index.html and
+simple/<project>/index.html, each with an index.html.gz beside it for
+nginx's gzip_static. The pages are rendered from the same templates
+SimpleIndexHandler uses, so the two never disagree.
+
+Every page is written to a temporary file and renamed into place, so a
+reader always sees a complete page, old or new. SetupPyHandler.upload calls
+update() to redo just the uploaded project's page and the root page, which
+happens in the background, off the IOLoop; a full rebuild is
+bin/ministry_export.py's job.
+
+"""
+import contextlib
+import fcntl
+import gzip
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+from cStringIO import StringIO
+
+import tornado.gen
+import tornado.ioloop
+import tornado.template
+
+from MinistryOfPackages.core.dao import pypi_data
+from MinistryOfPackages.core.executor import io_executor
+from MinistryOfPackages.core.index import Project
+
+GZIP_LEVEL = 9
+
+
+def gzip_page(page):
+    out = StringIO()
+    # A fixed mtime keeps the output the same for the same page.
+    gz = gzip.GzipFile(filename='', mode='wb', compresslevel=GZIP_LEVEL,
+                       fileobj=out, mtime=0)
+    gz.write(page)
+    gz.close()
+    return out.getvalue()
+
+
+def write_atomic(path, data):
+    fd, temp = tempfile.mkstemp(prefix='.' + os.path.basename(path),
+                                dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(data)
+        os.chmod(temp, 0o644)
+        os.rename(temp, path)
+    except Exception:
+        os.unlink(temp)
+        raise
+
+
+class StaticExport(object):
+
+    def __init__(self, export_dir, template_path, index, executor=None):
+        self.simple_dir = os.path.join(export_dir, 'simple')
+        self.loader = tornado.template.Loader(template_path)
+        self.index = index
+        # A core.executor.IOExecutor, which update() needs.
+        self.executor = executor
+        # Projects update() has been asked about that the writer hasn't
+        # got to yet, and whether it's running.
+        self.pending = set()
+        self.writing = False
+        if not os.path.isdir(self.simple_dir):
+            os.makedirs(self.simple_dir)
+
+    def acquire(self):
+        """
+        Take the lock that serializes updates between processes, so a page
+        one process rendered from an older view of the disk can't be
+        renamed over a newer one. Returns the lock file; closing it lets
+        the lock go.
+
+        """
+        lockfile = open(os.path.join(self.simple_dir, '.lock'), 'a')
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+        except Exception:
+            lockfile.close()
+            raise
+        return lockfile
+
+    @contextlib.contextmanager
+    def lock(self):
+        lockfile = self.acquire()
+        try:
+            yield
+        finally:
+            lockfile.close()
+
+    def write_page(self, directory, page):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, 'index.html')
+        write_atomic(path + '.gz', gzip_page(page))
+        write_atomic(path, page)
+
+    def export_project(self, project):
+        page = self.loader.load('simple_project.html').generate(
+            project=project, files=project.sorted_files())
+        self.write_page(os.path.join(self.simple_dir, project.normalized),
+                        page)
+
+    def remove_project(self, normalized):
+        shutil.rmtree(os.path.join(self.simple_dir, normalized),
+                      ignore_errors=True)
+
+    def export_root(self, projects):
+        page = self.loader.load('simple_index.html').generate(
+            projects=projects)
+        self.write_page(self.simple_dir, page)
+
+    def exported(self):
+        return [entry for entry in os.listdir(self.simple_dir)
+                if not entry.startswith('.') and
+                os.path.isdir(os.path.join(self.simple_dir, entry))]
+
+    def update(self, name):
+        """
+        Bring the pages affected by a change to project 'name' up to date:
+        its own, from a fresh look at the disk, and the root page.
+
+        That's done by write_pending(), one lot at a time, in the
+        background. Projects changed while it's busy are done together
+        next, with the root page rendered once for all of them.
+
+        """
+        self.pending.add(name)
+        if not self.writing:
+            self.writing = True
+            tornado.ioloop.IOLoop.current().spawn_callback(
+                self.write_pending)
+
+    @tornado.gen.coroutine
+    def write_pending(self):
+        """
+        The lock, the disk and the pages are seen to on the IOExecutor;
+        only filling in digests from the metadata store, and swapping the
+        projects into the index, happen on the IOLoop.
+
+        """
+        try:
+            while self.pending:
+                names, self.pending = self.pending, set()
+                try:
+                    lockfile = yield self.executor.submit(self.acquire)
+                    try:
+                        found = yield self.executor.submit(
+                            self.index.read_projects, names)
+                        self.index.replace_projects(found)
+                        projects = dict(
+                            (project.normalized, project)
+                            for project in self.index.sorted_projects())
+                        yield self.executor.submit(self.write_update, found,
+                                                   projects)
+                    finally:
+                        lockfile.close()
+                except (IOError, OSError) as out:
+                    # The uploads are stored either way; the next full
+                    # rebuild will catch the pages up.
+                    logging.error("Static index export for %s failed: %s",
+                                  ', '.join(sorted(names)), out)
+        finally:
+            self.writing = False
+
+    def write_update(self, found, projects):
+        """
+        Rewrite the pages of the projects in 'found', from
+        read_projects(), and the root page, listing 'projects' plus
+        anything another process has exported since our last scan, so
+        uploads handled elsewhere don't drop off it.
+
+        """
+        for normalized, project in found.items():
+            if project is None:
+                self.remove_project(normalized)
+            else:
+                self.export_project(project)
+        for normalized in self.exported():
+            projects.setdefault(normalized, Project(normalized))
+        self.export_root([projects[p] for p in sorted(projects)])
+
+    def rebuild(self, processes=None):
+        """
+        Rescan PackageDirs and rewrite every page, rendering projects in a
+        pool of 'processes' processes (one per CPU by default). Pages for
+        projects that are gone are removed. Returns the number of projects.
+
+        """
+        global _rebuilding
+        self.index.scan()
+        names = sorted(self.index.projects)
+
+        _rebuilding = self
+        pool = multiprocessing.Pool(processes)
+        try:
+            pool.map(_export_one, names, chunksize=64)
+        finally:
+            pool.close()
+            pool.join()
+            _rebuilding = None
+
+        with self.lock():
+            for normalized in self.exported():
+                if normalized not in self.index.projects:
+                    self.remove_project(normalized)
+            self.export_root(self.index.sorted_projects())
+        return len(names)
+
+
+# The StaticExport a rebuild's pool processes inherit when they're forked.
+_rebuilding = None
+
+
+def _export_one(normalized):
+    _rebuilding.export_project(_rebuilding.index.projects[normalized])
+
+
+def static_export(application):
+    """
+    The application's StaticExport, or None if there's no
+    static_export_dir setting.
+
+    """
+    exporter = getattr(application, 'static_export', None)
+    if exporter is None:
+        settings = application.settings
+        export_dir = settings.get('static_export_dir')
+        if not export_dir:
+            return None
+        exporter = StaticExport(
+            os.path.join(settings['base_path'], export_dir),
+            settings['template_path'], pypi_data(application).index,
+            io_executor(application))
+        application.static_export = exporter
+        logging.debug("Static index export to %s", exporter.simple_dir)
+    return exporter
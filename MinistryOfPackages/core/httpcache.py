@@ -0,0 +1,117 @@
+"""
+Validators and Cache-Control policy for what DirectoryListingHandler (and
+anything else that wants them) serves.
+
+Artifacts get strong ETags built from inode, size and mtime, which change
+whenever a file is replaced. Directory listings get weak ETags built from
+the directory's own stat, since that's what changes when entries are
+added, removed or renamed.
+
+Cache-Control policies come from the 'CacheControl' section of the
+Application config, keyed by path class ('artifacts', 'listings', ...).
+A class with no policy gets no Cache-Control header at all.
+
+"""
+import datetime
+import email.utils
+import hashlib
+
+
+def file_etag(st):
+    return '"%x-%x-%x"' % (st.st_ino, st.st_size, int(st.st_mtime * 1000000))
+
+
+def listing_etag(*stats):
+    """
+    Weak ETag for a rendered listing. Pass the stat of the directory and
+    of anything else that shows up on the page (e.g. the parent dir).
+
+    """
+    state = ','.join('%x-%x-%x' % (st.st_ino, st.st_size,
+                                   int(st.st_mtime * 1000000))
+                     for st in stats)
+    return 'W/"%s"' % hashlib.md5(state).hexdigest()
+
+
+def last_modified(mtime):
+    return datetime.datetime.utcfromtimestamp(int(mtime))
+
+
+def strip_weak(etag):
+    etag = etag.strip()
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    return etag
+
+
+def etag_matches(header, etag):
+    """
+    Weak comparison of our ETag against an If-None-Match header value.
+
+    """
+    if header.strip() == '*':
+        return True
+    ours = strip_weak(etag)
+    return any(strip_weak(theirs) == ours for theirs in header.split(','))
+
+
+def parse_http_date(value):
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return email.utils.mktime_tz(parsed)
+
+
+def is_not_modified(headers, etag, mtime):
+    """
+    Decide whether a GET/HEAD can be answered with a 304. If-None-Match
+    wins when both it and If-Modified-Since are present (RFC 7232, 6).
+
+    """
+    if 'If-None-Match' in headers:
+        return etag_matches(headers['If-None-Match'], etag)
+    if 'If-Modified-Since' in headers:
+        since = parse_http_date(headers['If-Modified-Since'])
+        return since is not None and int(mtime) <= since
+    return False
+
+
+def if_range_matches(headers, etag, mtime):
+    """
+    A Range request carrying If-Range only gets a partial response if the
+    validator still matches; otherwise the client gets the whole file.
+    Entity tags must match strongly here.
+
+    """
+    if 'If-Range' not in headers:
+        return True
+    value = headers['If-Range'].strip()
+    if value.startswith('"') or value.startswith('W/'):
+        return not etag.startswith('W/') and value == etag
+    return parse_http_date(value) == int(mtime)
+
+
+def cache_control(settings, path_class):
+    return settings.get('CacheControl', {}).get(path_class)
+
+
+def set_cache_headers(handler, path_class, etag, mtime):
+    """
+    Set ETag, Last-Modified and Cache-Control on a handler's response.
+    Returns True if the request's conditional headers mean it should just
+    get a 304, in which case the status has already been set.
+
+    """
+    handler.set_header('Etag', etag)
+    handler.set_header('Last-Modified', last_modified(mtime))
+    policy = cache_control(handler.application.settings, path_class)
+    if policy:
+        handler.set_header('Cache-Control', policy)
+
+    if handler.request.method not in ('GET', 'HEAD'):
+        return False
+    if is_not_modified(handler.request.headers, etag, mtime):
+        handler.set_status(304)
+        return True
+    return False
+
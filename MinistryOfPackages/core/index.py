@@ -0,0 +1,888 @@
+"""
+An in-memory index of the distributions under PackageDirs, keyed on
+PEP 503 normalized project names.
+
+The layout on disk is the one SetupPyHandler.upload creates: one directory
+per project under each PackageDirs entry, holding that project's files.
+Distribution files sitting directly in a PackageDirs entry (copied there
+by hand, say) are filed under the project name parsed out of the filename.
+core.storage's sharded layout adds fan-out directories, named '_' and two
+hex digits, above the project directories and between them and their
+files; wherever they turn up, they're looked through.
+
+Lookups never touch the filesystem. The index is rebuilt by scan(), which
+package_index() schedules every settings['index_refresh_interval'] seconds
+so files written by other processes show up, and uploads in this process
+are added as they happen. The scheduled scans walk PackageDirs on the
+core.executor IOExecutor, so the IOLoop carries on serving meanwhile.
+
+With settings['index_file'], the server's processes share one index
+instead of each keeping its own: it lives in a core.mmindex file that
+they all map. Whichever process is due to scan first writes the next
+generation of it, as does every upload, and the others pick up a new
+generation within GENERATION_CHECK_INTERVAL seconds.
+
+A wheel can have its METADATA file beside it, as <filename>.metadata
+(PEP 658), for installers to resolve dependencies from without
+downloading the wheel. Its sha256 goes on the file's links. Metadata files
+are small, but there can be a great many of them, so each one's digest is
+only worked out once: it's kept from one scan to the next for as long as
+the wheel's mtime stays the same.
+
+"""
+import errno
+import hashlib
+
+import logging
+import os
+import re
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+import tornado.gen
+import tornado.ioloop
+from concurrent.futures import ThreadPoolExecutor
+
+from MinistryOfPackages.core.executor import io_executor
+from MinistryOfPackages.core.mmindex import (IndexFile, decode_block,
+                                             encode_block, locked,
+                                             splice_index, write_index)
+
+DIST_EXTENSIONS = ('.tar.gz', '.tgz', '.tar.bz2', '.tar.xz', '.tar', '.zip',
+                   '.whl', '.egg', '.exe', '.msi', '.rpm')
+
+DEFAULT_REFRESH_INTERVAL = 60
+
+DEFAULT_INDEX_FILE = 'var/index.bin'
+
+DEFAULT_SCAN_THREADS = 8
+
+# Seconds between looks at whether a shared index has a new generation.
+GENERATION_CHECK_INTERVAL = 1
+
+METADATA_SUFFIX = '.metadata'
+
+FANOUT_PREFIX = '_'
+
+_normalize_re = re.compile(r'[-_.]+')
+
+_hex_digits = frozenset('0123456789abcdef')
+
+
+def normalize_name(name):
+    """
+    PEP 503 name normalization: runs of '-', '_' and '.' become a single
+    '-', and everything is lowercased.
+
+    """
+    return _normalize_re.sub('-', name).lower()
+
+
+def fanout_name(key):
+    """
+    The fan-out directory 'key' (a name, or filename) goes in.
+
+    """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return FANOUT_PREFIX + hashlib.md5(key).hexdigest()[:2]
+
+
+def is_fanout(name):
+    return (len(name) == 3 and name[0] == FANOUT_PREFIX and
+            name[1] in _hex_digits and name[2] in _hex_digits)
+
+
+def is_safe_name(name):
+    """
+    Whether 'name', from a client or an upstream index, is fit to be a
+    single path component: not empty, not hidden (which rules out '.' and
+    '..' too), and without any directory separators in it.
+
+    """
+    return (bool(name) and not name.startswith('.') and
+            os.path.basename(name) == name and
+            '/' not in name and os.sep not in name and '\0' not in name)
+
+
+def is_distribution(filename):
+    return (not filename.startswith('.') and
+            filename.lower().endswith(DIST_EXTENSIONS))
+
+
+def split_filename(filename):
+    """
+    Best-effort split of a distribution filename into (project, version).
+    Returns (None, None) if it doesn't look like one.
+
+    Wheels and eggs are unambiguous since their names are '-' separated with
+    '_' standing in for '-' inside fields. For everything else, the version
+    starts at the first '-' followed by a digit.
+
+    """
+    lowered = filename.lower()
+    for ext in DIST_EXTENSIONS:
+        if lowered.endswith(ext):
+            stem = filename[:-len(ext)]
+            break
+    else:
+        return None, None
+
+    if ext in ('.whl', '.egg'):
+        parts = stem.split('-')
+        if len(parts) < 2:
+            return None, None
+        return parts[0], parts[1]
+
+    match = re.match(r'^(.+?)-(\d.*)$', stem)
+    if match is None:
+        return None, None
+    version = match.group(2)
+    # bdist_rpm / bdist_wininst tack platform bits onto the version.
+    if ext in ('.rpm', '.exe', '.msi'):
+        version = version.split('.linux')[0].split('.win')[0]
+    return match.group(1), version
+
+
+class DistFile(object):
+    __slots__ = ('filename', 'version', 'path', 'url', 'size', 'mtime',
+                 'sha256', 'metadata_sha256')
+
+    def __init__(self, filename, version, path, url, size, mtime,
+                 sha256=None, metadata_sha256=None):
+        self.filename = filename
+        self.version = version
+        self.path = path
+        self.url = url
+        self.size = size
+        self.mtime = mtime
+        self.sha256 = sha256
+        # The sha256 of the file's PEP 658 metadata file, if it has one.
+        self.metadata_sha256 = metadata_sha256
+
+    @property
+    def href(self):
+        """
+        The url for links to this file, with a #sha256= fragment for
+        installers to check the download against, if we know the digest.
+
+        """
+        if self.sha256:
+            return '%s#sha256=%s' % (self.url, self.sha256)
+        return self.url
+
+    def link_attrs(self):
+        """
+        Extra (name, value) attributes for this file's link on a simple
+        index page: where there's a metadata file, PEP 658's attribute and
+        PEP 714's newer name for it, since installers vary in which they
+        look for.
+
+        """
+        if self.metadata_sha256:
+            value = 'sha256=%s' % self.metadata_sha256
+            return [('data-dist-info-metadata', value),
+                    ('data-core-metadata', value)]
+        return []
+
+
+class Project(object):
+    """
+    A project's display name (as it was spelled on disk or at upload time)
+    and its files, keyed by filename.
+
+    """
+    __slots__ = ('name', 'normalized', 'files')
+
+    def __init__(self, name):
+        self.name = name
+        self.normalized = normalize_name(name)
+        self.files = {}
+
+    def sorted_files(self):
+        return [self.files[f] for f in sorted(self.files)]
+
+
+class MappedProjects(object):
+    """
+    A read-only {normalized name: Project} view of one generation of a
+    shared index. Projects are decoded as they're looked up, so changing
+    one doesn't change the index.
+
+    """
+
+    def __init__(self, mapped, base_path):
+        self.mapped = mapped
+        self.base_path = base_path
+
+    def project(self, i):
+        normalized, name = self.mapped.names(i)
+        project = Project(name)
+        for (filename, version, url, size, mtime, sha256,
+             metadata_sha256) in decode_block(self.mapped.block(i)):
+            path = os.path.join(self.base_path, *url[1:].split('/'))
+            project.files[filename] = DistFile(filename, version, path, url,
+                                               size, mtime, sha256,
+                                               metadata_sha256)
+        return project
+
+    def listing(self):
+        """
+        Every project in order, as Projects without their files.
+
+        """
+        return [Project(self.mapped.names(i)[1])
+                for i in range(self.mapped.count)]
+
+    def get(self, normalized, default=None):
+        i = self.mapped.find(normalized)
+        if i is None:
+            return default
+        return self.project(i)
+
+    def __getitem__(self, normalized):
+        project = self.get(normalized)
+        if project is None:
+            raise KeyError(normalized)
+        return project
+
+    def __contains__(self, normalized):
+        return self.mapped.find(normalized) is not None
+
+    def __len__(self):
+        return self.mapped.count
+
+    def __iter__(self):
+        return (self.mapped.normalized(i) for i in range(self.mapped.count))
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self.project(i) for i in range(self.mapped.count)]
+
+    def items(self):
+        return [(project.normalized, project) for project in self.values()]
+
+
+def encode_project(project):
+    return encode_block([(dist.filename, dist.version, dist.url, dist.size,
+                          dist.mtime, dist.sha256, dist.metadata_sha256)
+                         for dist in project.sorted_files()])
+
+
+def metadata_digests(projects):
+    """
+    {(path, mtime): sha256} of the metadata files of the files in
+    'projects'.
+
+    """
+    return dict(((dist.path, dist.mtime), dist.metadata_sha256)
+                for project in projects.values()
+                for dist in project.files.values() if dist.metadata_sha256)
+
+
+class PackageIndex(object):
+
+    def __init__(self, base_path, package_dirs, index_file=None,
+                 scan_threads=DEFAULT_SCAN_THREADS):
+        self.base_path = base_path
+        self.package_dirs = package_dirs
+        self.scan_threads = scan_threads
+        # Where the projects are shared with other processes, if they are.
+        # If not, they're in self.local.
+        self.index_file = index_file
+        self.local = {}
+        # The generation of index_file we have mapped, and when we last
+        # looked for a newer one.
+        self.mapped = None
+        self.checked = 0
+        # Hashing every file on every scan would be far too slow, so
+        # digests come from whoever recorded them at upload time: a
+        # callable taking an optional normalized project name and 'flush',
+        # and returning {path: sha256 hex digest}. With flush False, it's
+        # being called off the IOLoop, and only what's been written counts.
+        # core.dao.PyPIData sets this.
+        self.digest_source = None
+        # Called with the new projects dict after every scan().
+        self.scan_listeners = []
+        # {(path, mtime): sha256} of the files' metadata files.
+        self.metadata_digests = {}
+        # While scan_on() is walking PackageDirs, the changes made to
+        # self.local in the meantime, to be made to what it finds too.
+        # None when there's no scan under way.
+        self.journal = None
+
+    @property
+    def projects(self):
+        """
+        {normalized name: Project}. For a shared index, that's a
+        MappedProjects over the latest generation.
+
+        """
+        if self.index_file is None:
+            return self.local
+        return MappedProjects(self.current(), self.base_path)
+
+    def find(self, name):
+        """
+        Case-insensitive (well, PEP 503 normalized) lookup of a project.
+        Returns a Project or None.
+
+        """
+        return self.projects.get(normalize_name(name))
+
+    def sorted_projects(self):
+        """
+        Every Project, in order. A shared index gives them without their
+        files, which listings of projects have no use for.
+
+        """
+        if self.index_file is not None:
+            return MappedProjects(self.current(), self.base_path).listing()
+        return [self.local[p] for p in sorted(self.local)]
+
+    def current(self, force=False):
+        """
+        The IndexFile of the latest generation of index_file, looking for a
+        newer one if it's been GENERATION_CHECK_INTERVAL seconds since we
+        last did, or if 'force' is set. If there isn't one at all yet, we
+        scan to write the first.
+
+        """
+        now = time.time()
+        if (force or self.mapped is None or
+                now - self.checked >= GENERATION_CHECK_INTERVAL):
+            self.checked = now
+            if self.latest() is None:
+                self.scan()
+        return self.mapped
+
+    def latest(self):
+        """
+        Map whatever is at index_file now, if it isn't what we have mapped
+        already. Returns the IndexFile, or None if there's nothing there.
+
+        """
+        mapped = self.open_latest(self.mapped)
+        if mapped is not None:
+            self.mapped = mapped
+        return mapped
+
+    def open_latest(self, mapped):
+        """
+        latest(), without swapping it in: 'mapped' if it's still the
+        latest generation, otherwise a new IndexFile.
+
+        """
+        try:
+            st = os.stat(self.index_file)
+        except OSError as out:
+            if out.errno != errno.ENOENT:
+                raise
+            return None
+        if mapped is None or mapped.inode != (st.st_dev, st.st_ino):
+            mapped = IndexFile(self.index_file)
+        return mapped
+
+    def splice(self, changes):
+        """
+        Write the next generation of a shared index, with projects
+        replaced. 'changes' maps normalized names to functions taking the
+        project's Project in the latest generation, or None, and returning
+        its replacement, or None to remove it.
+
+        """
+        self.current()
+        with locked(self.index_file):
+            mapped = self.latest()
+            view = MappedProjects(mapped, self.base_path)
+            ranges = []
+            for normalized in sorted(changes):
+                i = mapped.find(normalized)
+                project = changes[normalized](
+                    view.project(i) if i is not None else None)
+                if project is None and i is None:
+                    continue
+                entries = []
+                if project is not None:
+                    entries.append((normalized, project.name,
+                                    encode_project(project)))
+                if i is not None:
+                    ranges.append((i, i + 1, entries))
+                    continue
+                # New projects going in at the same place go in together.
+                i = mapped.position(normalized)
+                if ranges and ranges[-1][:2] == (i, i):
+                    ranges[-1][2].extend(entries)
+                else:
+                    ranges.append((i, i, entries))
+            if ranges:
+                splice_index(self.index_file, mapped, ranges)
+                self.latest()
+
+    def publish(self, projects, base, scanned):
+        """
+        Write the freshly scanned 'projects' as the next generation of a
+        shared index. 'base' is the generation there was when the scan
+        started: projects that have changed since then keep the newer
+        generation's files, as an upload's file may not have been there
+        yet when the scan looked. Returns the new generation's IndexFile,
+        for the caller to swap in; this is safe to run off the IOLoop.
+
+        """
+        entries = dict((normalized, (project.name, encode_project(project)))
+                       for normalized, project in projects.items())
+        with locked(self.index_file):
+            latest = self.open_latest(self.mapped)
+            if latest is not None and latest is not base:
+                for normalized, name, block in latest.entries():
+                    i = base.find(normalized) if base is not None else None
+                    if i is None or base.block(i) != block:
+                        entries[normalized] = (name, block)
+            generation = latest.generation + 1 if latest is not None else 1
+            write_index(self.index_file, generation, scanned,
+                        [(normalized,) + entries[normalized]
+                         for normalized in sorted(entries)])
+            return self.open_latest(latest)
+
+    def refresh(self, interval):
+        """
+        The periodic rescan, every 'interval' seconds. One process's scan
+        of a shared index does for all of them, so then we only scan if no
+        process has for half of 'interval', and none is scanning now.
+
+        """
+        if self.index_file is None:
+            self.scan()
+            return
+        if not self.scan_due(interval):
+            return
+        with locked(self.index_file + '.scan', wait=False) as got_lock:
+            if got_lock and self.scan_due(interval):
+                self.scan()
+
+    @tornado.gen.coroutine
+    def refresh_on(self, executor, interval):
+        """
+        refresh(), for the periodic callback, with the scan done by
+        scan_on().
+
+        """
+        try:
+            if self.index_file is None:
+                yield self.scan_on(executor)
+            elif self.scan_due(interval):
+                with locked(self.index_file + '.scan',
+                            wait=False) as got_lock:
+                    if got_lock and self.scan_due(interval):
+                        yield self.scan_on(executor)
+        except (IOError, OSError) as out:
+            logging.error("Rescanning PackageDirs: %s", out)
+
+    def scan_due(self, interval):
+        return time.time() - self.current(True).scanned >= interval / 2.0
+
+    def url_for(self, path):
+        return '/' + os.path.relpath(path, self.base_path).replace(os.sep, '/')
+
+    def make_file(self, path, version=None, sha256=None, has_metadata=None,
+                  st=None):
+        filename = os.path.basename(path)
+        if st is None:
+            st = os.stat(path)
+        if version is None:
+            version = split_filename(filename)[1]
+        url = self.url_for(path)
+        if has_metadata is None:
+            has_metadata = os.path.isfile(path + METADATA_SUFFIX)
+        metadata_sha256 = None
+        if has_metadata:
+            metadata_sha256 = self.metadata_digest(path, st.st_mtime)
+        return DistFile(filename, version, path, url, st.st_size,
+                        st.st_mtime, sha256, metadata_sha256)
+
+    def metadata_digest(self, path, mtime):
+        key = (path, mtime)
+        digest = self.metadata_digests.get(key)
+        if digest is None:
+            try:
+                with open(path + METADATA_SUFFIX, 'rb') as f:
+                    digest = hashlib.sha256(f.read()).hexdigest()
+            except IOError as out:
+                logging.error("Can't read metadata file for %s: %s",
+                              path, out)
+                return None
+            self.metadata_digests[key] = digest
+        return digest
+
+    def add_file(self, project_name, path, version=None, projects=None,
+                 sha256=None, has_metadata=None, st=None):
+        """
+        Add (or replace) the file at 'path' under 'project_name'. If
+        'has_metadata' is None, we look for a metadata file beside it.
+
+        """
+        dist = self.make_file(path, version, sha256, has_metadata, st)
+        if projects is None:
+            self.add_dists([(project_name, dist)])
+        else:
+            self.put(projects, project_name, dist)
+        return dist
+
+    def add_files(self, files):
+        """
+        add_file() for each (project_name, path, version, sha256) in
+        'files', as one change to a shared index. Returns their DistFiles,
+        in the same order.
+
+        """
+        added = self.make_files(files)
+        self.add_dists(added)
+        return [dist for project_name, dist in added]
+
+    def make_files(self, files):
+        """
+        The half of add_files() that looks at the disk: [(project_name,
+        DistFile)], for add_dists().
+
+        """
+        return [(project_name, self.make_file(path, version, sha256))
+                for project_name, path, version, sha256 in files]
+
+    def add_dists(self, added):
+        """
+        The other half. A per-process index is swapped out by scans on the
+        IOLoop, so this has to be done there too; a shared index is
+        changed in its file, under a lock, from anywhere.
+
+        """
+        if self.index_file is None:
+            def change(local):
+                for project_name, dist in added:
+                    self.put(local, project_name, dist)
+            self.change_local(change)
+            return
+
+        by_project = {}
+        for project_name, dist in added:
+            by_project.setdefault(normalize_name(project_name),
+                                  (project_name, []))[1].append(dist)
+
+        def changer(project_name, dists):
+            def change(project):
+                if project is None:
+                    project = Project(project_name)
+                for dist in dists:
+                    project.files[dist.filename] = dist
+                return project
+            return change
+        self.splice(dict((normalized, changer(project_name, dists))
+                         for normalized, (project_name, dists)
+                         in by_project.items()))
+
+    def put(self, projects, project_name, dist):
+        """
+        Add 'dist' to 'projects'. A file that turns up in more than one
+        place (partway through a rebalance, say) is the newest of them.
+
+        """
+        normalized = normalize_name(project_name)
+        project = projects.get(normalized)
+        if project is None:
+            project = projects[normalized] = Project(project_name)
+        old = project.files.get(dist.filename)
+        if old is None or dist.mtime >= old.mtime:
+            project.files[dist.filename] = dist
+
+    def fill_digests(self, projects, normalized=None, flush=True):
+        """
+        Look up sha256 digests from digest_source for the files in
+        'projects'. If 'normalized' is given, 'projects' only holds that
+        project, so only its digests are fetched. A shared index has them
+        already. Off the IOLoop, 'flush' has to be False.
+
+        """
+        if self.digest_source is None or isinstance(projects,
+                                                    MappedProjects):
+            return
+        digests = self.digest_source(normalized, flush)
+        for project in projects.values():
+            for dist in project.files.values():
+                dist.sha256 = digests.get(dist.path, dist.sha256)
+
+    def remove_file(self, project_name, filename):
+        def change(project):
+            if project is not None:
+                project.files.pop(filename, None)
+                if project.files:
+                    return project
+            return None
+        normalized = normalize_name(project_name)
+        if self.index_file is not None:
+            self.splice({normalized: change})
+            return
+
+        def drop(local):
+            if change(local.get(normalized)) is None:
+                local.pop(normalized, None)
+        self.change_local(drop)
+
+    def change_local(self, change):
+        """
+        Make 'change', a function taking a projects dict, to self.local,
+        and if scan_on() is walking PackageDirs, to what it finds, once
+        it's done, too.
+
+        """
+        change(self.local)
+        if self.journal is not None:
+            self.journal.append(change)
+
+    def scan(self):
+        """
+        Walk every PackageDirs root and swap in a freshly built index. The
+        project directories are listed scan_threads at a time, which on
+        a cold cache or network filesystem is most of the time taken.
+
+        """
+        self.replace_all(self.read_all())
+
+    @tornado.gen.coroutine
+    def scan_on(self, executor):
+        """
+        scan(), with the walk, the digest lookup and any writing of a shared
+        index done on 'executor', a core.executor.IOExecutor, and the result
+        swapped in back on the IOLoop. Uploads in the meantime are carried
+        over into it. If there's a scan_on() under way
+        already, that one will do.
+
+        """
+        if self.journal is not None:
+            return
+        self.journal = []
+        try:
+            scanned = yield executor.submit(self.read_all)
+            self.replace_all(scanned)
+        finally:
+            self.journal = None
+
+    def read_all(self):
+        """
+        The first half of scan(): every project on disk, with its files'
+        digests, and for a shared index, the IndexFile of the generation
+        they've been published as. This is safe to run off the IOLoop
+        thread.
+
+        """
+        started = time.time()
+        base = None
+        if self.index_file is not None:
+            base = self.open_latest(self.mapped)
+            if base is not None and not self.metadata_digests:
+                # Start from the digests the last scan, wherever it was,
+                # worked out.
+                self.metadata_digests = metadata_digests(
+                    MappedProjects(base, self.base_path))
+
+        projects = {}
+        executor = ThreadPoolExecutor(self.scan_threads)
+        try:
+            for root in self.package_dirs:
+                self.scan_root(os.path.join(self.base_path, root), projects,
+                               executor=executor)
+        finally:
+            executor.shutdown()
+        self.fill_digests(projects, flush=False)
+        mapped = None
+        if self.index_file is not None:
+            mapped = self.publish(projects, base, started)
+        return projects, mapped
+
+    def replace_all(self, scanned):
+        """
+        The second half: swap the projects in, or for a shared index, the
+        generation they were published as.
+
+        """
+        projects, mapped = scanned
+        if self.index_file is None:
+            for change in self.journal or ():
+                change(projects)
+            self.local = projects
+        elif self.mapped is None or mapped.generation > self.mapped.generation:
+            # An upload may have moved us on to a later one already.
+            self.mapped = mapped
+        # Forget the metadata digests of files that have gone.
+        self.metadata_digests = metadata_digests(projects)
+        logging.debug("Package index: %d projects", len(projects))
+        for listener in self.scan_listeners:
+            listener(projects)
+
+    def rescan_project(self, name):
+        """
+        Re-read one project's files from disk and swap them in, for when
+        other processes may have added some since the last scan(). Returns
+        the Project, or None if it has no files.
+
+        """
+        return self.rescan_projects([name])[normalize_name(name)]
+
+    def rescan_projects(self, names):
+        """
+        rescan_project() for several projects at once, with one pass over
+        each PackageDirs root. Returns {normalized name: Project or None}.
+
+        """
+        return self.replace_projects(self.read_projects(names))
+
+    def read_projects(self, names):
+        """
+        The first half of rescan_projects(): {normalized name: Project or
+        None} for 'names', from the disk alone. This is safe to run off
+        the IOLoop thread.
+
+        """
+        wanted = set(normalize_name(name) for name in names)
+        projects = {}
+        for root in self.package_dirs:
+            self.scan_root(os.path.join(self.base_path, root), projects,
+                           only=wanted)
+        return dict((normalized, projects.get(normalized))
+                    for normalized in wanted)
+
+    def replace_projects(self, found):
+        """
+        The second half: fill in digests and swap the projects in.
+
+        """
+        for normalized, project in found.items():
+            if project is not None:
+                self.fill_digests({normalized: project}, normalized)
+
+        if self.index_file is not None:
+            self.splice(dict((normalized, lambda old, project=project: project)
+                             for normalized, project in found.items()))
+        else:
+            def change(local):
+                for normalized, project in found.items():
+                    if project is None:
+                        local.pop(normalized, None)
+                    else:
+                        local[normalized] = project
+            self.change_local(change)
+        return found
+
+    def scan_root(self, root, projects, only=None, executor=None):
+        """
+        Add everything under 'root' to 'projects', or if 'only' is given,
+        just the files of the projects with the normalized names in it.
+        Project directories are listed on 'executor's threads, if given.
+
+        """
+        try:
+            entries = list(scandir(root))
+        except OSError as out:
+            logging.error("Can't scan package dir %s: %s", root, out)
+            return
+
+        names = set(entry.name for entry in entries)
+        directories = []
+        fanouts = []
+        for entry in entries:
+            if entry.name.startswith('.') or entry.is_symlink():
+                continue
+            if entry.is_dir():
+                if is_fanout(entry.name):
+                    fanouts.append(entry)
+                elif only is None or normalize_name(entry.name) in only:
+                    directories.append(entry)
+            elif is_distribution(entry.name):
+                project_name = split_filename(entry.name)[0]
+                if project_name and (only is None or
+                                     normalize_name(project_name) in only):
+                    self.add_file(project_name, entry.path,
+                                  projects=projects,
+                                  has_metadata=(entry.name + METADATA_SUFFIX
+                                                in names), st=entry.stat())
+
+        if only is not None:
+            # Only the fan-out directories the projects would be in.
+            wanted = set(fanout_name(normalized) for normalized in only)
+            fanouts = [entry for entry in fanouts if entry.name in wanted]
+        for fanout in fanouts:
+            try:
+                inner = list(scandir(fanout.path))
+            except OSError as out:
+                logging.error("Can't scan %s: %s", fanout.path, out)
+                continue
+            directories.extend(
+                entry for entry in inner
+                if not entry.name.startswith('.') and
+                entry.is_dir(follow_symlinks=False) and
+                (only is None or normalize_name(entry.name) in only))
+
+        if executor is None:
+            listed = map(self.scan_project_dir, directories)
+        else:
+            listed = executor.map(self.scan_project_dir, directories)
+        for entry, dists in zip(directories, listed):
+            for dist in dists:
+                self.put(projects, entry.name, dist)
+
+    def scan_project_dir(self, entry):
+        """
+        The DistFiles in the project directory scandir() gave as 'entry',
+        including any in fan-out directories in it.
+
+        """
+        try:
+            files = list(scandir(entry.path))
+            for fanout in [f for f in files if is_fanout(f.name) and
+                           f.is_dir(follow_symlinks=False)]:
+                files.extend(scandir(fanout.path))
+        except OSError as out:
+            logging.error("Can't scan project dir %s: %s", entry.path, out)
+            return []
+        paths = set(f.path for f in files)
+        return [self.make_file(f.path, has_metadata=(f.path + METADATA_SUFFIX
+                                                     in paths),
+                               st=f.stat())
+                for f in files
+                if is_distribution(f.name) and f.is_file(follow_symlinks=False)]
+
+
+def package_index(application):
+    """
+    The application's PackageIndex, built on first use, with a periodic
+    rescan scheduled on the current IOLoop. With settings['index_file'],
+    it's the shared index, which is only scanned here if there isn't one
+    yet.
+
+    """
+    index = getattr(application, 'package_index', None)
+    if index is None:
+        settings = application.settings
+        index_file = settings.get('index_file', DEFAULT_INDEX_FILE)
+        if index_file:
+            index_file = os.path.join(settings['base_path'], index_file)
+        index = PackageIndex(settings['base_path'], settings['PackageDirs'],
+                             index_file or None,
+                             settings.get('scan_threads',
+                                          DEFAULT_SCAN_THREADS))
+        if index.index_file is None:
+            index.scan()
+        application.package_index = index
+
+        interval = settings.get('index_refresh_interval',
+                                DEFAULT_REFRESH_INTERVAL)
+        if interval:
+            executor = io_executor(application)
+            tornado.ioloop.PeriodicCallback(
+                lambda: index.refresh_on(executor, interval),
+                interval * 1000).start()
+    return index
@@ -0,0 +1,150 @@
+"""
+The JSON API: /pypi/<project>/json and /pypi/<project>/<version>/json,
+laid out the way PyPI's are, so tooling written against PyPI works here.
+
+Documents are built from PyPIData and kept, serialized, in an LRU cache
+keyed on project and version and validated against the project's serial.
+Any change to a project bumps its serial, in whichever process made it, so
+a cached document is never served stale, and a dashboard polling an
+unchanged project costs one serial lookup.
+
+"""
+import datetime
+import json
+
+from MinistryOfPackages.core.cache import LRUCache
+from MinistryOfPackages.core.dao import pypi_data
+from MinistryOfPackages.core.index import normalize_name
+
+DEFAULT_JSON_CACHE_SIZE = 1024
+
+# Release metadata that 'info' has in a different form.
+SKIPPED_FIELDS = ('project_urls',)
+
+
+def iso_time(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime(
+        '%Y-%m-%dT%H:%M:%S')
+
+
+def file_json(record, requires_python):
+    digests = {}
+    if record.get('md5_digest'):
+        digests['md5'] = record['md5_digest']
+    if record.get('sha256_digest'):
+        digests['sha256'] = record['sha256_digest']
+    return {'filename': record['filename'],
+            'packagetype': record.get('filetype'),
+            'url': record.get('url'),
+            'size': record.get('size'),
+            'digests': digests,
+            'md5_digest': record.get('md5_digest'),
+            'upload_time': iso_time(record['upload_time']),
+            'upload_time_iso_8601': iso_time(record['upload_time']) + 'Z',
+            'requires_python': requires_python,
+            'yanked': False}
+
+
+def project_urls(values):
+    """
+    Project-URL fields are 'Label, url' strings; PyPI gives them as a dict.
+
+    """
+    urls = {}
+    for value in values or []:
+        label, _, url = value.partition(',')
+        if url.strip():
+            urls[label.strip()] = url.strip()
+    return urls
+
+
+def build_document(data, name, serial, version=None):
+    """
+    The document for project 'name' (as stored), or for one version of
+    it, along with the most recent upload time of the files in it.
+    Returns (None, None) if there's no such version.
+
+    """
+    releases = data.get_pkg_meta(name)
+    latest = data.get_latest_version(name)
+    target = version or latest
+    if target not in releases:
+        return None, None
+
+    files = {}
+    for record in data.get_pkg_files(name):
+        files.setdefault(record['version'], []).append(record)
+
+    def urls(v):
+        requires_python = releases[v].get('requires_python')
+        return [file_json(r, requires_python) for r in files.get(v, [])]
+
+    metadata = releases[target]
+    normalized = normalize_name(name)
+    info = dict((k, v) for k, v in metadata.items()
+                if k not in SKIPPED_FIELDS)
+    info.update(name=name, version=target,
+                project_urls=project_urls(metadata.get('project_urls')),
+                package_url='/pypi/%s/' % normalized,
+                project_url='/pypi/%s/' % normalized,
+                release_url='/pypi/%s/%s/' % (normalized, target),
+                download_url=(metadata.get('download_url') or
+                              data.get_pkg_download_url(name, target)),
+                yanked=False)
+
+    document = {'info': info, 'last_serial': serial, 'urls': urls(target),
+                'vulnerabilities': []}
+    if version is None:
+        document['releases'] = dict((v, urls(v)) for v in releases)
+        shown = [r for v in files for r in files[v]]
+    else:
+        shown = files.get(target, [])
+    mtime = max([r['upload_time'] for r in shown] or [0])
+    return document, mtime
+
+
+class JSONAPI(object):
+
+    def __init__(self, data, cache_size=DEFAULT_JSON_CACHE_SIZE):
+        self.data = data
+        self.cache = LRUCache(cache_size)
+
+    def get(self, project, version=None):
+        """
+        (body, etag, mtime) for a project's document, or for one version's,
+        or None if there's no such project or version. mtime is the latest
+        upload time of the files in it, for Last-Modified.
+
+        """
+        normalized = normalize_name(project)
+        found = self.data.read().get_project(normalized)
+        if found is None:
+            return None
+        name, serial = found
+
+        key = (normalized, version)
+        entry = self.cache.get(key, serial)
+        if entry is None:
+            document, mtime = build_document(self.data, name, serial,
+                                             version)
+            if document is None:
+                return None
+            entry = (json.dumps(document, sort_keys=True),
+                     '"%x"' % serial, mtime)
+            self.cache.put(key, serial, entry)
+        return entry
+
+
+def json_api(application):
+    """
+    The application's JSONAPI, with settings['json_cache_size'] documents
+    cached.
+
+    """
+    api = getattr(application, 'json_api', None)
+    if api is None:
+        api = JSONAPI(pypi_data(application),
+                      application.settings.get('json_cache_size',
+                                               DEFAULT_JSON_CACHE_SIZE))
+        application.json_api = api
+    return api
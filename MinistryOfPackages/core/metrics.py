@@ -0,0 +1,358 @@
+"""
+Request metrics, collected by every worker and readable by any of them.
+
+Like the scoreboard, the numbers live in a RawArray the parent creates
+before forking, with one region per scoreboard slot so every region has a
+single writer and nothing needs locking. Recording a request is a handful
+of array increments. Reading adds up every slot's region, which is cheap
+enough to do per scrape; regions are never zeroed when a slot is reused,
+so the sums only ever go up, the way Prometheus expects counters to.
+
+Handlers are identified by class name. The names are fixed when the
+parent starts; handler classes added to the config by a reload are
+counted under 'other'.
+
+After the handlers, each region has the worker's IOExecutor numbers (see
+core.executor). That's the one place with more than one writer, the pool's
+threads, so the executor records under a lock.
+
+Then come core.admission's numbers for each of its lanes, and last, the
+hits, misses and evictions of the worker's in-process caches (core.cache).
+Every worker has caches of its own, so those are reported per slot rather
+than added up.
+
+"""
+import bisect
+import httplib
+import multiprocessing
+
+# Upper bounds, in seconds, of the request latency histogram buckets.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+
+STATUS_CODES = sorted(httplib.responses)
+
+OTHER = 'other'
+
+# Per-handler counters, after the status codes and latency buckets.
+SUMS = ('latency_sum', 'bytes_sent', 'bytes_received', 'body_seconds',
+        'inflight')
+
+# Upper bounds, in seconds, of the histogram of how long filesystem work
+# waits for a pool thread. Mostly it shouldn't wait at all.
+IO_WAIT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# IOExecutor counters, after the wait buckets. How many tasks are queued
+# and running are worked out from the first three.
+IO_SUMS = ('submitted', 'started', 'finished', 'wait_sum', 'run_sum')
+
+# core.admission's lanes, and the numbers for each, after the IOExecutor's.
+ADMISSION_LANES = ('downloads', 'uploads')
+ADMISSION_SUMS = ('active', 'active_bytes', 'waiting', 'admitted', 'full',
+                  'timed_out', 'wait_sum')
+
+# core.cache LRUCaches, and the counters for each, after admission's.
+CACHES = ('listing',)
+CACHE_SUMS = ('hits', 'misses', 'evictions')
+
+
+class Layout(object):
+    """
+    Where each number lives in a slot's region.
+
+    """
+
+    def __init__(self, handlers):
+        self.handlers = list(handlers) + [OTHER]
+        self.handler_index = dict((h, i) for i, h in
+                                  enumerate(self.handlers))
+        self.code_index = dict((c, i) for i, c in enumerate(STATUS_CODES))
+
+        # Codes, plus one for anything non-standard.
+        self.codes = 0
+        self.buckets = self.codes + len(STATUS_CODES) + 1
+        # Buckets, plus one for +Inf.
+        self.sums = self.buckets + len(LATENCY_BUCKETS) + 1
+        self.handler_size = self.sums + len(SUMS)
+
+        self.io_buckets = self.handler_size * len(self.handlers)
+        self.io_sums = self.io_buckets + len(IO_WAIT_BUCKETS) + 1
+        self.admission = self.io_sums + len(IO_SUMS)
+        self.caches = (self.admission +
+                       len(ADMISSION_LANES) * len(ADMISSION_SUMS))
+        self.slot_size = self.caches + len(CACHES) * len(CACHE_SUMS)
+
+    def admission_offset(self, lane, field):
+        return (self.admission +
+                ADMISSION_LANES.index(lane) * len(ADMISSION_SUMS) +
+                ADMISSION_SUMS.index(field))
+
+    def cache_offset(self, cache, field):
+        return (self.caches + CACHES.index(cache) * len(CACHE_SUMS) +
+                CACHE_SUMS.index(field))
+
+    def handler(self, name):
+        return self.handler_index.get(name, len(self.handlers) - 1)
+
+
+class WorkerMetrics(object):
+    """
+    What a worker records its requests with.
+
+    """
+
+    def __init__(self, array, layout, offset):
+        self.array = array
+        self.layout = layout
+        self.offset = offset
+        self.sums = dict((name, layout.sums + i)
+                         for i, name in enumerate(SUMS))
+        self.io_sums = dict((name, offset + layout.io_sums + i)
+                            for i, name in enumerate(IO_SUMS))
+
+    def handler_offset(self, handler_name):
+        return (self.offset +
+                self.layout.handler(handler_name) * self.layout.handler_size)
+
+    def handler_started(self, handler_name):
+        self.array[self.handler_offset(handler_name) +
+                   self.sums['inflight']] += 1
+
+    def handler_done(self, handler_name):
+        self.array[self.handler_offset(handler_name) +
+                   self.sums['inflight']] -= 1
+
+    def record(self, handler_name, status, seconds, bytes_sent,
+               bytes_received, body_seconds):
+        base = self.handler_offset(handler_name)
+        layout = self.layout
+        array = self.array
+        array[base + layout.codes +
+              layout.code_index.get(status, len(STATUS_CODES))] += 1
+        array[base + layout.buckets +
+              bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        array[base + self.sums['latency_sum']] += seconds
+        array[base + self.sums['bytes_sent']] += bytes_sent
+        array[base + self.sums['bytes_received']] += bytes_received
+        array[base + self.sums['body_seconds']] += body_seconds
+
+    def io_submitted(self):
+        self.array[self.io_sums['submitted']] += 1
+
+    def io_started(self, wait):
+        array = self.array
+        array[self.offset + self.layout.io_buckets +
+              bisect.bisect_left(IO_WAIT_BUCKETS, wait)] += 1
+        array[self.io_sums['started']] += 1
+        array[self.io_sums['wait_sum']] += wait
+
+    def io_finished(self, seconds):
+        self.array[self.io_sums['finished']] += 1
+        self.array[self.io_sums['run_sum']] += seconds
+
+    def admission(self, lane, field, delta):
+        self.array[self.offset +
+                   self.layout.admission_offset(lane, field)] += delta
+
+    def cache(self, cache, field):
+        self.array[self.offset + self.layout.cache_offset(cache, field)] += 1
+
+    def reset_gauges(self):
+        """
+        Clear the in-flight counts and admission queues, and write off any
+        filesystem work that was queued or running, for when the worker
+        that owned this slot has died without getting to.
+
+        """
+        for h in range(len(self.layout.handlers)):
+            self.array[self.offset + h * self.layout.handler_size +
+                       self.sums['inflight']] = 0
+        for lane in ADMISSION_LANES:
+            for field in ('active', 'active_bytes', 'waiting'):
+                self.array[self.offset +
+                           self.layout.admission_offset(lane, field)] = 0
+        submitted = self.array[self.io_sums['submitted']]
+        self.array[self.io_sums['started']] = submitted
+        self.array[self.io_sums['finished']] = submitted
+
+
+class Metrics(object):
+
+    def __init__(self, slots, handlers):
+        self.slots = slots
+        self.layout = Layout(handlers)
+        self.array = multiprocessing.RawArray(
+            'd', slots * self.layout.slot_size)
+
+    def worker(self, slot):
+        return WorkerMetrics(self.array, self.layout,
+                             slot * self.layout.slot_size)
+
+    def totals(self):
+        """
+        Every slot's region added together: one region's worth of sums.
+
+        """
+        size = self.layout.slot_size
+        data = self.array[:]
+        totals = [0.0] * size
+        for start in range(0, len(data), size):
+            region = data[start:start + size]
+            if any(region):
+                totals = map(sum, zip(totals, region))
+        return totals
+
+    def render(self):
+        """
+        Everything, in the Prometheus text exposition format.
+
+        """
+        layout = self.layout
+        totals = self.totals()
+        per_handler = [(name, totals[i * layout.handler_size:
+                                     (i + 1) * layout.handler_size])
+                       for i, name in enumerate(layout.handlers)]
+        lines = []
+
+        def metric(name, kind, help):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+        metric('ministry_requests_total', 'counter',
+               'Requests completed, by handler and status code.')
+        for name, values in per_handler:
+            for i, code in enumerate(STATUS_CODES + [OTHER]):
+                if values[layout.codes + i]:
+                    lines.append('ministry_requests_total{handler="%s",'
+                                 'code="%s"} %d' %
+                                 (name, code, values[layout.codes + i]))
+
+        metric('ministry_request_duration_seconds', 'histogram',
+               'Time from receiving request headers to finishing the '
+               'response.')
+        for name, values in per_handler:
+            counts = values[layout.buckets:layout.sums]
+            if not any(counts):
+                continue
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), counts):
+                cumulative += count
+                lines.append('ministry_request_duration_seconds_bucket'
+                             '{handler="%s",le="%s"} %d' %
+                             (name, bound, cumulative))
+            lines.append('ministry_request_duration_seconds_sum'
+                         '{handler="%s"} %.6f' %
+                         (name, values[layout.sums +
+                                       SUMS.index('latency_sum')]))
+            lines.append('ministry_request_duration_seconds_count'
+                         '{handler="%s"} %d' % (name, cumulative))
+
+        for field, metric_name, kind, help in (
+                ('bytes_sent', 'ministry_response_bytes_total', 'counter',
+                 'Response body bytes sent.'),
+                ('bytes_received', 'ministry_request_bytes_total', 'counter',
+                 'Request body bytes received.'),
+                ('body_seconds', 'ministry_request_body_seconds_total',
+                 'counter', 'Time spent receiving request bodies. Upload '
+                 'throughput is the rate of ministry_request_bytes_total '
+                 'over the rate of this.'),
+                ('inflight', 'ministry_requests_in_flight', 'gauge',
+                 'Requests being handled right now.')):
+            metric(metric_name, kind, help)
+            i = layout.sums + SUMS.index(field)
+            for name, values in per_handler:
+                lines.append('%s{handler="%s"} %s' %
+                             (metric_name, name, format_value(values[i])))
+
+        io = dict((name, totals[layout.io_sums + i])
+                  for i, name in enumerate(IO_SUMS))
+        metric('ministry_io_queue_depth', 'gauge',
+               'Filesystem tasks waiting for a pool thread.')
+        lines.append('ministry_io_queue_depth %s' %
+                     format_value(io['submitted'] - io['started']))
+        metric('ministry_io_tasks_running', 'gauge',
+               'Filesystem tasks running on a pool thread.')
+        lines.append('ministry_io_tasks_running %s' %
+                     format_value(io['started'] - io['finished']))
+        metric('ministry_io_tasks_total', 'counter',
+               'Filesystem tasks finished.')
+        lines.append('ministry_io_tasks_total %s' %
+                     format_value(io['finished']))
+        metric('ministry_io_task_seconds_total', 'counter',
+               'Time pool threads spent running filesystem tasks.')
+        lines.append('ministry_io_task_seconds_total %.6f' % io['run_sum'])
+
+        metric('ministry_io_wait_seconds', 'histogram',
+               'Time filesystem tasks waited for a pool thread.')
+        cumulative = 0
+        for bound, count in zip(IO_WAIT_BUCKETS + ('+Inf',),
+                                totals[layout.io_buckets:layout.io_sums]):
+            cumulative += count
+            lines.append('ministry_io_wait_seconds_bucket{le="%s"} %d' %
+                         (bound, cumulative))
+        lines.append('ministry_io_wait_seconds_sum %.6f' % io['wait_sum'])
+        lines.append('ministry_io_wait_seconds_count %d' % cumulative)
+
+        def lane_value(lane, field):
+            return totals[layout.admission_offset(lane, field)]
+
+        for field, metric_name, kind, help in (
+                ('active', 'ministry_admission_active', 'gauge',
+                 'Uploads or downloads admitted and in progress.'),
+                ('active_bytes', 'ministry_admission_active_bytes', 'gauge',
+                 'Bytes being streamed by admitted uploads or downloads.'),
+                ('waiting', 'ministry_admission_queue_depth', 'gauge',
+                 'Uploads or downloads waiting to be admitted.'),
+                ('admitted', 'ministry_admission_admitted_total', 'counter',
+                 'Uploads or downloads admitted.'),
+                ('wait_sum', 'ministry_admission_wait_seconds_total',
+                 'counter', 'Time spent waiting to be admitted.')):
+            metric(metric_name, kind, help)
+            for lane in ADMISSION_LANES:
+                lines.append('%s{lane="%s"} %s' %
+                             (metric_name, lane,
+                              format_value(lane_value(lane, field))))
+        metric('ministry_admission_rejected_total', 'counter',
+               'Uploads or downloads turned away with a 503, because the '
+               'queue was full or they waited too long.')
+        for lane in ADMISSION_LANES:
+            for reason in ('full', 'timed_out'):
+                lines.append('ministry_admission_rejected_total{lane="%s",'
+                             'reason="%s"} %d' %
+                             (lane, reason, lane_value(lane, reason)))
+
+        self.render_caches(metric, lines)
+        return '\n'.join(lines) + '\n'
+
+    def render_caches(self, metric, lines):
+        """
+        The cache counters, for each slot that's used a cache.
+
+        """
+        layout = self.layout
+        size = layout.slot_size
+        data = self.array[:]
+        regions = [(slot, data[slot * size:(slot + 1) * size])
+                   for slot in range(self.slots)]
+        regions = [(slot, region) for slot, region in regions
+                   if any(region[layout.caches:])]
+        for field, help in (
+                ('hits', 'Lookups answered from a worker\'s cache.'),
+                ('misses', 'Lookups a worker\'s cache had no current '
+                 'entry for.'),
+                ('evictions', 'Entries thrown out of a worker\'s full '
+                 'cache.')):
+            metric_name = 'ministry_cache_%s_total' % field
+            metric(metric_name, 'counter', help)
+            for slot, region in regions:
+                for cache in CACHES:
+                    lines.append('%s{cache="%s",slot="%d"} %d' %
+                                 (metric_name, cache, slot,
+                                  region[layout.cache_offset(cache, field)]))
+
+
+def format_value(value):
+    if value == int(value):
+        return '%d' % value
+    return '%.6f' % value
@@ -0,0 +1,519 @@
+"""
+Copying projects from another simple index into PackageDirs, for
+bin/ministry_mirror.py.
+
+Upstream can be PyPI, another MinistryOfPackages, or anything else that
+serves PEP 503 pages; a local one does fine for trying things out. Each
+project's page is fetched, and each file on it we don't have already is
+downloaded and put where core.storage says it goes, with its record in
+the metadata store, as if it had been uploaded.
+
+A file we have already is left alone if it has the same digest as the
+one in upstream's link (the #sha256=... fragment, or whatever algorithm
+upstream uses), which means it's the same size too. For links without a
+digest, a HEAD request for the size is all there is to go on.
+
+Everything goes through one AsyncHTTPClient, and at most max_clients
+requests are in flight at once, however many projects and files there
+are.
+
+Files are downloaded to <tmp_dir>/<project>/<filename>.part and checked
+against the link's digest before they're put in place. A download that's
+cut off, by a dropped connection or by the mirror being stopped, carries
+on where it left off the next time with a Range request. If-Range makes
+upstream send the whole file again if it's changed in the meantime.
+
+The checkpoint file records each project page's ETag and Last-Modified
+as of the last time everything on it was synced. Pages are fetched
+conditionally, and a project whose page upstream says hasn't changed (a
+304) is skipped, files and all, so each run after the first only fetches
+what's new. The checkpoint is saved every CHECKPOINT_INTERVAL seconds as
+projects finish, so an interrupted run doesn't start over either.
+
+"""
+import collections
+import hashlib
+import HTMLParser
+import json
+import logging
+import os
+import time
+import urlparse
+
+import tornado.gen
+import tornado.httpclient
+import tornado.httputil
+import tornado.locks
+
+from MinistryOfPackages.core.blobs import (FILE_MODE, makedirs_for,
+                                           move_atomic, temp_beside)
+from MinistryOfPackages.core.distmeta import (READ_SIZE, extract, record_file,
+                                              write_metadata_file)
+from MinistryOfPackages.core.executor import IOExecutor
+from MinistryOfPackages.core.index import (is_distribution, is_safe_name,
+                                           normalize_name)
+from MinistryOfPackages.core.proxy import UpstreamError, parse_links, pycurl
+
+DEFAULT_MAX_CLIENTS = 8
+DEFAULT_CHECKPOINT = 'var/mirror/checkpoint.json'
+DEFAULT_TMP_DIR = 'var/mirror/partial'
+
+# Seconds a whole file has to arrive in, and to get connected.
+REQUEST_TIMEOUT = 3600
+CONNECT_TIMEOUT = 30
+
+# Tries per file, each carrying on from the last.
+MAX_ATTEMPTS = 3
+
+# Seconds between checkpoint saves.
+CHECKPOINT_INTERVAL = 30
+
+PART_SUFFIX = '.part'
+# Beside a .part file, the ETag or Last-Modified of what's in it.
+VALIDATOR_SUFFIX = '.validator'
+
+
+class ProjectParser(HTMLParser.HTMLParser):
+    """
+    The projects linked from a simple index's root page, as
+    {normalized: name}.
+
+    """
+
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.projects = {}
+        self.href = None
+        self.text = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            self.href = dict(attrs).get('href')
+            self.text = []
+
+    def handle_data(self, data):
+        if self.href is not None:
+            self.text.append(data)
+
+    def handle_endtag(self, tag):
+        if tag != 'a' or self.href is None:
+            return
+        name = (''.join(self.text).strip() or
+                self.href.rstrip('/').rsplit('/', 1)[-1])
+        # It ends up as a directory name.
+        if is_safe_name(name):
+            self.projects[normalize_name(name)] = name
+        elif name:
+            logging.warning("Ignoring project %r", name)
+        self.href = None
+
+
+def parse_projects(html):
+    parser = ProjectParser()
+    parser.feed(html)
+    parser.close()
+    return parser.projects
+
+
+def link_digest(link):
+    """
+    (algorithm, hex digest) from a link's #<algorithm>=<digest> fragment,
+    or None if it hasn't got one we can check.
+
+    """
+    algorithm, _, value = link.fragment.partition('=')
+    if value and algorithm in hashlib.algorithms:
+        return algorithm, value.lower()
+    return None
+
+
+def file_digests(path, algorithms):
+    """
+    {algorithm: hex digest} of the file at 'path'.
+
+    """
+    digests = dict((algorithm, hashlib.new(algorithm))
+                   for algorithm in algorithms)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), ''):
+            for digest in digests.values():
+                digest.update(block)
+    return dict((algorithm, digest.hexdigest())
+                for algorithm, digest in digests.items())
+
+
+def has_digest(dist, digest):
+    """
+    Whether 'dist', a core.index.DistFile, has 'digest' from link_digest().
+
+    """
+    algorithm, value = digest
+    if algorithm == 'sha256' and dist.sha256:
+        return dist.sha256 == value
+    try:
+        return file_digests(dist.path, [algorithm])[algorithm] == value
+    except (IOError, OSError):
+        return False
+
+
+def read_validator(part):
+    try:
+        with open(part + VALIDATOR_SUFFIX) as f:
+            return f.read().strip() or None
+    except IOError:
+        return None
+
+
+def discard(part):
+    for path in (part, part + VALIDATOR_SUFFIX):
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+class Download(object):
+    """
+    One file coming in to the .part file 'part', after the 'offset' bytes
+    already in it if upstream takes up the Range request, or from scratch
+    if it doesn't.
+
+    """
+
+    def __init__(self, part, offset):
+        self.part = part
+        self.offset = offset
+        self.code = None
+        self.headers = tornado.httputil.HTTPHeaders()
+        self.received = 0
+        self.file = None
+
+    def on_header(self, line):
+        if line.startswith('HTTP/'):
+            start_line = tornado.httputil.parse_response_start_line(line)
+            self.code = start_line.code
+            self.headers = tornado.httputil.HTTPHeaders()
+        elif line.strip():
+            self.headers.parse_line(line)
+
+    def resumed(self):
+        return (self.code == 206 and
+                self.headers.get('Content-Range', '').startswith(
+                    'bytes %d-' % self.offset))
+
+    def on_chunk(self, chunk):
+        if self.file is None:
+            if self.resumed():
+                self.file = open(self.part, 'ab')
+            elif self.code == 200:
+                self.offset = 0
+                makedirs_for(self.part)
+                self.file = open(self.part, 'wb')
+                # Only a strong ETag will do for If-Range.
+                etag = self.headers.get('ETag', '')
+                validator = (etag if etag.startswith('"') else
+                             self.headers.get('Last-Modified'))
+                with open(self.part + VALIDATOR_SUFFIX, 'w') as f:
+                    f.write(validator or '')
+            else:
+                return
+        self.file.write(chunk)
+        self.received += len(chunk)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class Mirror(object):
+
+    def __init__(self, upstream, storage, index, data, tmp_dir,
+                 checkpoint_path, max_clients=DEFAULT_MAX_CLIENTS,
+                 blobs=None):
+        if not upstream.endswith('/'):
+            upstream += '/'
+        self.upstream = upstream
+        # A core.storage.ArtifactStorage, for where files go.
+        self.storage = storage
+        # A scanned core.index.PackageIndex, for what we have already.
+        self.index = index
+        self.data = data
+        self.tmp_dir = tmp_dir
+        self.checkpoint_path = checkpoint_path
+        # A core.blobs.BlobStore, or None.
+        self.blobs = blobs
+        if pycurl is not None:
+            tornado.httpclient.AsyncHTTPClient.configure(
+                'tornado.curl_httpclient.CurlAsyncHTTPClient',
+                max_clients=max_clients)
+        else:
+            # Streamed downloads still count against max_body_size.
+            tornado.httpclient.AsyncHTTPClient.configure(
+                None, max_clients=max_clients, max_body_size=2 ** 62)
+        self.client = tornado.httpclient.AsyncHTTPClient()
+        self.max_clients = max_clients
+        # Requests left waiting in the client's own queue would time out
+        # there, so they wait here instead.
+        self.slots = tornado.locks.Semaphore(max_clients)
+        # Hashing, moving and reading files.
+        self.executor = IOExecutor(max_clients)
+        self.checkpoint = self.load_checkpoint()
+        self.saved = time.time()
+        self.counts = collections.Counter()
+
+    def load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as f:
+                checkpoint = json.load(f)
+        except IOError:
+            checkpoint = None
+        except ValueError as out:
+            logging.warning("Ignoring bad checkpoint %s: %s",
+                            self.checkpoint_path, out)
+            checkpoint = None
+        if checkpoint is None or checkpoint.get('upstream') != self.upstream:
+            checkpoint = {'upstream': self.upstream, 'projects': {}}
+        return checkpoint
+
+    def save_checkpoint(self):
+        makedirs_for(self.checkpoint_path)
+        temp = temp_beside(self.checkpoint_path)
+        try:
+            with open(temp, 'w') as f:
+                json.dump(self.checkpoint, f, indent=1, sort_keys=True)
+            os.chmod(temp, FILE_MODE)
+            os.rename(temp, self.checkpoint_path)
+        except Exception:
+            os.unlink(temp)
+            raise
+        self.saved = time.time()
+
+    @tornado.gen.coroutine
+    def fetch(self, request, **kwargs):
+        with (yield self.slots.acquire()):
+            response = yield self.client.fetch(request, raise_error=False,
+                                               **kwargs)
+        raise tornado.gen.Return(response)
+
+    @tornado.gen.coroutine
+    def list_projects(self):
+        """
+        {normalized: name} for every project upstream has.
+
+        """
+        response = yield self.fetch(self.upstream,
+                                    request_timeout=REQUEST_TIMEOUT)
+        if response.code != 200:
+            raise UpstreamError(response.code, 'Listing projects at %s: %s'
+                                % (self.upstream, response.code))
+        raise tornado.gen.Return(parse_projects(response.body))
+
+    @tornado.gen.coroutine
+    def run(self, projects=None, full=False):
+        """
+        Sync 'projects', a list of names, or everything upstream has. With
+        'full', projects are looked at whether the checkpoint says they've
+        changed or not.
+
+        """
+        if projects:
+            names = dict((normalize_name(name), name) for name in projects
+                         if is_safe_name(name))
+            for name in set(projects) - set(names.values()):
+                logging.warning("Ignoring project %r", name)
+        else:
+            names = yield self.list_projects()
+        logging.info('%d projects to sync from %s', len(names),
+                     self.upstream)
+        todo = sorted(names.items(), reverse=True)
+
+        @tornado.gen.coroutine
+        def worker():
+            while todo:
+                normalized, name = todo.pop()
+                try:
+                    yield self.sync_project(name, full)
+                except Exception as out:
+                    self.counts['failed_projects'] += 1
+                    logging.exception("Syncing %s: %s", name, out)
+
+        try:
+            # More than enough to keep every slot busy, since a project's
+            # files are fetched side by side.
+            yield [worker() for i in range(self.max_clients)]
+        finally:
+            self.data.backend.flush()
+            self.save_checkpoint()
+            self.executor.shutdown()
+        raise tornado.gen.Return(self.counts)
+
+    @tornado.gen.coroutine
+    def sync_project(self, name, full=False):
+        normalized = normalize_name(name)
+        projects = self.checkpoint['projects']
+        saved = projects.get(normalized)
+        headers = {}
+        if saved and not full:
+            if saved.get('etag'):
+                headers['If-None-Match'] = saved['etag']
+            if saved.get('last_modified'):
+                headers['If-Modified-Since'] = saved['last_modified']
+        response = yield self.fetch(
+            urlparse.urljoin(self.upstream, normalized + '/'),
+            headers=headers, request_timeout=REQUEST_TIMEOUT)
+        if response.code == 304:
+            self.counts['unchanged_projects'] += 1
+            return
+        if response.code != 200:
+            self.counts['failed_projects'] += 1
+            logging.error("Fetching the page for %s: %s", name,
+                          response.code)
+            return
+
+        # Keep the spelling of a project we have already.
+        local = self.index.find(normalized)
+        if local is not None:
+            name = local.name
+        # parse_links has dropped any filename that isn't one path
+        # component; this is belt and braces, since it's joined onto both
+        # tmp_dir and PackageDirs.
+        links = [link for link in parse_links(response.body,
+                                              response.effective_url)
+                 if is_safe_name(link.filename) and
+                 is_distribution(link.filename)]
+        results = yield [self.sync_file(name, local, link) for link in links]
+        self.counts['projects'] += 1
+        if all(results):
+            projects[normalized] = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'synced': time.time()}
+        else:
+            # Look at it again next time, whatever upstream says.
+            projects.pop(normalized, None)
+        if time.time() - self.saved >= CHECKPOINT_INTERVAL:
+            self.save_checkpoint()
+
+    @tornado.gen.coroutine
+    def sync_file(self, name, local, link):
+        """
+        Make sure we have the file 'link' points to, under project 'name'
+        ('local' is what we have of it, if anything). Returns whether we
+        do.
+
+        """
+        digest = link_digest(link)
+        have = local and local.files.get(link.filename)
+        if have is not None:
+            if digest is not None:
+                same = yield self.executor.submit(has_digest, have, digest)
+            else:
+                size = yield self.upstream_size(link)
+                same = size == have.size
+            if same:
+                self.counts['skipped_files'] += 1
+                raise tornado.gen.Return(True)
+
+        part = os.path.join(self.tmp_dir, normalize_name(name),
+                            link.filename + PART_SUFFIX)
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                done = yield self.download(link, part)
+                if not done:
+                    continue
+                digests = yield self.executor.submit(
+                    file_digests, part,
+                    set(['md5', 'sha256', digest[0] if digest else 'md5']))
+                if digest is not None and digests[digest[0]] != digest[1]:
+                    logging.warning("%s doesn't match its %s digest, "
+                                    "fetching it again", link.url, digest[0])
+                    yield self.executor.submit(discard, part)
+                    continue
+                yield self.place(name, have, link, part, digests)
+                self.counts['fetched_files'] += 1
+                raise tornado.gen.Return(True)
+            except (IOError, OSError) as out:
+                logging.error("Fetching %s: %s", link.url, out)
+        self.counts['failed_files'] += 1
+        raise tornado.gen.Return(False)
+
+    @tornado.gen.coroutine
+    def upstream_size(self, link):
+        response = yield self.fetch(link.url, method='HEAD',
+                                    request_timeout=CONNECT_TIMEOUT)
+        if response.code != 200 or 'Content-Length' not in response.headers:
+            raise tornado.gen.Return(None)
+        raise tornado.gen.Return(int(response.headers['Content-Length']))
+
+    @tornado.gen.coroutine
+    def download(self, link, part):
+        """
+        Bring the whole of 'link' into 'part', carrying on from whatever's
+        there already. Returns whether it's all there.
+
+        """
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        validator = read_validator(part)
+        headers = {}
+        if offset and validator:
+            headers['Range'] = 'bytes=%d-' % offset
+            headers['If-Range'] = validator
+            logging.info("Resuming %s from byte %d", link.url, offset)
+        else:
+            logging.info("Fetching %s", link.url)
+        download = Download(part, offset if validator else 0)
+        request = tornado.httpclient.HTTPRequest(
+            link.url, headers=headers, request_timeout=REQUEST_TIMEOUT,
+            connect_timeout=CONNECT_TIMEOUT,
+            header_callback=download.on_header,
+            streaming_callback=download.on_chunk)
+        try:
+            response = yield self.fetch(request)
+        finally:
+            download.close()
+        self.counts['bytes'] += download.received
+
+        if response.code == 416:
+            # Nothing past what we have: either we have it all, or it's
+            # shrunk, and then it's changed.
+            total = response.headers.get('Content-Range', '').rsplit('/', 1)
+            if offset and total[-1] == str(offset):
+                raise tornado.gen.Return(True)
+            yield self.executor.submit(discard, part)
+            raise tornado.gen.Return(False)
+        if response.code == 200 or download.resumed():
+            raise tornado.gen.Return(True)
+        if response.code == 206:
+            # Not the range we asked for; start again.
+            yield self.executor.submit(discard, part)
+        logging.error("Fetching %s: %s", link.url,
+                      response.error or response.code)
+        raise tornado.gen.Return(False)
+
+    @tornado.gen.coroutine
+    def place(self, name, have, link, part, digests):
+        """
+        Put the downloaded file 'part' in place, and record it in the
+        metadata store and the index.
+
+        """
+        dest = self.storage.path_for(name, link.filename)
+
+        def publish():
+            write_metadata_file(dest, part)
+            if os.path.exists(part + VALIDATOR_SUFFIX):
+                os.unlink(part + VALIDATOR_SUFFIX)
+            if self.blobs is not None:
+                self.blobs.publish(part, digests['sha256'], dest)
+            else:
+                os.chmod(part, FILE_MODE)
+                move_atomic(part, dest)
+            if have is not None and have.path != dest:
+                self.storage.remove(have.path)
+            return extract(dest, digests=False)
+
+        result = yield self.executor.submit(publish)
+        result.update(md5_digest=digests['md5'],
+                      sha256_digest=digests['sha256'])
+        dist = self.index.add_file(name, dest, sha256=digests['sha256'])
+        if record_file(self.data, name, dist, result) is None:
+            logging.warning("Can't tell what version %s is; it has no "
+                            "record in the metadata store", dest)
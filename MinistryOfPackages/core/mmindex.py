@@ -0,0 +1,351 @@
+"""
+The package index as a compact, read-only binary file that every worker
+maps into memory, rather than each building its own copy.
+
+The layout, all little-endian:
+
+    header   magic, generation, when PackageDirs was last scanned in full,
+             the number of projects, and where the sections below start
+    entries  a fixed-size record per project, sorted by normalized name:
+             where its normalized and display names are in the names
+             section, and where its block is in the blocks section
+    names    the names, back to back
+    blocks   per project, in entry order: a file count, then each file's
+             fixed-size fields and digests followed by its strings
+
+Finding a project is a binary search over the entries, and only its
+block is decoded. The pages a worker touches are the kernel's page cache,
+shared by every worker, so workers don't grow with the catalogue and
+opening the file is all a new one has to do.
+
+A file is never changed once written. Writers build the next generation
+in a temp file beside it and rename that over it; readers that still have
+the old one mapped carry on with it until they next check for a new one.
+After an upload, only the changed project is encoded: the rest of the
+next generation is copied from the last one in a few large pieces.
+
+"""
+import binascii
+import contextlib
+import errno
+import fcntl
+import mmap
+import os
+import struct
+
+from MinistryOfPackages.core.blobs import FILE_MODE, makedirs_for, temp_beside
+
+MAGIC = 'MOPIDX01'
+
+# magic, generation, scanned, count, entries_at, names_at, blocks_at
+HEADER = struct.Struct('<8sQdQQQQ')
+
+# normalized name offset and length, display name offset and length (in
+# the names section), block offset and length (in the blocks section).
+ENTRY = struct.Struct('<IIIIQQ')
+
+COUNT = struct.Struct('<I')
+
+# filename, version and url lengths, size, mtime, flags.
+FILE = struct.Struct('<HHHQdB')
+
+HAS_SHA256 = 1
+HAS_METADATA_SHA256 = 2
+
+DIGEST_SIZE = 32
+
+LOCK_SUFFIX = '.lock'
+
+
+def utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+
+def encode_block(files):
+    """
+    One project's block. 'files' is a list of (filename, version, url,
+    size, mtime, sha256, metadata_sha256) tuples, with the digests in hex
+    and version and digests possibly None. An empty version reads back as
+    None.
+
+    """
+    parts = [COUNT.pack(len(files))]
+    for filename, version, url, size, mtime, sha256, metadata_sha256 in files:
+        filename, version, url = utf8(filename), utf8(version or ''), utf8(url)
+        flags = 0
+        digests = ''
+        if sha256:
+            flags |= HAS_SHA256
+            digests += binascii.unhexlify(sha256)
+        if metadata_sha256:
+            flags |= HAS_METADATA_SHA256
+            digests += binascii.unhexlify(metadata_sha256)
+        parts.append(FILE.pack(len(filename), len(version), len(url), size,
+                               mtime, flags))
+        parts.extend((digests, filename, version, url))
+    return ''.join(parts)
+
+
+def decode_block(block):
+    """
+    The list of tuples encode_block() was given.
+
+    """
+    count, = COUNT.unpack_from(block, 0)
+    offset = COUNT.size
+    files = []
+    for i in range(count):
+        (filename_len, version_len, url_len, size, mtime,
+         flags) = FILE.unpack_from(block, offset)
+        offset += FILE.size
+        sha256 = metadata_sha256 = None
+        if flags & HAS_SHA256:
+            sha256 = binascii.hexlify(block[offset:offset + DIGEST_SIZE])
+            offset += DIGEST_SIZE
+        if flags & HAS_METADATA_SHA256:
+            metadata_sha256 = binascii.hexlify(
+                block[offset:offset + DIGEST_SIZE])
+            offset += DIGEST_SIZE
+        filename = block[offset:offset + filename_len]
+        offset += filename_len
+        version = block[offset:offset + version_len] or None
+        offset += version_len
+        url = block[offset:offset + url_len]
+        offset += url_len
+        files.append((filename, version, url, size, mtime, sha256,
+                      metadata_sha256))
+    return files
+
+
+def write_index(path, generation, scanned, entries):
+    """
+    Write 'entries', a list of (normalized, name, block) sorted on
+    normalized, as generation 'generation' of the index at 'path', and
+    swap it in. Blocks can be strings or buffers (into an older
+    generation's mapping, say).
+
+    """
+    packed, names, blocks, names_size, blocks_size = pack_entries(entries)
+    entries_at = HEADER.size
+    names_at = entries_at + ENTRY.size * len(packed)
+    blocks_at = names_at + names_size
+    replace_file(path, [HEADER.pack(MAGIC, generation, scanned, len(packed),
+                                    entries_at, names_at, blocks_at),
+                        ''.join(packed), ''.join(names)] + blocks)
+
+
+def splice_index(path, mapped, changes):
+    """
+    Write the generation after 'mapped' (an IndexFile) to 'path' with
+    some of its projects replaced. 'changes' is a list of (start, stop,
+    entries) in order, without overlaps: the projects from 'start' up to
+    'stop' are replaced by 'entries', as for write_index(). The rest is
+    copied across as it is, bar the offsets in their entries.
+
+    """
+    def offsets(i):
+        if i < mapped.count:
+            entry = mapped.entry(i)
+            return entry[0], entry[4]
+        return (mapped.blocks_at - mapped.names_at,
+                len(mapped.mm) - mapped.blocks_at)
+
+    def moved(start, stop, names_shift, blocks_shift):
+        # A run of unchanged entries, moved all at once; one at a time
+        # would be the bulk of the work.
+        if not names_shift and not blocks_shift:
+            return buffer(mm, mapped.entries_at + start * ENTRY.size,
+                          (stop - start) * ENTRY.size)
+        run = struct.Struct('<' + ENTRY.format[1:] * (stop - start))
+        values = list(run.unpack_from(mm,
+                                      mapped.entries_at + start * ENTRY.size))
+        for field, shift in ((0, names_shift), (2, names_shift),
+                             (4, blocks_shift)):
+            values[field::6] = [value + shift for value in values[field::6]]
+        return run.pack(*values)
+
+    mm = mapped.mm
+    packed, names, blocks = [], [], []
+    names_shift = blocks_shift = 0
+    count = mapped.count
+    position = 0
+    for start, stop, entries in changes + [(mapped.count, mapped.count, [])]:
+        names_from, blocks_from = offsets(position)
+        names_to, blocks_to = offsets(start)
+        packed.append(moved(position, start, names_shift, blocks_shift))
+        names.append(buffer(mm, mapped.names_at + names_from,
+                            names_to - names_from))
+        blocks.append(buffer(mm, mapped.blocks_at + blocks_from,
+                             blocks_to - blocks_from))
+
+        (new_packed, new_names, new_blocks, names_size,
+         blocks_size) = pack_entries(entries, names_to + names_shift,
+                                     blocks_to + blocks_shift)
+        packed.extend(new_packed)
+        names.extend(new_names)
+        blocks.extend(new_blocks)
+        names_from, blocks_from = names_to, blocks_to
+        names_to, blocks_to = offsets(stop)
+        names_shift += names_size - (names_to - names_from)
+        blocks_shift += blocks_size - (blocks_to - blocks_from)
+        count += len(entries) - (stop - start)
+        position = stop
+
+    entries_at = HEADER.size
+    names_at = entries_at + ENTRY.size * count
+    blocks_at = names_at + mapped.blocks_at - mapped.names_at + names_shift
+    replace_file(path, [HEADER.pack(MAGIC, mapped.generation + 1,
+                                    mapped.scanned, count, entries_at,
+                                    names_at, blocks_at)] +
+                 packed + names + blocks)
+
+
+def pack_entries(entries, names_at=0, blocks_at=0):
+    """
+    Lay out 'entries' from offsets 'names_at' and 'blocks_at' in the
+    names and blocks sections. Returns the packed entries, the names and
+    blocks to write, and how much of each section they take.
+
+    """
+    packed = []
+    names = []
+    blocks = []
+    names_size = blocks_size = 0
+    for normalized, name, block in entries:
+        normalized, name = utf8(normalized), utf8(name)
+        packed.append(ENTRY.pack(names_at + names_size, len(normalized),
+                                 names_at + names_size + len(normalized),
+                                 len(name), blocks_at + blocks_size,
+                                 len(block)))
+        names.extend((normalized, name))
+        blocks.append(block)
+        names_size += len(normalized) + len(name)
+        blocks_size += len(block)
+    return packed, names, blocks, names_size, blocks_size
+
+
+def replace_file(path, chunks):
+    makedirs_for(path)
+    temp = temp_beside(path)
+    try:
+        with open(temp, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.chmod(temp, FILE_MODE)
+        os.rename(temp, path)
+    except Exception:
+        os.unlink(temp)
+        raise
+
+
+@contextlib.contextmanager
+def locked(path, wait=True):
+    """
+    Hold the lock for the index at 'path', which serializes writers
+    between processes. Yields False if 'wait' is False and someone else
+    has it.
+
+    """
+    makedirs_for(path)
+    with open(path + LOCK_SUFFIX, 'a') as lockfile:
+        flags = fcntl.LOCK_EX
+        if not wait:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(lockfile, flags)
+        except IOError as out:
+            if out.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+class IndexFile(object):
+    """
+    One generation of the index, mapped read-only. The mapping stays valid
+    after the file is replaced, and goes away with the last reference to
+    this.
+
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.inode = (st.st_dev, st.st_ino)
+        (magic, self.generation, self.scanned, self.count, self.entries_at,
+         self.names_at, self.blocks_at) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a package index file' % path)
+
+    def entry(self, i):
+        return ENTRY.unpack_from(self.mm, self.entries_at + i * ENTRY.size)
+
+    def normalized(self, i):
+        offset, length = ENTRY.unpack_from(
+            self.mm, self.entries_at + i * ENTRY.size)[:2]
+        start = self.names_at + offset
+        return self.mm[start:start + length]
+
+    def names(self, i):
+        """
+        (normalized, display name) of the i'th project.
+
+        """
+        (normalized_at, normalized_len, name_at, name_len, block_at,
+         block_len) = self.entry(i)
+        normalized_at += self.names_at
+        name_at += self.names_at
+        return (self.mm[normalized_at:normalized_at + normalized_len],
+                self.mm[name_at:name_at + name_len])
+
+    def block(self, i):
+        """
+        The i'th project's block, as a buffer over the mapping.
+
+        """
+        block_at, block_len = self.entry(i)[4:]
+        return buffer(self.mm, self.blocks_at + block_at, block_len)
+
+    def position(self, normalized):
+        """
+        Where the project with normalized name 'normalized' is, or would
+        go.
+
+        """
+        normalized = utf8(normalized)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.normalized(middle) < normalized:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, normalized):
+        """
+        The position of the project with normalized name 'normalized', or
+        None.
+
+        """
+        i = self.position(normalized)
+        if i < self.count and self.normalized(i) == utf8(normalized):
+            return i
+        return None
+
+    def entries(self):
+        """
+        Every (normalized, name, block), in order, ready to be handed to
+        write_index() with a few changed.
+
+        """
+        for i in range(self.count):
+            normalized, name = self.names(i)
+            yield normalized, name, self.block(i)
@@ -0,0 +1,245 @@
+"""
+Incremental multipart/form-data parsing.
+
+SetupPyHandler streams upload bodies through this rather than holding the
+whole request in memory. Parts are parsed as the bytes arrive; form fields
+are kept in memory (they're small), and file parts go straight to temp
+files one chunk at a time, so memory use doesn't grow with the size of the
+artifacts.
+
+We're lenient about line endings because distutils hasn't always used
+proper CRLFs (http://bugs.python.org/issue10510).
+
+"""
+import hashlib
+import logging
+import os
+import tempfile
+
+# Parser states
+PREAMBLE, DELIMITER, HEADERS, BODY, EPILOGUE = range(5)
+
+# Header blocks and form fields should never get anywhere near these.
+MAX_HEADER_SIZE = 16 * 1024
+MAX_FIELD_SIZE = 8 * 1024 * 1024
+
+
+class MultipartError(Exception):
+    pass
+
+
+def get_boundary(content_type):
+    """
+    Pull the boundary out of a multipart Content-Type header value. Returns
+    None if there isn't one.
+
+    """
+    for field in content_type.split(';'):
+        field = field.strip()
+        if field.startswith('boundary='):
+            boundary = field.split('=', 1)[1]
+            if boundary.startswith('"') and boundary.endswith('"'):
+                boundary = boundary[1:-1]
+            return boundary
+    return None
+
+
+def parse_part_headers(block):
+    """
+    Turn a raw part header block into a dict of lowercased header names to
+    values, plus a dict of Content-Disposition parameters (name, filename).
+
+    """
+    headers = {}
+    params = {}
+    for line in block.splitlines():
+        if ':' not in line:
+            continue
+        hname, hval = line.split(':', 1)
+        headers[hname.strip().lower()] = hval.strip()
+
+    for param in headers.get('content-disposition', '').split(';'):
+        if '=' not in param:
+            continue
+        k, v = param.split('=', 1)
+        k, v = k.strip(), v.strip()
+        if v.startswith('"') and v.endswith('"'):
+            v = v[1:-1]
+        params[k] = v
+    return headers, params
+
+
+class MultipartStreamParser(object):
+    """
+    Call feed() with each piece of the body as it comes in, then close()
+    once the request is complete. Form fields end up in self.args. If the
+    body had a file part, self.args also gets:
+
+    filename: the name the client gave the file
+    filetemp: path to the temp file holding its contents
+    filesize: number of bytes written to filetemp
+    filemd5, filesha256: hex digests of the file, computed as it's written
+
+    If there's more than one file part, as in a batch upload, those are
+    for the last one, and self.files has a dict of the same for each of
+    them, in order.
+
+    The caller owns the temp files once close() returns; cleanup() removes
+    any still lying around (e.g. the client went away mid-upload).
+
+    """
+
+    def __init__(self, boundary, tmp_dir=None, multi_valued=('classifiers',)):
+        self.delimiter = '--' + boundary
+        self.tmp_dir = tmp_dir
+        self.multi_valued = multi_valued
+        self.args = {}
+        self.state = PREAMBLE
+        self.buf = ''
+        self.part_name = None
+        self.part_chunks = None
+        self.part_size = 0
+        self.fileobj = None
+        self.hashes = None
+        self.files = []
+
+    def feed(self, data):
+        self.buf += data
+        while self._step():
+            pass
+
+    def close(self):
+        if self.state != EPILOGUE:
+            self.cleanup()
+            raise MultipartError("Body ended before the closing boundary")
+        return self.args
+
+    def cleanup(self):
+        if self.fileobj is not None and not self.fileobj.closed:
+            self.fileobj.close()
+        for spooled in self.files:
+            tmp = spooled['filetemp']
+            if os.path.exists(tmp):
+                logging.debug("Removing abandoned upload %s", tmp)
+                os.unlink(tmp)
+
+    def _step(self):
+        """
+        Advance the state machine as far as the buffer allows. Returns True
+        if it's worth calling again.
+
+        """
+        if self.state == PREAMBLE:
+            idx = self.buf.find(self.delimiter)
+            if idx == -1:
+                self.buf = self.buf[-len(self.delimiter):]
+                return False
+            self.buf = self.buf[idx + len(self.delimiter):]
+            self.state = DELIMITER
+            return True
+
+        elif self.state == DELIMITER:
+            if len(self.buf) < 2:
+                return False
+            if self.buf.startswith('--'):
+                self.state = EPILOGUE
+                self.buf = ''
+                return False
+            idx = self.buf.find('\n')
+            if idx == -1:
+                if len(self.buf) > MAX_HEADER_SIZE:
+                    raise MultipartError("Garbage after boundary")
+                return False
+            self.buf = self.buf[idx + 1:]
+            self.state = HEADERS
+            return True
+
+        elif self.state == HEADERS:
+            ends = [(i, len(sep)) for i, sep in
+                    [(self.buf.find(s), s) for s in ('\r\n\r\n', '\n\n')]
+                    if i != -1]
+            if not ends:
+                if len(self.buf) > MAX_HEADER_SIZE:
+                    raise MultipartError("Part headers too large")
+                return False
+            idx, seplen = min(ends)
+            headers, params = parse_part_headers(self.buf[:idx])
+            self.buf = self.buf[idx + seplen:]
+            self._start_part(params)
+            self.state = BODY
+            return True
+
+        elif self.state == BODY:
+            idx = self.buf.find('\n' + self.delimiter)
+            if idx != -1:
+                data = self.buf[:idx]
+                if data.endswith('\r'):
+                    data = data[:-1]
+                self._part_data(data)
+                self._end_part()
+                self.buf = self.buf[idx + 1 + len(self.delimiter):]
+                self.state = DELIMITER
+                return True
+            # Hang on to enough of the tail that a delimiter split across
+            # two chunks (including a leading '\r\n') is still found.
+            safe = len(self.buf) - len(self.delimiter) - 2
+            if safe > 0:
+                self._part_data(self.buf[:safe])
+                self.buf = self.buf[safe:]
+            return False
+
+        # EPILOGUE: anything after the closing boundary is ignored.
+        self.buf = ''
+        return False
+
+    def _start_part(self, params):
+        self.part_name = params.get('name')
+        self.part_size = 0
+        if 'filename' in params:
+            fd, path = tempfile.mkstemp(prefix='upload-', dir=self.tmp_dir)
+            self.fileobj = os.fdopen(fd, 'wb')
+            self.hashes = {'filemd5': hashlib.md5(),
+                           'filesha256': hashlib.sha256()}
+            self.files.append({'filename': params['filename'],
+                               'filetemp': path})
+            self.args['filename'] = params['filename']
+            self.args['filetemp'] = path
+            logging.debug("Spooling '%s' to %s", params['filename'], path)
+        else:
+            self.part_chunks = []
+
+    def _part_data(self, data):
+        if not data:
+            return
+        self.part_size += len(data)
+        if self.fileobj is not None:
+            self.fileobj.write(data)
+            for h in self.hashes.values():
+                h.update(data)
+        else:
+            if self.part_size > MAX_FIELD_SIZE:
+                raise MultipartError("Form field '%s' too large" %
+                                     self.part_name)
+            self.part_chunks.append(data)
+
+    def _end_part(self):
+        if self.fileobj is not None:
+            self.fileobj.close()
+            self.fileobj = None
+            spooled = self.files[-1]
+            spooled['filesize'] = self.part_size
+            for k, h in self.hashes.items():
+                spooled[k] = h.hexdigest()
+            self.args.update(spooled)
+            self.hashes = None
+            return
+
+        k, v = self.part_name, ''.join(self.part_chunks)
+        self.part_chunks = None
+        if k is None:
+            return
+        if k in self.multi_valued:
+            # there can be >1 of these.
+            self.args.setdefault(k, []).append(v)
+        else:
+            self.args[k] = v
@@ -0,0 +1,505 @@
+"""
+Pull-through caching of an upstream simple index.
+
+UpstreamIndex fetches project pages and distribution files from the
+configured upstream (PyPI, or another MinistryOfPackages) with Tornado's
+AsyncHTTPClient, whose max_clients caps how many upstream requests are in
+flight at once. pycurl's client is used if it's installed, since it keeps
+connections alive between requests.
+
+Files are written to a temp file in the cache as they arrive. Anyone who
+wants the same file while it's still coming in attaches to the same Fetch
+rather than starting another one: they read what's already in the temp
+file and then follow along as more arrives, so one upstream download can
+feed any number of clients. Each reader only ever holds one chunk.
+
+The cache is bounded by size. DiskCache evicts least recently used files
+once it's over 'cache_max_bytes'; access times are recorded as file
+mtimes, so the order survives restarts and is shared (roughly) between
+processes. Working that out means walking the whole cache, which is done
+on the IOExecutor.
+
+"""
+import collections
+import hashlib
+import HTMLParser
+import json
+import logging
+import os
+import tempfile
+import time
+import urlparse
+
+import tornado.concurrent
+import tornado.gen
+import tornado.httpclient
+import tornado.httputil
+import tornado.ioloop
+import tornado.locks
+
+from MinistryOfPackages.core.executor import io_executor
+from MinistryOfPackages.core.index import is_safe_name, normalize_name
+
+try:
+    import pycurl
+except ImportError:
+    pycurl = None
+
+DEFAULT_UPSTREAM = 'https://pypi.org/simple/'
+DEFAULT_MAX_CLIENTS = 20
+DEFAULT_PAGE_TTL = 300
+DEFAULT_CACHE_MAX_BYTES = 10 * 1024 * 1024 * 1024
+SWEEP_INTERVAL = 300
+STALE_TMP_AGE = 24 * 60 * 60
+
+
+class UpstreamError(Exception):
+
+    def __init__(self, code, message=None):
+        Exception.__init__(self, message or 'Upstream returned %s' % code)
+        self.code = code
+
+
+class Link(object):
+    """
+    One file link from an upstream project page. 'url' is where upstream
+    keeps it; 'attrs' are the data-* attributes that came with it.
+
+    """
+    __slots__ = ('filename', 'url', 'fragment', 'attrs')
+
+    def __init__(self, filename, url, fragment, attrs):
+        self.filename = filename
+        self.url = url
+        self.fragment = fragment
+        self.attrs = attrs
+
+    def to_json(self):
+        return {'filename': self.filename, 'url': self.url,
+                'fragment': self.fragment, 'attrs': self.attrs}
+
+    @property
+    def sha256(self):
+        if self.fragment.startswith('sha256='):
+            return self.fragment[len('sha256='):]
+
+
+class LinkParser(HTMLParser.HTMLParser):
+
+    def __init__(self, base_url):
+        HTMLParser.HTMLParser.__init__(self)
+        self.base_url = base_url
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag != 'a':
+            return
+        attrs = dict(attrs)
+        href = attrs.pop('href', None)
+        if not href:
+            return
+        url, fragment = urlparse.urldefrag(urlparse.urljoin(self.base_url,
+                                                            href))
+        filename = urlparse.unquote(url.rsplit('/', 1)[-1])
+        if not is_safe_name(filename):
+            # Nothing upstream says gets to pick a path outside the cache.
+            return
+        data = dict((k, v) for k, v in attrs.items()
+                    if k.startswith('data-') and v is not None)
+        self.links.append(Link(filename, url, fragment, data))
+
+
+def parse_links(html, base_url):
+    parser = LinkParser(base_url)
+    parser.feed(html)
+    parser.close()
+    return parser.links
+
+
+class DiskCache(object):
+    """
+    Files under 'directory', at most 'max_bytes' of them, least recently
+    used thrown out first. Keys are relative paths. With an 'executor' (a
+    core.executor.IOExecutor), sweeps are done on that.
+
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_MAX_BYTES,
+                 executor=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.executor = executor
+        self.tmp_dir = os.path.join(directory, '.tmp')
+        if not os.path.isdir(self.tmp_dir):
+            os.makedirs(self.tmp_dir)
+        self.entries = collections.OrderedDict()
+        self.total = 0
+        # Resolves when the sweep_on() under way, if any, is done.
+        self.sweeping = None
+        if executor is None:
+            self.sweep()
+        else:
+            tornado.ioloop.IOLoop.current().spawn_callback(self.sweep_on)
+
+    def path(self, key):
+        """
+        Where 'key' is kept. Raises ValueError for keys that would lead
+        outside the cache.
+
+        """
+        path = os.path.join(self.directory, key)
+        if not os.path.realpath(path).startswith(
+                os.path.realpath(self.directory) + os.sep):
+            raise ValueError('%r is outside the cache' % key)
+        return path
+
+    def lookup(self, key):
+        """
+        Path to the cached file, or None. Counts as a use.
+
+        """
+        try:
+            path = self.path(key)
+        except ValueError as out:
+            logging.error("Cache lookup: %s", out)
+            return None
+        if key not in self.entries:
+            # Another process may have cached it.
+            if not os.path.isfile(path):
+                return None
+            self.entries[key] = os.stat(path).st_size
+            self.total += self.entries[key]
+        else:
+            self.entries[key] = self.entries.pop(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            # Evicted by another process.
+            self.total -= self.entries.pop(key)
+            return None
+        return path
+
+    def temp_file(self):
+        fd, path = tempfile.mkstemp(dir=self.tmp_dir)
+        return os.fdopen(fd, 'wb'), path
+
+    def store(self, key, tmp_path):
+        path = self.path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+        if key in self.entries:
+            self.total -= self.entries.pop(key)
+        self.entries[key] = os.stat(path).st_size
+        self.total += self.entries[key]
+        if self.total > self.max_bytes:
+            if self.executor is None:
+                self.sweep()
+            else:
+                tornado.ioloop.IOLoop.current().spawn_callback(self.sweep_on)
+        return path
+
+    def sweep(self):
+        """
+        Rebuild our view of the cache from disk, since other processes
+        write to it too, and evict until it fits.
+
+        """
+        self.entries, self.total = self.read_disk()
+
+    @tornado.gen.coroutine
+    def sweep_on(self):
+        """
+        sweep(), with the walk and the evictions done on self.executor. If
+        there's one under way already, that one will do.
+
+        """
+        if self.sweeping is not None:
+            yield self.sweeping
+            return
+        self.sweeping = tornado.concurrent.Future()
+        try:
+            self.entries, self.total = yield self.executor.submit(
+                self.read_disk)
+        except (IOError, OSError) as out:
+            logging.error("Sweeping the proxy cache: %s", out)
+        finally:
+            sweeping, self.sweeping = self.sweeping, None
+            sweeping.set_result(None)
+
+    def read_disk(self):
+        """
+        The entries and total size sweep() comes up with, evicting what
+        doesn't fit on the way. This is safe to run off the IOLoop thread.
+
+        """
+        found = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            if dirpath == self.directory and '.tmp' in dirnames:
+                dirnames.remove('.tmp')
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                found.append((st.st_mtime,
+                              os.path.relpath(path, self.directory),
+                              st.st_size))
+        found.sort()
+
+        # Leftovers from fetches that died with their process.
+        for filename in os.listdir(self.tmp_dir):
+            path = os.path.join(self.tmp_dir, filename)
+            try:
+                if os.stat(path).st_mtime < time.time() - STALE_TMP_AGE:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+        entries = collections.OrderedDict((k, size) for t, k, size in found)
+        total = sum(entries.values())
+
+        while total > self.max_bytes and entries:
+            key, size = entries.popitem(last=False)
+            logging.debug("Evicting %s from proxy cache", key)
+            try:
+                os.unlink(self.path(key))
+            except OSError:
+                pass
+            total -= size
+        return entries, total
+
+
+class Fetch(object):
+    """
+    One file being downloaded from upstream into the cache. 'received' is
+    how much of it is in the temp file so far. 'headers' resolves to the
+    upstream status code once upstream has answered. 'progress' is notified
+    every time more arrives, and when the fetch is over; 'finished' is set
+    then, along with 'error' if it failed.
+
+    """
+
+    def __init__(self, key, link, tmp_file, tmp_path):
+        self.key = key
+        self.link = link
+        self.tmp_file = tmp_file
+        self.tmp_path = tmp_path
+        self.received = 0
+        self.code = None
+        self.length = None
+        self.finished = False
+        self.error = None
+        self.sha256 = hashlib.sha256()
+        self.headers = tornado.concurrent.Future()
+        self.progress = tornado.locks.Condition()
+        self.response_headers = tornado.httputil.HTTPHeaders()
+
+    def on_header(self, line):
+        if line.startswith('HTTP/'):
+            start_line = tornado.httputil.parse_response_start_line(line)
+            self.code = start_line.code
+            self.response_headers = tornado.httputil.HTTPHeaders()
+        elif line.strip():
+            self.response_headers.parse_line(line)
+        elif self.code is not None and not 300 <= self.code < 400:
+            if 'Content-Length' in self.response_headers:
+                self.length = int(self.response_headers['Content-Length'])
+            if not self.headers.done():
+                self.headers.set_result(self.code)
+
+    def on_chunk(self, chunk):
+        if self.code != 200:
+            return
+        self.tmp_file.write(chunk)
+        # Readers open the temp file separately; make sure they can see it.
+        self.tmp_file.flush()
+        self.sha256.update(chunk)
+        self.received += len(chunk)
+        self.progress.notify_all()
+
+    def fail(self, error):
+        self.error = error
+        self.finished = True
+        if not self.headers.done():
+            self.headers.set_exception(error)
+        self.progress.notify_all()
+
+
+class UpstreamIndex(object):
+
+    def __init__(self, upstream, cache, max_clients=DEFAULT_MAX_CLIENTS,
+                 page_ttl=DEFAULT_PAGE_TTL, request_timeout=300):
+        if not upstream.endswith('/'):
+            upstream += '/'
+        self.upstream = upstream
+        self.cache = cache
+        self.page_ttl = page_ttl
+        self.request_timeout = request_timeout
+        if pycurl is not None:
+            tornado.httpclient.AsyncHTTPClient.configure(
+                'tornado.curl_httpclient.CurlAsyncHTTPClient',
+                max_clients=max_clients)
+        else:
+            tornado.httpclient.AsyncHTTPClient.configure(
+                None, max_clients=max_clients)
+        self.client = tornado.httpclient.AsyncHTTPClient()
+        self.pages = {}
+        self.page_fetches = {}
+        self.file_fetches = {}
+
+    def page_key(self, normalized):
+        return os.path.join('pages', normalized + '.json')
+
+    def file_key(self, normalized, filename):
+        return os.path.join('files', normalized, filename)
+
+    @tornado.gen.coroutine
+    def get_links(self, project):
+        """
+        The file links on upstream's page for 'project', from memory, the
+        disk cache or upstream, in that order. Concurrent requests for the
+        same page share one upstream fetch.
+
+        """
+        normalized = normalize_name(project)
+        cached = self.pages.get(normalized)
+        if cached is None:
+            path = self.cache.lookup(self.page_key(normalized))
+            if path is not None:
+                with open(path) as f:
+                    data = json.load(f)
+                cached = self.pages[normalized] = (
+                    data['fetched'], [Link(**l) for l in data['links']])
+        if cached is not None and time.time() - cached[0] < self.page_ttl:
+            raise tornado.gen.Return(cached[1])
+
+        if normalized not in self.page_fetches:
+            self.page_fetches[normalized] = self.fetch_page(normalized)
+        try:
+            links = yield self.page_fetches[normalized]
+        except UpstreamError:
+            if cached is None:
+                raise
+            # Stale beats nothing when upstream is down.
+            logging.error("Serving stale upstream page for %s", normalized)
+            links = cached[1]
+        raise tornado.gen.Return(links)
+
+    @tornado.gen.coroutine
+    def fetch_page(self, normalized):
+        url = urlparse.urljoin(self.upstream, normalized + '/')
+        try:
+            response = yield self.client.fetch(
+                url, request_timeout=self.request_timeout, raise_error=False)
+        finally:
+            self.page_fetches.pop(normalized, None)
+        if response.code != 200:
+            raise UpstreamError(response.code)
+
+        links = parse_links(response.body, response.effective_url)
+        fetched = time.time()
+        self.pages[normalized] = (fetched, links)
+        tmp_file, tmp_path = self.cache.temp_file()
+        with tmp_file:
+            json.dump({'fetched': fetched,
+                       'links': [l.to_json() for l in links]}, tmp_file)
+        self.cache.store(self.page_key(normalized), tmp_path)
+        raise tornado.gen.Return(links)
+
+    @tornado.gen.coroutine
+    def find_link(self, project, filename):
+        links = yield self.get_links(project)
+        for link in links:
+            if link.filename == filename:
+                raise tornado.gen.Return(link)
+        raise UpstreamError(404, 'No such file upstream: %s' % filename)
+
+    @tornado.gen.coroutine
+    def get_file(self, project, filename):
+        """
+        Returns (path, None) if the file is already cached, otherwise
+        (None, fetch) where fetch is the Fetch bringing it in. Callers
+        wait on fetch.headers before sending anything.
+
+        """
+        normalized = normalize_name(project)
+        key = self.file_key(normalized, filename)
+        path = self.cache.lookup(key)
+        if path is not None:
+            raise tornado.gen.Return((path, None))
+
+        fetch = self.file_fetches.get(key)
+        if fetch is None:
+            link = yield self.find_link(project, filename)
+            # Somebody may have started it while we were finding the link.
+            fetch = self.file_fetches.get(key)
+            if fetch is None:
+                fetch = self.start_fetch(key, link)
+        raise tornado.gen.Return((None, fetch))
+
+    def start_fetch(self, key, link):
+        tmp_file, tmp_path = self.cache.temp_file()
+        fetch = Fetch(key, link, tmp_file, tmp_path)
+        self.file_fetches[key] = fetch
+        logging.info("Fetching %s from upstream", link.url)
+        request = tornado.httpclient.HTTPRequest(
+            link.url, request_timeout=self.request_timeout,
+            header_callback=fetch.on_header,
+            streaming_callback=fetch.on_chunk)
+        future = self.client.fetch(request, raise_error=False)
+        tornado.ioloop.IOLoop.current().add_future(
+            future, lambda f: self.finish_fetch(fetch, f))
+        return fetch
+
+    def finish_fetch(self, fetch, future):
+        self.file_fetches.pop(fetch.key, None)
+        fetch.tmp_file.close()
+        try:
+            response = future.result()
+            if response.code != 200:
+                raise UpstreamError(response.code)
+            expected = fetch.link.sha256
+            if expected and fetch.sha256.hexdigest() != expected:
+                raise UpstreamError(502, 'sha256 mismatch for %s' %
+                                    fetch.link.url)
+            self.cache.store(fetch.key, fetch.tmp_path)
+        except Exception as out:
+            logging.error("Upstream fetch of %s failed: %s",
+                          fetch.link.url, out)
+            if not isinstance(out, UpstreamError):
+                out = UpstreamError(502, str(out))
+            if os.path.exists(fetch.tmp_path):
+                os.unlink(fetch.tmp_path)
+            fetch.fail(out)
+            return
+        fetch.finished = True
+        if not fetch.headers.done():
+            fetch.headers.set_result(fetch.code)
+        fetch.progress.notify_all()
+
+
+def upstream_index(application):
+    """
+    The application's UpstreamIndex, configured from settings['Proxy'].
+
+    """
+    upstream = getattr(application, 'upstream_index', None)
+    if upstream is None:
+        settings = application.settings
+        config = settings.get('Proxy') or {}
+        cache = DiskCache(
+            os.path.join(settings['base_path'],
+                         config.get('cache_dir', 'var/proxy-cache')),
+            config.get('cache_max_bytes', DEFAULT_CACHE_MAX_BYTES),
+            io_executor(application))
+        upstream = UpstreamIndex(
+            config.get('upstream', DEFAULT_UPSTREAM), cache,
+            max_clients=config.get('max_clients', DEFAULT_MAX_CLIENTS),
+            page_ttl=config.get('page_ttl', DEFAULT_PAGE_TTL))
+        application.upstream_index = upstream
+        tornado.ioloop.PeriodicCallback(cache.sweep_on,
+                                        SWEEP_INTERVAL * 1000).start()
+    return upstream
@@ -0,0 +1,102 @@
+"""
+Per-worker load figures in shared memory.
+
+The parent process creates a Scoreboard before forking workers, and each
+worker writes to its own slot. Nothing is locked: every slot has exactly
+one writer, and the parent only reads, so the worst it can see is a
+figure that's a request or two out of date.
+
+"""
+import multiprocessing
+import time
+
+FIELDS = ('pid', 'port', 'started', 'requests', 'inflight', 'busy',
+          'claimed_requests', 'claimed_busy')
+(PID, PORT, STARTED, REQUESTS, INFLIGHT, BUSY, CLAIMED_REQUESTS,
+ CLAIMED_BUSY) = range(len(FIELDS))
+
+
+class WorkerStats(object):
+    """
+    One worker's view of its own slot.
+
+    """
+
+    def __init__(self, array, offset):
+        self.array = array
+        self.offset = offset
+
+    def claim(self, pid, port):
+        # 'requests' and 'busy' keep running across the workers that reuse
+        # a slot, so they never go backwards; 'inflight' is per worker.
+        # Where they were when this one started is kept for load_report.
+        self.array[self.offset + CLAIMED_REQUESTS] = \
+            self.array[self.offset + REQUESTS]
+        self.array[self.offset + CLAIMED_BUSY] = self.array[self.offset + BUSY]
+        self.array[self.offset + PID] = pid
+        self.array[self.offset + PORT] = port
+        self.array[self.offset + STARTED] = time.time()
+        self.array[self.offset + INFLIGHT] = 0
+
+    def release(self):
+        self.array[self.offset + PID] = 0
+        self.array[self.offset + INFLIGHT] = 0
+
+    def request_started(self):
+        self.array[self.offset + INFLIGHT] += 1
+
+    def request_finished(self, seconds):
+        self.array[self.offset + REQUESTS] += 1
+        self.array[self.offset + INFLIGHT] -= 1
+        self.array[self.offset + BUSY] += seconds
+
+
+class Scoreboard(object):
+    """
+    A fixed number of worker slots in a RawArray of doubles. Create it
+    before forking so every worker shares the same memory.
+
+    """
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.array = multiprocessing.RawArray('d', slots * len(FIELDS))
+
+    def worker(self, slot):
+        return WorkerStats(self.array, slot * len(FIELDS))
+
+    def read(self, slot):
+        offset = slot * len(FIELDS)
+        return dict(zip(FIELDS, self.array[offset:offset + len(FIELDS)]))
+
+    def snapshot(self):
+        """
+        A dict of figures for every slot with a live worker in it.
+
+        """
+        return dict((slot, self.read(slot)) for slot in range(self.slots)
+                    if self.read(slot)['pid'])
+
+
+def load_report(before, after, interval):
+    """
+    Log-friendly lines describing what each worker did between two
+    snapshots taken 'interval' seconds apart.
+
+    """
+    lines = []
+    for slot in sorted(after):
+        now = after[slot]
+        then = before.get(slot)
+        if then is None or then['pid'] != now['pid']:
+            # A worker that's started since: count from when it did.
+            then = dict(now, requests=now['claimed_requests'],
+                        busy=now['claimed_busy'])
+        lines.append('port %d slot %d pid %d: %.1f req/s, %d in flight, '
+                     '%.0f%% busy' % (now['port'], slot, now['pid'],
+                                      (now['requests'] - then['requests']) /
+                                      interval,
+                                      now['inflight'],
+                                      100.0 * (now['busy'] - then['busy']) /
+                                      interval))
+    return lines
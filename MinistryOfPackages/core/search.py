@@ -0,0 +1,217 @@
+"""
+Search over release metadata, for /search?q=&classifier=.
+
+Every release is a document. Its project name, keywords, author and
+maintainer, classifiers, summary and description are broken into terms
+for an inverted index kept in memory, {term: {document: weight}}, where
+the weight is the sum of FIELD_WEIGHTS for the fields the term turns up
+in: a match in the name counts for more than one in the description.
+Classifiers are also indexed whole, along with each of their '::'
+prefixes, so classifier=Programming Language :: Python finds releases
+that only list Programming Language :: Python :: 3.6.
+
+A query intersects the documents of each of its terms and classifiers,
+smallest first, scores what's left by weight times inverse document
+frequency, and returns each project once, as its best scoring release
+(the newest, on a tie). Ranked results are cached per query until the
+index next changes, so paging through them, or a popular query, costs a
+slice.
+
+The index follows the metadata store by project serial: before each
+query, it asks the store for projects whose serial has moved since it
+last looked and reindexes just those. Metadata from a register or upload
+in any process is searchable on the next query. Workers build the whole
+index as they start.
+
+"""
+import math
+import re
+
+from MinistryOfPackages.core.cache import LRUCache
+from MinistryOfPackages.core.dao import pypi_data
+from MinistryOfPackages.core.versions import parse_version
+
+# (field, weight) for the release metadata fields searched.
+FIELD_WEIGHTS = (('name', 10), ('keywords', 5), ('author', 3),
+                 ('author_email', 3), ('maintainer', 3),
+                 ('maintainer_email', 3), ('summary', 3), ('classifiers', 2),
+                 ('description', 1))
+
+DEFAULT_SEARCH_CACHE_SIZE = 256
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+_term_re = re.compile(r'[a-z0-9]+(?:\.[a-z0-9]+)*')
+
+
+def terms(value):
+    """
+    The set of search terms in a metadata value, a string or a list of
+    them. Dotted runs like '3.6' or 'zope.interface' stay in one piece.
+
+    """
+    if not value:
+        return set()
+    if isinstance(value, (list, tuple)):
+        value = ' '.join(v for v in value if v)
+    return set(_term_re.findall(value.lower()))
+
+
+def classifier_prefixes(classifiers):
+    prefixes = set()
+    if isinstance(classifiers, basestring):
+        classifiers = [classifiers]
+    for classifier in classifiers or []:
+        parts = [part.strip() for part in classifier.split('::')]
+        for i in range(1, len(parts) + 1):
+            prefixes.add(' :: '.join(parts[:i]))
+    return prefixes
+
+
+class SearchIndex(object):
+
+    def __init__(self, data, cache_size=DEFAULT_SEARCH_CACHE_SIZE):
+        self.data = data
+        # (terms, classifiers): ranked results, validated by serial.
+        self.cache = LRUCache(cache_size)
+        # The highest project serial indexed so far.
+        self.serial = 0
+        self.next_doc = 0
+        # document: (name, version, summary, rank), where rank orders the
+        # project's releases from oldest to newest.
+        self.docs = {}
+        # normalized name: [documents]
+        self.project_docs = {}
+        # document: (terms, classifiers) it's filed under, for forgetting
+        # it again.
+        self.doc_keys = {}
+        # term: {document: weight}
+        self.postings = {}
+        # classifier or classifier prefix: set of documents
+        self.classifiers = {}
+
+    def refresh(self):
+        """
+        Reindex the projects that have changed since we last looked.
+
+        """
+        backend = self.data.read()
+        for normalized, serial in backend.get_changed_projects(self.serial):
+            self.index_project(backend, normalized)
+            self.serial = max(self.serial, serial)
+
+    def index_project(self, backend, normalized):
+        self.forget(normalized)
+        found = backend.get_project(normalized)
+        if found is None:
+            return
+        name = found[0]
+        releases = backend.get_releases(normalized)
+        docs = self.project_docs[normalized] = []
+        for rank, version in enumerate(sorted(releases, key=parse_version)):
+            metadata = releases[version]
+            doc = self.next_doc
+            self.next_doc += 1
+            docs.append(doc)
+            self.docs[doc] = (name, version, metadata.get('summary') or '',
+                              rank)
+
+            weights = {}
+            for field, weight in FIELD_WEIGHTS:
+                value = name if field == 'name' else metadata.get(field)
+                for term in terms(value):
+                    weights[term] = weights.get(term, 0) + weight
+            for term, weight in weights.items():
+                self.postings.setdefault(term, {})[doc] = weight
+
+            classifiers = classifier_prefixes(metadata.get('classifiers'))
+            for classifier in classifiers:
+                self.classifiers.setdefault(classifier, set()).add(doc)
+            self.doc_keys[doc] = (list(weights), list(classifiers))
+
+    def forget(self, normalized):
+        for doc in self.project_docs.pop(normalized, []):
+            del self.docs[doc]
+            doc_terms, doc_classifiers = self.doc_keys.pop(doc)
+            for term in doc_terms:
+                postings = self.postings[term]
+                del postings[doc]
+                if not postings:
+                    del self.postings[term]
+            for classifier in doc_classifiers:
+                docs = self.classifiers[classifier]
+                docs.discard(doc)
+                if not docs:
+                    del self.classifiers[classifier]
+
+    def search(self, query, classifiers=(), offset=0,
+               limit=DEFAULT_PAGE_SIZE):
+        """
+        Projects matching every term in 'query' and every one of
+        'classifiers', best first. Returns how many there are, and
+        (score, name, version, summary) for 'limit' of them from 'offset'.
+
+        """
+        self.refresh()
+        query_terms = terms(query)
+        classifiers = set(' :: '.join(part.strip()
+                                      for part in classifier.split('::'))
+                          for classifier in classifiers)
+        key = (frozenset(query_terms), frozenset(classifiers))
+        ranked = self.cache.get(key, self.serial)
+        if ranked is None:
+            ranked = self.rank(query_terms, classifiers)
+            self.cache.put(key, self.serial, ranked)
+        return len(ranked), ranked[offset:offset + limit]
+
+    def rank(self, query_terms, classifiers):
+        sets = [self.postings.get(term, {}) for term in query_terms]
+        sets.extend(self.classifiers.get(classifier, set())
+                    for classifier in classifiers)
+        if not sets or not all(sets):
+            return []
+        sets.sort(key=len)
+        rest = sets[1:]
+        matches = [doc for doc in sets[0]
+                   if all(doc in other for other in rest)]
+
+        weighted = [(self.postings[term],
+                     math.log(1.0 + float(len(self.docs)) /
+                              len(self.postings[term])))
+                    for term in query_terms]
+        docs = self.docs
+        best = {}
+        for doc in matches:
+            score = 0
+            for postings, weight in weighted:
+                score += postings[doc] * weight
+            name = docs[doc][0]
+            current = best.get(name)
+            if (current is None or score > current[0] or
+                    (score == current[0] and
+                     docs[doc][3] > docs[current[1]][3])):
+                best[name] = (score, doc)
+
+        # Python 2 list comprehensions leak their names, so these mustn't
+        # reuse the loop's.
+        ranked = [(doc_score,) + docs[best_doc][:3]
+                  for doc_score, best_doc in best.values()]
+        ranked.sort(key=lambda result: (-result[0], result[1].lower()))
+        return ranked
+
+
+def search_index(application):
+    """
+    The application's SearchIndex, with settings['search_cache_size']
+    queries' results cached.
+
+    """
+    index = getattr(application, 'search_index', None)
+    if index is None:
+        index = SearchIndex(pypi_data(application),
+                            application.settings.get(
+                                'search_cache_size',
+                                DEFAULT_SEARCH_CACHE_SIZE))
+        application.search_index = index
+    return index
@@ -0,0 +1,152 @@
+"""
+Where uploaded files go under PackageDirs.
+
+With settings['storage_layout'] 'flat', the way it's always been, every
+upload goes in <first PackageDirs entry>/<project>/<filename>.
+
+With 'sharded', files are spread over every PackageDirs entry (put each
+disk's mount point in PackageDirs) by consistent hashing on the project
+and filename, and laid out as
+
+    <root>/_ab/<project>/_cd/<filename>
+
+where _ab comes from the project's name and _cd from the filename, so
+the entries of any big directory are spread over 256 smaller ones. Names
+starting with '_' can't be project names, so fan-out directories are
+never taken for projects. Each root has VIRTUAL_NODES points on the hash
+ring; adding a root moves about its share of the files to it and leaves
+the rest where they are.
+bin/ministry_rebalance.py does the moving, and also takes a flat tree to
+sharded.
+
+Nothing needs to probe the roots for a file: where a file belongs is
+worked out from its name, and where it is is in the package index, with
+its url pointing straight at it.
+
+"""
+import bisect
+import errno
+import hashlib
+import os
+import struct
+
+from MinistryOfPackages.core.index import (METADATA_SUFFIX, fanout_name,
+                                           normalize_name)
+
+DEFAULT_STORAGE_LAYOUT = 'flat'
+
+LAYOUTS = ('flat', 'sharded')
+
+# Points on the hash ring per root.
+VIRTUAL_NODES = 128
+
+
+def utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+
+class HashRing(object):
+    """
+    Consistent hashing of keys onto 'nodes'.
+
+    """
+
+    def __init__(self, nodes, replicas=VIRTUAL_NODES):
+        points = []
+        for node in nodes:
+            for i in range(replicas):
+                points.append((self.position('%s#%d' % (node, i)), node))
+        points.sort()
+        self.positions = [position for position, node in points]
+        self.nodes = [node for position, node in points]
+
+    @staticmethod
+    def position(key):
+        return struct.unpack('>I', hashlib.md5(utf8(key)).digest()[:4])[0]
+
+    def node_for(self, key):
+        i = bisect.bisect(self.positions, self.position(key))
+        return self.nodes[i % len(self.nodes)]
+
+
+class ArtifactStorage(object):
+
+    def __init__(self, base_path, package_dirs,
+                 layout=DEFAULT_STORAGE_LAYOUT, draining=()):
+        if layout not in LAYOUTS:
+            raise ValueError('storage_layout must be one of %s, not %r' %
+                             (', '.join(LAYOUTS), layout))
+        self.base_path = base_path
+        self.package_dirs = package_dirs
+        self.layout = layout
+        # PackageDirs entries to put nothing in, since they're being
+        # emptied to be taken out.
+        self.targets = [root for root in package_dirs if root not in draining]
+        if not self.targets:
+            raise ValueError('Every PackageDirs entry is being drained')
+        self.ring = HashRing(self.targets)
+
+    def root_for(self, project_name, filename):
+        """
+        The PackageDirs entry a file belongs in.
+
+        """
+        if self.layout == 'flat':
+            return self.targets[0]
+        return self.ring.node_for('%s/%s' % (normalize_name(project_name),
+                                             filename))
+
+    def path_for(self, project_name, filename):
+        """
+        Where the file 'filename' of project 'project_name' (as spelled for
+        its directory) belongs.
+
+        """
+        root = os.path.join(self.base_path,
+                            self.root_for(project_name, filename))
+        if self.layout == 'flat':
+            return os.path.join(root, project_name, filename)
+        return os.path.join(root, fanout_name(normalize_name(project_name)),
+                            project_name, fanout_name(filename), filename)
+
+    def remove(self, path):
+        """
+        Remove the file at 'path' and its metadata file, if they're there,
+        then any directories that leaves empty, short of the PackageDirs
+        entry itself.
+
+        """
+        for victim in (path, path + METADATA_SUFFIX):
+            try:
+                os.unlink(victim)
+            except OSError as out:
+                if out.errno != errno.ENOENT:
+                    raise
+        roots = set(os.path.join(self.base_path, root)
+                    for root in self.package_dirs)
+        directory = os.path.dirname(path)
+        while directory not in roots and directory != os.path.dirname(
+                directory):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+
+def artifact_storage(application):
+    """
+    The application's ArtifactStorage, for settings['storage_layout'].
+
+    """
+    storage = getattr(application, 'artifact_storage', None)
+    if storage is None:
+        settings = application.settings
+        storage = ArtifactStorage(settings['base_path'],
+                                  settings['PackageDirs'],
+                                  settings.get('storage_layout',
+                                               DEFAULT_STORAGE_LAYOUT))
+        application.artifact_storage = storage
+    return storage
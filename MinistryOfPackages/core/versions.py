@@ -0,0 +1,138 @@
+"""
+PEP 440 version ordering, and a per-project index of versions kept in
+that order.
+
+parse_version() turns a version string into a key that sorts the way
+PEP 440 says it should: dev releases before pre-releases before the final
+release before post releases, with epochs and local versions handled.
+Strings that aren't valid PEP 440 still get a key; they sort before every
+valid version, the same way setuptools treats them.
+
+"""
+import bisect
+import re
+
+VERSION_PATTERN = re.compile(r"""
+    ^\s*v?
+    (?:(?P<epoch>[0-9]+)!)?
+    (?P<release>[0-9]+(?:\.[0-9]+)*)
+    (?P<pre>[-_.]?(?P<pre_l>a|b|c|rc|alpha|beta|pre|preview)
+        [-_.]?(?P<pre_n>[0-9]+)?)?
+    (?P<post>(?:-(?P<post_n1>[0-9]+))|(?:[-_.]?(?P<post_l>post|rev|r)
+        [-_.]?(?P<post_n2>[0-9]+)?))?
+    (?P<dev>[-_.]?(?P<dev_l>dev)[-_.]?(?P<dev_n>[0-9]+)?)?
+    (?:\+(?P<local>[a-z0-9]+(?:[-_.][a-z0-9]+)*))?
+    \s*$
+    """, re.VERBOSE | re.IGNORECASE)
+
+PRE_LABELS = {'a': 'a', 'alpha': 'a', 'b': 'b', 'beta': 'b',
+              'c': 'rc', 'rc': 'rc', 'pre': 'rc', 'preview': 'rc'}
+
+
+def parse_version(version):
+    """
+    Returns a tuple that compares the way PEP 440 orders versions. The
+    first element is 1 for valid PEP 440 versions and 0 for anything else,
+    so the two kinds never get compared field by field.
+
+    Within a valid version, each optional segment is encoded as a tuple
+    whose first element puts 'missing' in the right place relative to
+    'present': no pre-release sorts after any pre-release (unless it's a
+    bare dev release, which sorts before them), no post release before
+    any, no dev release after any.
+
+    """
+    match = VERSION_PATTERN.match(version)
+    if match is None:
+        return (0, tuple(re.split(r'[-_.]+', version.lower())))
+
+    epoch = int(match.group('epoch') or 0)
+
+    release = [int(i) for i in match.group('release').split('.')]
+    while len(release) > 1 and release[-1] == 0:
+        release.pop()
+
+    if match.group('pre'):
+        pre = (1, PRE_LABELS[match.group('pre_l').lower()],
+               int(match.group('pre_n') or 0))
+    elif match.group('dev') and not match.group('post'):
+        pre = (0,)
+    else:
+        pre = (2,)
+
+    if match.group('post'):
+        post = (1, int(match.group('post_n1') or match.group('post_n2') or 0))
+    else:
+        post = (0,)
+
+    if match.group('dev'):
+        dev = (0, int(match.group('dev_n') or 0))
+    else:
+        dev = (1,)
+
+    if match.group('local'):
+        local = (1, tuple((1, int(part), '') if part.isdigit()
+                          else (0, 0, part.lower())
+                          for part in re.split(r'[-_.]', match.group('local'))))
+    else:
+        local = (0,)
+
+    return (1, epoch, tuple(release), pre, post, dev, local)
+
+
+def is_prerelease(version):
+    match = VERSION_PATTERN.match(version)
+    return match is None or bool(match.group('pre') or match.group('dev'))
+
+
+class ReleaseIndex(object):
+    """
+    One project's versions, kept sorted oldest to newest as they're added.
+    Each version is parsed once, on the way in. latest() and
+    latest_stable() are O(1); add() and remove() are a binary search plus
+    a list insert.
+
+    'serial' is for the owner to record what state of the data store the
+    index reflects.
+
+    """
+
+    def __init__(self, versions=(), serial=None):
+        self.serial = serial
+        self.entries = sorted((parse_version(v), v) for v in set(versions))
+        self.stable = [e for e in self.entries if not is_prerelease(e[1])]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, version):
+        entry = (parse_version(version), version)
+        i = bisect.bisect_left(self.entries, entry)
+        return i < len(self.entries) and self.entries[i] == entry
+
+    def add(self, version):
+        entry = (parse_version(version), version)
+        i = bisect.bisect_left(self.entries, entry)
+        if i < len(self.entries) and self.entries[i] == entry:
+            return
+        self.entries.insert(i, entry)
+        if not is_prerelease(version):
+            bisect.insort(self.stable, entry)
+
+    def remove(self, version):
+        entry = (parse_version(version), version)
+        for entries in (self.entries, self.stable):
+            i = bisect.bisect_left(entries, entry)
+            if i < len(entries) and entries[i] == entry:
+                del entries[i]
+
+    def latest(self):
+        if self.entries:
+            return self.entries[-1][1]
+
+    def latest_stable(self):
+        if self.stable:
+            return self.stable[-1][1]
+
+    def newest_first(self):
+        return [v for k, v in reversed(self.entries)]
@@ -0,0 +1,486 @@
+"""
+Watching PackageDirs for files that arrive, change or go away other than
+by upload: rsync runs, copies by hand, clean-ups. Without this they only
+show up at the next periodic rescan.
+
+On Linux, that's inotify (through ctypes), with a watch on each
+PackageDirs root and on each project directory in them, and on the
+fan-out directories core.storage's sharded layout puts around those.
+Elsewhere, or if
+inotify can't be set up (say the watch limit is too low for the tree),
+the project directories and loose files are polled for changes every
+settings['watch_poll_interval'] seconds instead.
+
+Changes are applied a project at a time, once settings['watch_delay']
+seconds pass without another (but no more than MAX_WATCH_DELAY seconds
+after the first), so a bulk copy comes out as one rescan per project
+rather than one per file. The project is re-read into the index, the
+metadata store forgets files that have gone, and files it doesn't know
+about go to the MetadataExtractor to be recorded.
+
+With a shared index, one worker watches for all of them: whichever holds
+the watch lock. The others try for it every ELECTION_INTERVAL seconds,
+so if that worker goes away, another takes over. Walking PackageDirs to
+set up the watches (or the first snapshot) is done on the IOExecutor,
+since a standby taking over is serving requests already.
+
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+import tornado.gen
+import tornado.ioloop
+
+from MinistryOfPackages.core.dao import pypi_data
+from MinistryOfPackages.core.distmeta import metadata_extractor, try_lock
+from MinistryOfPackages.core.executor import io_executor
+from MinistryOfPackages.core.index import (METADATA_SUFFIX, is_distribution,
+                                           is_fanout, normalize_name,
+                                           split_filename)
+
+DEFAULT_WATCH_DELAY = 1
+DEFAULT_WATCH_POLL_INTERVAL = 10
+
+# However busy PackageDirs is, changes wait no longer than this.
+MAX_WATCH_DELAY = 10
+
+# Seconds between a standby worker's attempts to take over watching.
+ELECTION_INTERVAL = 5
+
+WATCH_LOCK = 'var/watcher.lock'
+
+# From <sys/inotify.h>.
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE)
+
+# wd, mask, cookie, name length
+EVENT = struct.Struct('iIII')
+
+READ_SIZE = 64 * 1024
+
+
+class Inotify(object):
+    """
+    An inotify instance. Raises OSError (or AttributeError, where libc
+    has no inotify) if one can't be had.
+
+    """
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self.raise_error()
+        self.paths = {}
+
+    def raise_error(self, path=None):
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code), path)
+
+    def add(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            self.raise_error(path)
+        self.paths[wd] = path
+
+    def read(self):
+        """
+        (directory, name, mask) for each event waiting. directory is None
+        for an IN_Q_OVERFLOW.
+
+        """
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except OSError as out:
+            if out.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            events.append((self.paths.get(wd), name, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def project_of(roots, directory):
+    """
+    The name of the project whose files are in 'directory', or None if
+    it's a root or a fan-out directory holding project directories.
+
+    """
+    for root in roots:
+        if directory.startswith(root + os.sep):
+            parts = [part for part in directory[len(root) + 1:].split(os.sep)
+                     if not is_fanout(part)]
+            return parts[0] if parts else None
+    return None
+
+
+def watched_dirs(roots, directory):
+    """
+    The directories under 'directory' that hold projects or files, down
+    to the ones holding files, as scandir() entries.
+
+    """
+    found = []
+    try:
+        entries = list(scandir(directory))
+    except OSError:
+        return found
+    holds_projects = project_of(roots, directory) is None
+    for entry in entries:
+        if (entry.name.startswith('.') or entry.is_symlink() or
+                not entry.is_dir()):
+            continue
+        if holds_projects or is_fanout(entry.name):
+            found.append(entry)
+            found.extend(watched_dirs(roots, entry.path))
+    return found
+
+
+def gone_files(before, found):
+    """
+    (project name, filename) for each file the projects in 'found' had in
+    'before' and don't any more.
+
+    """
+    gone = []
+    for normalized, project in found.items():
+        old = before.get(normalized)
+        if old is None:
+            continue
+        gone.extend((old.name, filename) for filename in
+                    set(old.files) - set(project.files if project else ()))
+    return gone
+
+
+def take_snapshot(roots):
+    """
+    {path: (mtime, inode, project)} for every project directory (and
+    fan-out directory in one) and loose file in 'roots', where project
+    is the name of the project the directory holds files of, or None for
+    a file. A directory's mtime changes whenever a file in it is added,
+    removed or renamed over.
+
+    """
+    snapshot = {}
+    for root in roots:
+        try:
+            entries = list(scandir(root))
+        except OSError:
+            continue
+        for entry in entries:
+            if (entry.name.startswith('.') or entry.is_symlink() or
+                    entry.is_dir()):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            snapshot[entry.path] = (st.st_mtime, st.st_ino, None)
+        for entry in watched_dirs(roots, root):
+            project = project_of(roots, entry.path)
+            if project is None:
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            snapshot[entry.path] = (st.st_mtime, st.st_ino, project)
+    return snapshot
+
+
+class PackageWatcher(object):
+
+    def __init__(self, data, executor, extractor, delay, poll_interval,
+                 lock_path):
+        self.data = data
+        self.index = data.index
+        self.executor = executor
+        # A core.distmeta.MetadataExtractor, or None.
+        self.extractor = extractor
+        self.delay = delay
+        self.poll_interval = poll_interval
+        self.lock_path = lock_path
+        self.roots = [os.path.join(self.index.base_path, root)
+                      for root in self.index.package_dirs]
+        self.lockfile = None
+        self.election = None
+        self.inotify = None
+        self.snapshot = None
+        self.polling = False
+        # Names of projects with changes waiting, as spelled on disk.
+        self.pending = set()
+        # Whether events were lost, so everything needs rescanning.
+        self.rescan = False
+        self.first = None
+        self.timeout = None
+        self.applying = False
+        self.io_loop = None
+
+    def start(self):
+        self.io_loop = tornado.ioloop.IOLoop.current()
+        if self.index.index_file is None:
+            # Every process has an index of its own to keep up to date.
+            self.io_loop.spawn_callback(self.watch)
+        elif not self.elect():
+            self.election = tornado.ioloop.PeriodicCallback(
+                self.elect, ELECTION_INTERVAL * 1000)
+            self.election.start()
+
+    def elect(self):
+        """
+        Start watching if the watch lock is free. Returns whether we are.
+
+        """
+        self.lockfile = try_lock(self.lock_path)
+        if self.lockfile is None:
+            return False
+        if self.election is not None:
+            self.election.stop()
+        self.io_loop.spawn_callback(self.watch)
+        return True
+
+    @tornado.gen.coroutine
+    def watch(self):
+        try:
+            self.inotify = Inotify()
+            yield self.executor.submit(self.add_watches)
+        except (AttributeError, OSError) as out:
+            if self.inotify is not None:
+                self.inotify.close()
+                self.inotify = None
+            if not self.poll_interval:
+                logging.warning("Can't watch PackageDirs: %s", out)
+                return
+            logging.warning("Can't watch PackageDirs (%s), polling every "
+                            "%ss instead", out, self.poll_interval)
+            self.snapshot = yield self.executor.submit(take_snapshot,
+                                                       self.roots)
+            tornado.ioloop.PeriodicCallback(
+                self.poll, self.poll_interval * 1000).start()
+            return
+        self.io_loop.add_handler(self.inotify.fd, self.on_events,
+                                 tornado.ioloop.IOLoop.READ)
+        logging.info("Watching PackageDirs: %d directories",
+                     len(self.inotify.paths))
+
+    def add_watches(self):
+        """
+        Watch every root and the directories under it. This is for the
+        IOExecutor, before the inotify fd is handed to the IOLoop.
+
+        """
+        for root in self.roots:
+            try:
+                self.inotify.add(root)
+            except OSError as out:
+                if out.errno != errno.ENOENT:
+                    raise
+                logging.error("Can't watch missing package dir %s", root)
+                continue
+            for entry in watched_dirs(self.roots, root):
+                self.inotify.add(entry.path)
+
+    def on_events(self, fd, events):
+        for directory, name, mask in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                self.rescan = True
+            elif directory is None or name.startswith('.'):
+                # Temp files, from uploads and rsync alike, are named so.
+                continue
+            elif not mask & IN_ISDIR:
+                self.file_changed(name, project_of(self.roots, directory))
+            else:
+                path = os.path.join(directory, name)
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.io_loop.spawn_callback(self.directory_added, path)
+                project = project_of(self.roots, path)
+                if project is not None:
+                    self.pending.add(project)
+        self.schedule()
+
+    @tornado.gen.coroutine
+    def directory_added(self, path):
+        """
+        Watch a new directory and what's under it, which is walked on the
+        IOExecutor. Anything in it already got there before the watch did,
+        so its projects are rescanned.
+
+        """
+        added = yield self.executor.submit(self.add_watches_under, path)
+        for entry in added:
+            project = project_of(self.roots, entry.path)
+            if project is not None:
+                self.pending.add(project)
+        self.schedule()
+
+    def add_watches_under(self, path):
+        """
+        Watch 'path' and the directories under it, returning those that
+        are watched now.
+
+        """
+        added = []
+        try:
+            self.inotify.add(path)
+            for entry in watched_dirs(self.roots, path):
+                self.inotify.add(entry.path)
+                added.append(entry)
+        except OSError as out:
+            logging.error("Can't watch %s: %s", path, out)
+        return added
+
+    def file_changed(self, filename, project_name=None):
+        if filename.endswith(METADATA_SUFFIX):
+            filename = filename[:-len(METADATA_SUFFIX)]
+        if not is_distribution(filename):
+            return
+        if project_name is None:
+            project_name = split_filename(filename)[0]
+        if project_name:
+            self.pending.add(project_name)
+
+    @tornado.gen.coroutine
+    def poll(self):
+        if self.polling:
+            return
+        self.polling = True
+        try:
+            snapshot = yield self.executor.submit(take_snapshot, self.roots)
+        finally:
+            self.polling = False
+        for path in set(snapshot) | set(self.snapshot):
+            old, new = self.snapshot.get(path), snapshot.get(path)
+            if old == new:
+                continue
+            project = (old or new)[2]
+            if project is not None:
+                self.pending.add(project)
+            else:
+                self.file_changed(os.path.basename(path))
+        self.snapshot = snapshot
+        self.schedule()
+
+    def schedule(self):
+        if not self.pending and not self.rescan:
+            return
+        now = time.time()
+        if self.first is None:
+            self.first = now
+        if self.timeout is not None:
+            self.io_loop.remove_timeout(self.timeout)
+        self.timeout = self.io_loop.add_timeout(
+            min(now + self.delay, self.first + MAX_WATCH_DELAY), self.apply)
+
+    @tornado.gen.coroutine
+    def apply(self):
+        self.timeout = None
+        if self.applying:
+            # These wait for the last lot to be done.
+            self.schedule()
+            return
+        names, self.pending = self.pending, set()
+        rescan, self.rescan = self.rescan, False
+        self.first = None
+
+        self.applying = True
+        try:
+            if rescan:
+                logging.warning("Missed changes to PackageDirs, rescanning")
+                # A shared index's generations never change; our own one
+                # is changed in place by uploads.
+                before = self.index.projects
+                if isinstance(before, dict):
+                    before = dict(before)
+                yield self.index.scan_on(self.executor)
+                # The rescan has files the metadata store doesn't know
+                # about recorded, but that still has to forget the ones
+                # that have gone.
+                after = self.index.projects
+                gone = yield self.executor.submit(
+                    lambda: gone_files(before, dict(
+                        (normalized, after.get(normalized))
+                        for normalized in before)))
+                self.forget(gone)
+                return
+            before = dict((normalize_name(name), self.index.find(name))
+                          for name in names)
+            found = yield self.executor.submit(self.index.read_projects,
+                                               names)
+            self.index.replace_projects(found)
+            self.record(before, found)
+            logging.debug("Applied changes to %d projects", len(found))
+        except (IOError, OSError) as out:
+            logging.error("Applying changes to PackageDirs: %s", out)
+        finally:
+            self.applying = False
+
+    def record(self, before, found):
+        """
+        Bring the metadata store into line with the projects in 'found',
+        which were 'before' in the index until just now.
+
+        """
+        self.forget(gone_files(before, found))
+        found = dict((normalized, project)
+                     for normalized, project in found.items() if project)
+        if self.extractor is not None and found:
+            self.extractor.catch_up(self.data, found)
+
+    def forget(self, gone):
+        for project_name, filename in gone:
+            self.data.remove_pkg_file(project_name, filename)
+
+
+def package_watcher(application):
+    """
+    The application's PackageWatcher, or None if settings['watch_delay']
+    is 0.
+
+    """
+    watcher = getattr(application, 'package_watcher', None)
+    if watcher is None:
+        settings = application.settings
+        delay = settings.get('watch_delay', DEFAULT_WATCH_DELAY)
+        if not delay:
+            return None
+        watcher = PackageWatcher(
+            pypi_data(application), io_executor(application),
+            metadata_extractor(application), delay,
+            settings.get('watch_poll_interval', DEFAULT_WATCH_POLL_INTERVAL),
+            os.path.join(settings['base_path'], WATCH_LOCK))
+        application.package_watcher = watcher
+    return watcher
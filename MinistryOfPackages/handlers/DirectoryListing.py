@@ -1,9 +1,98 @@
+import tornado.gen
+import tornado.iostream
 import tornado.web
+import functools
 import os
-from os.path import normpath, join, isdir, islink, exists, basename
+from os.path import normpath, join, islink, exists, basename
 import mimetypes
 import logging
+import stat
 import time
+import uuid
+
+from MinistryOfPackages.core import httpcache
+from MinistryOfPackages.core.admission import (DOWNLOADS, Overloaded,
+                                               admission_control, refuse)
+from MinistryOfPackages.core.cache import LRUCache
+from MinistryOfPackages.core.executor import io_executor
+from MinistryOfPackages.core.index import METADATA_SUFFIX, package_index
+
+# How much of a file we read and send at a time.
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# Multi-range requests asking for more pieces than this get the whole file.
+MAX_RANGES = 64
+
+# Number of rendered listings kept per process.
+DEFAULT_LISTING_CACHE_SIZE = 256
+
+# Directories modified more recently than this many seconds ago aren't
+# cached. mtime granularity can be as coarse as a second or two, so a
+# change made right after we rendered could otherwise leave the mtime (and
+# our cached page) looking current.
+RACY_MTIME_WINDOW = 2
+
+
+def read_at(f, position, size):
+    """
+    Read up to 'size' bytes of 'f' from 'position'. Seeking and reading in
+    one call keeps them together on whichever pool thread runs it.
+
+    """
+    f.seek(position)
+    return f.read(size)
+
+
+def parse_range_header(value, size):
+    """
+    Turn a 'Range: bytes=...' header value into a sorted list of
+    (start, end) pairs, end exclusive, for a file of 'size' bytes.
+    Overlapping and adjacent ranges are merged.
+
+    Returns None if the header is malformed or not a byte range, in which
+    case it should be ignored and the whole file sent. Returns an empty list
+    if it's well-formed but nothing in it can be satisfied (a 416).
+
+    """
+    unit, _, spec = value.partition('=')
+    if unit.strip() != 'bytes' or not spec:
+        return None
+
+    ranges = []
+    for piece in spec.split(','):
+        first, dash, last = piece.strip().partition('-')
+        if not dash or not (first or last):
+            return None
+        # Not int() alone, which would take signs and spaces.
+        if not all(n.isdigit() for n in (first, last) if n):
+            return None
+        first = int(first) if first else None
+        last = int(last) if last else None
+
+        if first is None:
+            # bytes=-N is the last N bytes.
+            if last == 0:
+                continue
+            start, end = max(size - last, 0), size
+        else:
+            if last is not None and last < first:
+                return None
+            start = first
+            end = size if last is None else min(last + 1, size)
+        if start >= size:
+            continue
+        ranges.append((start, end))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
 
 
 class DirectoryListingHandler(tornado.web.RequestHandler):
@@ -22,9 +111,53 @@ class DirectoryListingHandler(tornado.web.RequestHandler):
     at filetype. In the future I'll try to import the python-magic module or
     similar & fall back to mimetypes. Patches welcome :)
 
+    Files get strong ETags and listings weak ones (see core.httpcache), and
+    conditional requests that still match get a 304. Cache-Control comes
+    from the 'artifacts' and 'listings' policies in settings['CacheControl'].
+
+    Rendered listings are kept in an LRU cache (application.listing_cache,
+    settings['listing_cache_size'] entries), checked against the same stat
+    info the ETag comes from, so a repeat hit on an unchanged directory
+    skips the directory walk and the template render. Each worker's hits,
+    misses and evictions are on /metrics.
+
+    Files are sent a chunk at a time (settings['download_chunk_size'] bytes,
+    64k by default), flushing between chunks, so a big download only ever
+    has one chunk in memory and doesn't hog the IOLoop. Range requests,
+    including multi-range, get 206 responses, and HEAD requests never read
+    the file. Sending the body has to be admitted to the 'downloads' lane
+    of core.admission first, for as many bytes as there are to send.
+
+    Every stat, listdir, open and read happens on the IOExecutor's threads
+    (see core.executor), never on the IOLoop.
+
     """
 
-    def get(self, directory):
+    def compute_etag(self):
+        """
+        We set our own validators from stat info, which is far cheaper than
+        Tornado's default of hashing the whole response body.
+
+        """
+        return None
+
+    @property
+    def listing_cache(self):
+        cache = getattr(self.application, 'listing_cache', None)
+        if cache is None:
+            metrics = getattr(self.application, 'worker_metrics', None)
+            cache = LRUCache(
+                self.application.settings.get('listing_cache_size',
+                                              DEFAULT_LISTING_CACHE_SIZE),
+                metrics and functools.partial(metrics.cache, 'listing'))
+            self.application.listing_cache = cache
+        return cache
+
+    def head(self, directory):
+        return self.get(directory, include_body=False)
+
+    @tornado.gen.coroutine
+    def get(self, directory, include_body=True):
         """
         If the requested path isn't under one of the directories in
         our config's PackageDirs list, or doesn't exist, we return a 404.
@@ -38,14 +171,17 @@ class DirectoryListingHandler(tornado.web.RequestHandler):
 
         """
 
-        valid_request = self.checkpath(directory)
+        executor = io_executor(self.application)
+        directory = self.locate(directory)
+        valid_request = yield executor.submit(self.checkpath, directory)
         uri_path = directory
         disk_path = self.get_fullpath(directory)
         if valid_request:
             # If the path didn't exist or wasn't under PackageDirs, we would've
             # already returned an HTTPError from checkpath.
-            if not isdir(disk_path):
-                self.return_file(disk_path)
+            st = yield executor.submit(os.stat, disk_path)
+            if not stat.S_ISDIR(st.st_mode):
+                yield self.return_file(disk_path, include_body, st)
             else:
                 # it's a directory. Try to provide a basic directory listing.
 
@@ -53,9 +189,8 @@ class DirectoryListingHandler(tornado.web.RequestHandler):
                 # 'parent directory' link in the browser output.
                 root_dirs = [self.get_fullpath(d) for d in \
                              self.application.settings['PackageDirs']]
-                allentries = os.listdir(disk_path)
-                dlist = [(x, os.lstat(normpath(join(disk_path, x)))) for x in \
-                                                                    allentries]
+                dir_stat = st
+                validators = [dir_stat]
                 pardir = None
 
                 # if we're not requesting a base root_dir, there's a parent
@@ -63,22 +198,81 @@ class DirectoryListingHandler(tornado.web.RequestHandler):
                 if normpath(disk_path) not in root_dirs:
                     parent_directory = normpath(join(uri_path, '..'))
                     parent_fullpath = self.get_fullpath(parent_directory)
+                    parent_st = yield executor.submit(os.stat,
+                                                      parent_fullpath)
+                    validators.append(parent_st)
                     parent_stat = time.asctime(time.localtime(
-                                            os.stat(parent_fullpath).st_mtime))
+                                            parent_st.st_mtime))
                     pardir = [(parent_directory, parent_stat)]
 
-                # filter statinfo to only (name, mtime) for each dir entry.
-                output_entries = [(x, time.asctime(time.localtime(
-                    y.st_mtime))) for x, y in dlist]
-                page_title = "Listing of directory '%s'" % uri_path
-                self.render("dlist.html", title=page_title,
-                            entries=output_entries, directory=uri_path,
-                            pardir=pardir)
+                etag = httpcache.listing_etag(*validators)
+                if httpcache.set_cache_headers(
+                        self, 'listings', etag,
+                        max(st.st_mtime for st in validators)):
+                    return
+
+                cache_key = uri_path
+                page = self.listing_cache.get(cache_key, etag)
+                if page is None:
+                    entries = yield executor.submit(self.list_directory,
+                                                    disk_path)
+                    page = self.render_listing(uri_path, entries, pardir)
+                    if time.time() - dir_stat.st_mtime > RACY_MTIME_WINDOW:
+                        self.listing_cache.put(cache_key, etag, page)
+                self.finish(page)
+
+    def locate(self, directory):
+        """
+        Files asked for as <PackageDirs entry>/<project>/<filename> are
+        found wherever the package index says they are, which with
+        core.storage's sharded layout is somewhere else, maybe under
+        another entry. Returns the path to serve.
+
+        """
+        for root in self.application.settings['PackageDirs']:
+            if directory.startswith(root.rstrip('/') + '/'):
+                break
+        else:
+            return directory
+        rest = directory[len(root):].strip('/')
+        project_name, _, filename = rest.partition('/')
+        if not filename or '/' in filename:
+            return directory
+        suffix = ''
+        if filename.endswith(METADATA_SUFFIX):
+            filename = filename[:-len(METADATA_SUFFIX)]
+            suffix = METADATA_SUFFIX
+        project = package_index(self.application).find(project_name)
+        dist = project and project.files.get(filename)
+        if dist is None:
+            return directory
+        return dist.url[1:] + suffix
+
+    def list_directory(self, disk_path):
+        """
+        (name, mtime) for each entry in the directory. This is the part of
+        a listing that touches the disk.
+
+        """
+        allentries = os.listdir(disk_path)
+        dlist = [(x, os.lstat(normpath(join(disk_path, x)))) for x in \
+                                                            allentries]
+
+        # filter statinfo to only (name, mtime) for each dir entry.
+        return [(x, time.asctime(time.localtime(y.st_mtime)))
+                for x, y in dlist]
+
+    def render_listing(self, uri_path, output_entries, pardir):
+        page_title = "Listing of directory '%s'" % uri_path
+        return self.render_string("dlist.html", title=page_title,
+                                  entries=output_entries, directory=uri_path,
+                                  pardir=pardir)
 
     def checkpath(self, requested_path):
         """
         Check that the requested path lives under one of the configured
-        PackageDirs, that it exists, and that it's not a symlink.
+        PackageDirs, that it exists, and that it's not a symlink. This hits
+        the disk, so get() runs it on the IOExecutor.
 
         """
         valid = [normpath(requested_path).startswith(i) for i in \
@@ -102,12 +296,16 @@ class DirectoryListingHandler(tornado.web.RequestHandler):
         fullpath = join(self.application.settings['base_path'], req)
         return fullpath
 
-    def return_file(self, requested_file):
+    @tornado.gen.coroutine
+    def return_file(self, requested_file, include_body=True, st=None):
         """
         The requested path is a file, not a dir.  Make a best effort at
-        figuring out what kind of file it is, and send it along.
+        figuring out what kind of file it is, and send it along, or just the
+        parts of it the client asked for. 'st' is the file's stat result, if
+        the caller already has it.
 
         """
+        executor = io_executor(self.application)
         ftype_enc = mimetypes.guess_type(requested_file)
 
         if None not in ftype_enc:
@@ -116,9 +314,105 @@ class DirectoryListingHandler(tornado.web.RequestHandler):
         else:
             content_type = 'application/octet-stream'
 
-        self.set_header('Content-Type', content_type)
+        if st is None:
+            st = yield executor.submit(os.stat, requested_file)
+        size = st.st_size
+        etag = httpcache.file_etag(st)
+        self.set_header('Accept-Ranges', 'bytes')
         self.set_header('Content-Disposition',
                         'attachment; filename=%s' % basename(requested_file))
+        if httpcache.set_cache_headers(self, 'artifacts', etag, st.st_mtime):
+            return
 
-        f = open(requested_file, 'r').read()
-        self.write(f)
+        ranges = None
+        if ('Range' in self.request.headers and
+                httpcache.if_range_matches(self.request.headers, etag,
+                                           st.st_mtime)):
+            ranges = parse_range_header(self.request.headers['Range'], size)
+
+        if ranges == []:
+            self.set_status(416)
+            self.set_header('Content-Type', content_type)
+            self.set_header('Content-Range', 'bytes */%d' % size)
+            return
+
+        trailer = None
+        if not ranges:
+            # No (usable) Range header, so it's the whole thing.
+            length = size
+            self.set_header('Content-Type', content_type)
+            self.set_header('Content-Length', length)
+            parts = [(None, 0, size)]
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            length = end - start
+            self.set_status(206)
+            self.set_header('Content-Type', content_type)
+            self.set_header('Content-Range',
+                            'bytes %d-%d/%d' % (start, end - 1, size))
+            self.set_header('Content-Length', length)
+            parts = [(None, start, end)]
+        else:
+            boundary = uuid.uuid4().hex
+            parts = [('--%s\r\nContent-Type: %s\r\n'
+                      'Content-Range: bytes %d-%d/%d\r\n\r\n' %
+                      (boundary, content_type, start, end - 1, size),
+                      start, end) for start, end in ranges]
+            trailer = '--%s--\r\n' % boundary
+            length = sum(len(hdr) + end - start + 2 for hdr, start, end in
+                         parts) + len(trailer)
+            self.set_status(206)
+            self.set_header('Content-Type',
+                            'multipart/byteranges; boundary=%s' % boundary)
+            self.set_header('Content-Length', length)
+
+        if not include_body:
+            return
+
+        try:
+            permit = yield admission_control(self.application).acquire(
+                DOWNLOADS, length)
+        except Overloaded as out:
+            refuse(self, out)
+            return
+        try:
+            yield self.send_parts(requested_file, parts, trailer)
+        finally:
+            permit.release()
+
+    @tornado.gen.coroutine
+    def send_parts(self, requested_file, parts, trailer=None):
+        """
+        Send 'parts', (part header or None, start, end) for each piece of
+        the file to send, and the multipart 'trailer' if there's one.
+
+        """
+        executor = io_executor(self.application)
+        chunk_size = self.application.settings.get('download_chunk_size',
+                                                   DEFAULT_CHUNK_SIZE)
+        f = yield executor.submit(open, requested_file, 'rb')
+        try:
+            for part_header, start, end in parts:
+                if part_header is not None:
+                    self.write(part_header)
+                position = start
+                while position < end:
+                    chunk = yield executor.submit(
+                        read_at, f, position, min(chunk_size, end - position))
+                    if not chunk:
+                        # File shrank underneath us. Nothing sensible to
+                        # send; the client will see a short body.
+                        logging.error("Short read on %s", requested_file)
+                        return
+                    position += len(chunk)
+                    self.write(chunk)
+                    yield self.flush()
+                if part_header is not None:
+                    self.write('\r\n')
+            if len(parts) > 1:
+                self.write(trailer)
+        except tornado.iostream.StreamClosedError:
+            logging.debug("Client went away during download of %s",
+                          requested_file)
+        finally:
+            f.close()
@@ -0,0 +1,18 @@
+import tornado.web
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    Request metrics for the whole server, every worker's numbers added
+    together, in the Prometheus text format. Any worker can answer, since
+    they all share the numbers (see core.metrics).
+
+    """
+
+    def get(self):
+        metrics = getattr(self.application, 'metrics', None)
+        if metrics is None:
+            raise tornado.web.HTTPError(404)
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.set_header('Cache-Control', 'no-cache')
+        self.write(metrics.render())
@@ -0,0 +1,175 @@
+import tornado.gen
+import tornado.iostream
+import tornado.web
+import logging
+import mimetypes
+import urllib
+
+from MinistryOfPackages.core.executor import io_executor
+from MinistryOfPackages.core.index import Project, is_safe_name, package_index
+from MinistryOfPackages.core.proxy import UpstreamError, upstream_index
+from DirectoryListing import DirectoryListingHandler, DEFAULT_CHUNK_SIZE
+from PyPI import SimpleIndexHandler
+
+# data-* attributes from upstream links we pass along. Anything promising
+# extra files (like PEP 658 metadata) is left off, since we don't proxy those.
+PASSED_ATTRS = ('data-requires-python', 'data-yanked', 'data-gpg-sig')
+
+
+class ProxiedFile(object):
+    """
+    An upstream file, as it appears on one of our project pages: the link
+    points at ProxyFileHandler rather than upstream.
+
+    """
+
+    def __init__(self, normalized, link):
+        self.filename = link.filename
+        self.url = '/proxy/files/%s/%s' % (normalized,
+                                           urllib.quote(link.filename))
+        self.href = self.url
+        if link.fragment:
+            self.href += '#' + link.fragment
+        self.attrs = [(k, v) for k, v in sorted(link.attrs.items())
+                      if k in PASSED_ATTRS]
+
+    def link_attrs(self):
+        return self.attrs
+
+
+class ProxyHandler(SimpleIndexHandler):
+    """
+    A simple index that falls back to an upstream one. Projects we have
+    are served from the local index exactly as SimpleIndexHandler would;
+    for anything else we serve upstream's file list, with the links
+    pointing at ProxyFileHandler so the files get cached here on the way
+    through. Upstream is configured under settings['Proxy'].
+
+    """
+
+    @tornado.gen.coroutine
+    def get(self, package=None, version=None):
+        if (not package or not self.request.path.endswith('/') or
+                package_index(self.application).find(package) is not None):
+            super(ProxyHandler, self).get(package, version)
+            return
+
+        project = Project(package)
+        if package != project.normalized:
+            self.redirect('/simple/%s/' % project.normalized, permanent=True)
+            return
+
+        try:
+            links = yield upstream_index(self.application).get_links(package)
+        except UpstreamError as out:
+            logging.error("Upstream page for %s: %s", package, out)
+            raise tornado.web.HTTPError(404 if out.code == 404 else 502)
+
+        self.render("simple_project.html", project=project,
+                    files=[ProxiedFile(project.normalized, link)
+                           for link in links])
+
+
+class ProxyFileHandler(DirectoryListingHandler):
+    """
+    Files from the upstream index, served from the proxy cache if they're
+    there, otherwise streamed to the client as they come in from upstream
+    (and cached at the same time). Any number of clients asking for the
+    same uncached file share a single upstream download.
+
+    """
+
+    @tornado.gen.coroutine
+    def get(self, package, filename, include_body=True):
+        # Route groups are URL-decoded after matching, so an encoded '/'
+        # gets this far.
+        if not is_safe_name(filename):
+            raise tornado.web.HTTPError(404)
+
+        upstream = upstream_index(self.application)
+        try:
+            path, fetch = yield upstream.get_file(package, filename)
+        except UpstreamError as out:
+            logging.error("Upstream file %s/%s: %s", package, filename, out)
+            raise tornado.web.HTTPError(404 if out.code == 404 else 502)
+
+        if path is not None:
+            yield self.return_file(path, include_body)
+        else:
+            yield self.stream_fetch(upstream, fetch, include_body)
+
+    def head(self, package, filename):
+        return self.get(package, filename, include_body=False)
+
+    @tornado.gen.coroutine
+    def stream_fetch(self, upstream, fetch, include_body):
+        """
+        Follow a Fetch that's in progress: send what's already in its temp
+        file, then wait for more until it's finished. The last chunk is
+        held back until the file's sha256 has been checked, so one that
+        doesn't match never gets to the client whole: it gets a 502 if
+        nothing's been sent yet, and is cut off otherwise.
+
+        """
+        try:
+            f = open(fetch.tmp_path, 'rb')
+        except IOError:
+            # It finished (and was moved into the cache) before we got here.
+            path = upstream.cache.lookup(fetch.key)
+            if path is None:
+                raise tornado.web.HTTPError(502)
+            yield self.return_file(path, include_body)
+            return
+
+        with f:
+            try:
+                code = yield fetch.headers
+            except UpstreamError:
+                raise tornado.web.HTTPError(502)
+            if code != 200:
+                raise tornado.web.HTTPError(404 if code == 404 else 502)
+
+            content_type = mimetypes.guess_type(fetch.link.filename)[0]
+            self.set_header('Content-Type',
+                            content_type or 'application/octet-stream')
+            self.set_header('Content-Disposition',
+                            'attachment; filename=%s' % fetch.link.filename)
+            if fetch.length is not None:
+                self.set_header('Content-Length', fetch.length)
+            if not include_body:
+                return
+
+            chunk_size = self.application.settings.get('download_chunk_size',
+                                                       DEFAULT_CHUNK_SIZE)
+            executor = io_executor(self.application)
+            offset = 0
+            try:
+                while True:
+                    if fetch.finished and fetch.error is None:
+                        sendable = fetch.received
+                    else:
+                        sendable = fetch.received - chunk_size
+                    if offset < sendable:
+                        chunk = yield executor.submit(
+                            f.read, min(chunk_size, sendable - offset))
+                        offset += len(chunk)
+                        self.write(chunk)
+                        yield self.flush()
+                    elif fetch.finished:
+                        break
+                    else:
+                        yield fetch.progress.wait()
+            except tornado.iostream.StreamClosedError:
+                logging.debug("Client went away during proxied download of "
+                              "%s", fetch.link.filename)
+                return
+
+            if fetch.error is None:
+                return
+            logging.error("Proxied download of %s failed part way: %s",
+                          fetch.link.filename, fetch.error)
+            if not offset:
+                raise tornado.web.HTTPError(502)
+            # Headers are long gone; all we can do is cut the client off so
+            # it can see the body is short.
+            self.request.connection.close()
@@ -1,5 +1,14 @@
+import json
+
 import tornado.web
 
+from MinistryOfPackages.core import httpcache
+from MinistryOfPackages.core.dao import pypi_data
+from MinistryOfPackages.core.index import normalize_name
+from MinistryOfPackages.core.jsonapi import json_api
+from MinistryOfPackages.core.search import (DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE,
+                                            search_index)
+
 
 class PyPIHandler(tornado.web.RequestHandler):
     """
@@ -39,3 +48,118 @@ class PyPIHandler(tornado.web.RequestHandler):
 
         """
         self.write("Welcome to the Ministry of Packages")
+
+
+class SimpleIndexHandler(PyPIHandler):
+    """
+    The PEP 503 'simple' repository API that pip and friends actually use:
+
+    /simple/            links to every project
+    /simple/<project>/  links to every file for that project
+
+    Everything comes out of the PackageIndex, so a page is a lookup and a
+    template render, with no data store access. A shared index_file is
+    mapped, and stat()ed every GENERATION_CHECK_INTERVAL seconds to see
+    if there's a newer generation; otherwise it's all in memory. Project
+    names are matched case-insensitively per PEP 503, and requests for
+    anything but the normalized name are redirected to it.
+
+    """
+
+    def get(self, package=None, version=None):
+        # Going through pypi_data gets us the index with file digests
+        # hooked up, for the links' #sha256= fragments.
+        index = pypi_data(self.application).index
+
+        if not self.request.path.endswith('/'):
+            self.redirect(self.request.path + '/', permanent=True)
+            return
+
+        policy = httpcache.cache_control(self.application.settings, 'simple')
+        if policy:
+            self.set_header('Cache-Control', policy)
+
+        if not package:
+            self.render("simple_index.html",
+                        projects=index.sorted_projects())
+            return
+
+        project = index.find(package)
+        if project is None:
+            raise tornado.web.HTTPError(404)
+        if package != project.normalized:
+            self.redirect('/simple/%s/' % project.normalized, permanent=True)
+            return
+
+        self.render("simple_project.html", project=project,
+                    files=project.sorted_files())
+
+
+class ProjectJSONHandler(PyPIHandler):
+    """
+    PyPI's JSON API, for tooling that wants versions, files and metadata
+    without scraping HTML:
+
+    /pypi/<project>/json            the latest release, plus every release's
+                                    files
+    /pypi/<project>/<version>/json  just that release
+
+    Documents come serialized out of core.jsonapi's cache, so repeat
+    requests for an unchanged project don't rebuild them, and clients
+    revalidating with If-None-Match get a 304.
+
+    """
+
+    def compute_etag(self):
+        return None
+
+    def get(self, package=None, version=None):
+        entry = json_api(self.application).get(package, version)
+        if entry is None:
+            raise tornado.web.HTTPError(404)
+        body, etag, mtime = entry
+        self.set_header('Content-Type', 'application/json')
+        self.set_header('Access-Control-Allow-Origin', '*')
+        if httpcache.set_cache_headers(self, 'json', etag, mtime):
+            return
+        self.finish(body)
+
+
+class SearchHandler(PyPIHandler):
+    """
+    Search over release metadata, as JSON:
+
+    /search?q=<terms>&classifier=<classifier>&page=<n>&per_page=<n>
+
+    Every term in q and every classifier given (there can be several, and
+    a classifier matches everything under it) has to match. Results are
+    projects, best match first, each with the release that matched best.
+
+    """
+
+    def get(self, package=None, version=None):
+        query = self.get_argument('q', '')
+        classifiers = self.get_arguments('classifier')
+        if not query.strip() and not classifiers:
+            raise tornado.web.HTTPError(400, 'q or classifier is required')
+        try:
+            page = max(int(self.get_argument('page', 1)), 1)
+            per_page = min(max(int(self.get_argument('per_page',
+                                                     DEFAULT_PAGE_SIZE)), 1),
+                           MAX_PAGE_SIZE)
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'page and per_page are numbers')
+
+        total, found = search_index(self.application).search(
+            query, classifiers, (page - 1) * per_page, per_page)
+        # Not 'version', which a Python 2 list comprehension would rebind.
+        results = [{'name': name, 'version': found_version,
+                    'summary': summary, 'score': round(score, 3),
+                    'url': '/pypi/%s/%s/json' % (normalize_name(name),
+                                                found_version)}
+                   for score, name, found_version, summary in found]
+        self.set_header('Content-Type', 'application/json')
+        self.set_header('Access-Control-Allow-Origin', '*')
+        self.finish(json.dumps({'query': query, 'classifiers': classifiers,
+                                'total': total, 'page': page,
+                                'results': results}, sort_keys=True))
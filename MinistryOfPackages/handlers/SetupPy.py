@@ -1,19 +1,56 @@
+import tornado.gen
 import tornado.web
+import tornado.httputil
+import json
 import logging
 import os
 
-# This needs to be uncommented and the 'return True'
-# later on removed in order to enable the data model and
-# redis support.
-#db = dao.db
+from MinistryOfPackages.core.admission import (UPLOADS, Overloaded,
+                                               admission_control, refuse)
+from MinistryOfPackages.core.blobs import (blob_store, makedirs_for,
+                                           move_atomic, temp_beside)
+from MinistryOfPackages.core.bundle import (BundleError, TarStreamParser,
+                                            check_bundle, parse_manifest)
+from MinistryOfPackages.core.dao import pypi_data
+from MinistryOfPackages.core.distmeta import (metadata_extractor,
+                                              stage_metadata_file,
+                                              write_metadata_file)
+from MinistryOfPackages.core.executor import io_executor
+from MinistryOfPackages.core.export import static_export
+from MinistryOfPackages.core.index import (METADATA_SUFFIX, is_distribution,
+                                           is_safe_name, package_index)
+from MinistryOfPackages.core.multipart import (MultipartStreamParser,
+                                               MultipartError, get_boundary)
+from MinistryOfPackages.core.storage import artifact_storage
 
 __author__ = 'jonesy'
 
+# Tornado's default body limit is 100MB, which some of our sdists blow past.
+DEFAULT_MAX_UPLOAD_SIZE = 512 * 1024 * 1024
 
+DEFAULT_MAX_BATCH_SIZE = 4 * 1024 * 1024 * 1024
+
+TAR_TYPES = ('application/x-tar', 'application/tar')
+
+
+@tornado.web.stream_request_body
 class SetupPyHandler(tornado.web.RequestHandler):
     """
     This should handle the setup.py 'register' and 'upload' sub-commands.
 
+    The request body is streamed: data_received() hands each chunk to a
+    MultipartStreamParser as it arrives, so an upload never has to fit in
+    memory, and the IOLoop is free to serve other requests between chunks.
+    Parsing a chunk means writing it to the spool file, so that happens on
+    the IOExecutor (see core.executor), as does putting the finished file
+    in place; Tornado doesn't read the next chunk until the last one is
+    written.
+
+    Before any of the body is read, the upload has to be admitted to the
+    'uploads' lane of core.admission. Bodies bigger than
+    settings['max_upload_size'] are refused with a 413 up front, if they
+    say how big they are.
+
     """
 
     def initialize(self):
@@ -22,7 +59,105 @@ class SetupPyHandler(tornado.web.RequestHandler):
             'long_description',
             'summary',
             ':action']
+        self.parser = None
+        self.parse_error = None
+        self.body_chunks = []
+        # The last filesystem work handed to the IOExecutor for the spooled
+        # upload, which cleanup has to wait for.
+        self.pending = None
+        # From core.admission, once the upload's been let in.
+        self.permit = None
+
+    def max_body_size(self):
+        return self.application.settings.get('max_upload_size',
+                                             DEFAULT_MAX_UPLOAD_SIZE)
+
+    def make_parser(self, content_type, tmp_dir):
+        """
+        The streaming parser for a body of 'content_type', or None to
+        buffer the body and parse it as an ordinary form.
+
+        """
+        if content_type.startswith('multipart/form-data'):
+            boundary = get_boundary(content_type)
+            if not boundary:
+                raise tornado.web.HTTPError(400, 'No multipart boundary')
+            return MultipartStreamParser(boundary, tmp_dir=tmp_dir)
+        return None
+
+    @tornado.gen.coroutine
+    def prepare(self):
+        settings = self.application.settings
+        max_size = self.max_body_size()
+        self.request.connection.set_max_body_size(max_size)
+        try:
+            size = int(self.request.headers.get('Content-Length', 0))
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'Bad Content-Length')
+        if size > max_size:
+            raise tornado.web.HTTPError(413, 'Uploads are limited to %d bytes'
+                                        % max_size)
+
+        try:
+            self.permit = yield admission_control(self.application).acquire(
+                UPLOADS, size)
+        except Overloaded as out:
+            refuse(self, out)
+            return
+        if self.request.connection.stream.closed():
+            # They gave up while waiting.
+            self.permit.release()
+            return
+
+        tmp_dir = settings.get('upload_tmp_dir')
+        if tmp_dir:
+            tmp_dir = os.path.join(settings['base_path'], tmp_dir)
+        self.parser = self.make_parser(
+            self.request.headers.get('Content-Type', ''), tmp_dir)
+
+    def data_received(self, chunk):
+        if self.parse_error is not None:
+            return
+        if self.parser is None:
+            # Not multipart, so it's a small urlencoded form.
+            self.body_chunks.append(chunk)
+            return
+        self.pending = io_executor(self.application).submit(self.feed, chunk)
+        return self.pending
+
+    def feed(self, chunk):
+        try:
+            self.parser.feed(chunk)
+        except (MultipartError, BundleError) as out:
+            # Raising here would just drop the connection; hold on to it
+            # and send a proper 400 from post().
+            logging.error("Bad upload body: %s", out)
+            self.parse_error = out
+            self.parser.cleanup()
+
+    def cleanup(self):
+        """
+        Give up our place in the uploads lane, and remove the spooled
+        upload, if it's still there, once whatever the IOExecutor is doing
+        with it is done.
 
+        """
+        if self.permit is not None:
+            self.permit.release()
+        if self.parser is None:
+            return
+        if self.pending is not None and not self.pending.done():
+            self.pending.add_done_callback(lambda f: self.parser.cleanup())
+        else:
+            io_executor(self.application).submit(self.parser.cleanup)
+
+    def on_finish(self):
+        self.cleanup()
+
+    def on_connection_close(self):
+        self.cleanup()
+
+    @tornado.gen.coroutine
     def post(self):
         """
         Incoming requests come from the setup.py 'register' or 'upload'
@@ -34,157 +169,418 @@ class SetupPyHandler(tornado.web.RequestHandler):
 
         http://www.w3.org/Protocols/rfc2616/rfc2616-sec19.html#sec19.3
 
-        ...which is why we parse our own body (after double-checking that
-        self.request.arguments is empty)
+        ...which is why we parse our own body.
 
         Distutils is aware that it's a problem:
 
         http://bugs.python.org/issue10510
 
         """
+        if self.parse_error is not None:
+            raise tornado.web.HTTPError(400, str(self.parse_error))
 
-        #logging.debug("ARGUMENTS: %s", self.request.arguments)
-        if not self.request.arguments:
-            args = self.parse_args_from_body()
+        if self.parser is not None:
+            try:
+                args = self.parser.close()
+            except MultipartError as out:
+                raise tornado.web.HTTPError(400, str(out))
         else:
-            args = self.request.arguments
+            args = self.parse_args_from_form()
 
         logging.debug("ARGS INSIDE POST: %s", args)
 
+        if 'name' not in args or 'version' not in args:
+            raise tornado.web.HTTPError(400, 'name and version are required')
+
+        filepath = None
         if 'filename' in args.keys():
+            self.check_digests(args)
+            self.check_names(args)
             try:
                 logging.debug("CALLING upload")
-                self.upload(self.request, args)
-                # this return should be removed if an option to store data
-                # and/or use the web UI is enabled.
-                return True
+                filepath = yield self.upload(self.request, args)
             except Exception as out:
                 raise tornado.web.HTTPError(500, 'Problem with upload() --> %s'
                     % out)
-        #
-        # store all the args we got in the main lookup hash for the pkg.
-        #logging.debug("REDIS: db.hmset('pkg:%s',  %s)", args['name'], args)
-        #db.hmset('pkg:%s' % args['name'], args)
-        #
-        # For each k,v in args, make a set
-        #for arg, val in args.items():
-        #    if arg == 'classifiers':
-        #        for classifier in val:
-        #            #logging.debug("Adding classifier '%s' for pkg %s",
-        #                classifier,
-        #                args['name'])
-        #            logging.debug("REDIS: db.sadd(':'.join((%s, %s)), %s )",
-        #                arg,
-        #                classifier,
-        #                args['name'])
-        #            db.sadd(':'.join((arg, classifier)), args['name'])
-        #    else:
-        #        if arg not in self.nolist_keys:
-        #            #logging.debug("Adding %s for pkg %s", 'metadata:%s' %
-        #                 arg,
-        #                 args['name'])
-        #            logging.debug("REDIS: db.sadd('metadata:%s', %s)" %
-        #                 arg,
-        #                 val)
-        #            db.sadd('metadata:%s' % arg, val)
+
+        # store all the args we got as the release's metadata. The write is
+        # batched with any others arriving around the same time. It bumps
+        # the project's serial, which is how /search knows to reindex it.
+        data = pypi_data(self.application)
+        data.store_pkg_metadata(args['name'], args['version'], args)
+
+        # What's in the file itself is filled in over that once a metadata
+        # process has read it.
+        extractor = metadata_extractor(self.application)
+        if filepath is not None and extractor is not None:
+            extractor.update_release(data, args['name'], args['version'],
+                                     filepath)
+
+    @tornado.gen.coroutine
     def upload(self, req, args):
-        # TODO: this line is going to cause brokenness someday. Planning to
-        # clean it up and let users define different base paths for
-        # different file types or maybe other arbitrary conditions.
+        # Where the file goes, under which of PackageDirs, is up to
+        # core.storage.
         logging.debug("INSIDE upload()")
-        base_pkgdir = os.path.join(self.application.settings['base_path'],
-            self.application.settings['PackageDirs'][0])
-
         pkgname = args['name']
         vers = args['version']
         ftype = args['filetype']
         fname = args['filename']
-        fcontent = args['filecontent']
+        ftemp = args['filetemp']
 
         if fname.startswith('"') and fname.endswith('"'):
             fname = fname[1:-1]
             logging.debug("FILENAME: %s", fname)
 
-        filepath = os.path.join(base_pkgdir, pkgname, fname)
+        storage = artifact_storage(self.application)
+        filepath = storage.path_for(pkgname, fname)
+        index = package_index(self.application)
+        project = index.find(pkgname)
+        previous = project and project.files.get(fname)
+        executor = io_executor(self.application)
         try:
-            with open(filepath, 'w') as f:
-                f.write(fcontent)
-        except IOError as ioerr:
-            logging.debug("Error writing uploaded file: %s - %s",
-                ioerr.errno,
-                ioerr.strerror)
-            try:
-                os.makedirs(os.path.dirname(filepath))
-                logging.debug("Path created: %s", os.path.dirname(filepath))
-                with open(filepath, 'w') as f:
-                    f.write(fcontent)
-            except OSError as out:
-                logging.debug("Error creating path %s (%s - %s)",
-                    filepath,
-                    out.errno,
-                    out.strerror)
-                raise tornado.web.HTTPError(500)
-
-    def parse_args_from_body(self):
-        """
-        current distutils versions don't use proper line terminators for HTTP
-        headers, so we can't lean on Tornado's nicely-populated
-        self.request.arguments, and self.request.files. We have to do it
-        manually.
-
-        """
-        logging.debug("Inside parse_args_from_body")
-        logging.debug(self.request)
+            self.pending = executor.submit(self.store_file, ftemp,
+                                           args['filesha256'], filepath)
+            yield self.pending
+            logging.debug("Stored %s", filepath)
+        except (IOError, OSError) as out:
+            logging.debug("Error storing uploaded file %s (%s - %s)",
+                filepath,
+                out.errno,
+                out.strerror)
+            raise tornado.web.HTTPError(500)
+
+        dist, = yield self.index_files([(pkgname, filepath, vers,
+                                         args['filesha256'])])
+        if previous is not None and previous.path != filepath:
+            # It was somewhere else before: under another layout, or on a
+            # disk that's since been added to or taken out of PackageDirs.
+            yield executor.submit(storage.remove, previous.path)
+        pypi_data(self.application).store_pkg_file(
+            pkgname, vers, dist.filename, filetype=ftype, url=dist.url,
+            path=filepath, size=dist.size, md5_digest=args['filemd5'],
+            sha256_digest=args['filesha256'])
+
+        # The file's stored either way, so a failed export shouldn't fail
+        # the upload. The pages are written in the background, and the next
+        # full rebuild will catch them up if that fails.
+        try:
+            exporter = static_export(self.application)
+            if exporter is not None:
+                exporter.update(pkgname)
+        except (IOError, OSError) as out:
+            logging.error("Static index export for %s failed: %s",
+                          pkgname, out)
+        raise tornado.gen.Return(filepath)
+
+    @tornado.gen.coroutine
+    def index_files(self, files):
+        """
+        The package index's add_files(files), with the disk looked at on
+        the IOExecutor. A per-process index is only changed on the IOLoop,
+        where rescans swap it out; a shared one can be changed from
+        anywhere, so that's done on the IOExecutor too.
+
+        """
+        index = package_index(self.application)
+        executor = io_executor(self.application)
+        added = yield executor.submit(index.make_files, files)
+        if index.index_file is None:
+            index.add_dists(added)
+        else:
+            yield executor.submit(index.add_dists, added)
+        raise tornado.gen.Return([dist for project_name, dist in added])
+
+    def store_file(self, ftemp, sha256, filepath):
+        """
+        Put the spooled upload in place at 'filepath'. Either way, the file
+        appears there all at once, and a wheel's metadata file is there
+        first.
+
+        """
+        write_metadata_file(filepath, ftemp)
+        store = blob_store(self.application)
+        if store is not None:
+            store.publish(ftemp, sha256, filepath)
+        else:
+            os.chmod(ftemp, 0o644)
+            move_atomic(ftemp, filepath)
+
+    def check_names(self, args):
+        """
+        The project name is a directory under PackageDirs and the filename
+        a file in it, so neither can be allowed to point anywhere else.
+
+        """
+        fname = args['filename']
+        if fname.startswith('"') and fname.endswith('"'):
+            fname = fname[1:-1]
+        if not is_safe_name(args['name']):
+            raise tornado.web.HTTPError(400, 'not a project name')
+        if not is_safe_name(fname) or not is_distribution(fname):
+            raise tornado.web.HTTPError(400, 'not a distribution filename')
+
+    def check_digests(self, args):
+        """
+        Any digests the client sent have to match what we computed while
+        the file was streaming in.
+
+        """
+        for sent, computed in (('md5_digest', 'filemd5'),
+                               ('sha256_digest', 'filesha256')):
+            value = args.get(sent)
+            if value and value.strip().lower() != args[computed]:
+                logging.error("%s mismatch for %s: sent %s, computed %s",
+                              sent, args['filename'], value, args[computed])
+                raise tornado.web.HTTPError(400, '%s does not match the '
+                                            'uploaded file' % sent)
+
+    def parse_args_from_form(self):
+        """
+        Anything that isn't multipart is an ordinary urlencoded form with no
+        file attached, so the body is small and Tornado can parse it for us.
+        Values are flattened the same way the multipart parser does it.
+
+        """
+        arguments = {}
+        tornado.httputil.parse_body_arguments(
+            self.request.headers.get('Content-Type', ''),
+            ''.join(self.body_chunks), arguments, {})
+        for k, v in self.request.arguments.items():
+            arguments.setdefault(k, []).extend(v)
+
+        args = {}
+        for k, v in arguments.items():
+            args[k] = v if k == 'classifiers' else v[-1]
+        return args
+
+
+@tornado.web.stream_request_body
+class BatchUploadHandler(SetupPyHandler):
+    """
+    Many distributions in one request, for release pipelines that would
+    otherwise make a setup.py upload request for each:
+
+    POST /dist/batch            store whichever files check out
+    POST /dist/batch?atomic=1   store every file, or none of them
+
+    The body is a tar stream (Content-Type: application/x-tar) or a
+    multipart/form-data body, holding the files and a manifest of their
+    digests (see core.bundle). It's streamed in like any upload, and counts
+    as one upload to admission control, but it can be up to
+    settings['max_batch_size'] bytes.
+
+    Files are staged beside where they're going, and an atomic batch isn't
+    staged at all unless every file can be. Then the records of the staged
+    files go to the metadata store in one transaction, and only once that's
+    committed are the files renamed into place, so nothing is published
+    without its records. The package index is updated once. The response
+    is JSON, with whether each file was stored, and why not.
+
+    """
+
+    def max_body_size(self):
+        return self.application.settings.get('max_batch_size',
+                                             DEFAULT_MAX_BATCH_SIZE)
+
+    def make_parser(self, content_type, tmp_dir):
+        if content_type.split(';')[0].strip() in TAR_TYPES:
+            return TarStreamParser(tmp_dir)
+        parser = SetupPyHandler.make_parser(self, content_type, tmp_dir)
+        if parser is None:
+            raise tornado.web.HTTPError(415, 'Send a tar stream or a '
+                                        'multipart/form-data body')
+        return parser
+
+    @tornado.gen.coroutine
+    def post(self):
+        if self.parse_error is not None:
+            raise tornado.web.HTTPError(400, str(self.parse_error))
+        try:
+            args = self.parser.close()
+            entries = parse_manifest(args.get('manifest'))
+        except (MultipartError, BundleError) as out:
+            raise tornado.web.HTTPError(400, str(out))
+        atomic = self.get_argument('atomic', '').lower() in ('1', 'true',
+                                                             'yes')
+
+        items = check_bundle(entries, self.parser.files)
+        good = [item for item in items if item['error'] is None]
+        if atomic and len(good) < len(items):
+            for item in good:
+                item['error'] = ('not stored, since others in the batch '
+                                 'failed')
+            self.report(400, items, atomic)
+            return
+
+        storage = artifact_storage(self.application)
+        index = package_index(self.application)
+        for item in good:
+            item['path'] = storage.path_for(item['name'], item['filename'])
+            project = index.find(item['name'])
+            item['previous'] = project and project.files.get(item['filename'])
+
+        executor = io_executor(self.application)
         try:
-            ctfields = self.request.headers['Content-Type'].split(';')
-            logging.debug("ctfields: %s", ctfields)
-
-            boundary = [field.split('=')[1] for field in ctfields
-                if 'boundary=' in field][0]
-            logging.debug("boundary: %s", boundary)
-
-            chunks = self.request.body.split(boundary)
-            logging.debug("chunks: %s", chunks)
-
-            args = {}
-            for i in chunks:
-                logging.debug("Current chunk: %s", i)
-                if 'filename' in i:
-                    hdrs, file_contents = i.split('\n\n', 1)
-                    logging.debug("HEADERS RAW: %s", hdrs)
-                    hdr_dict = dict([(h.split('=')) for h in hdrs.split(';')
-                        if '=' in h])
-                    logging.debug("HEADER DICT: %s", hdr_dict)
-                    if 'filename' in hdr_dict.keys():
-                        file_name = hdr_dict['filename']
-                        args['filename'] = file_name
-                        args['filecontent'] = file_contents
-                        continue
-
-                if 'form-data' in i:
-                    argbit = i.split(';', 1)[1]
-                    logging.debug("Argbit: %s", argbit)
-
-                    prename, preval = argbit.split('\n\n', 1)
-                    logging.debug("prename, preval == %s, %s", prename, preval)
-
-                    k = prename.split('=')[1]
-                    if k.startswith('"') and k.endswith('"'):
-                        k = k[1:-1]
-                    v = preval.rstrip('\n--')
-                    logging.debug("K, V = %s, %s", k, v)
-
-                    if k == 'classifiers':
-                        if k in args:
-                            # there can be >1 of these.
-                            args[k].append(v)
-                        else:
-                            #first classifier we're adding.
-                            args[k] = [v]
-                    else:
-                        args[k] = v
-
-            logging.debug("ARGS: %s", args)
-            return args
+            self.pending = executor.submit(self.stage_batch, good, atomic)
+            yield self.pending
+        except (IOError, OSError) as out:
+            logging.error("Storing batch upload failed: %s", out)
+            for item in good:
+                item['error'] = 'not stored: %s' % out
+            self.report(500, items, atomic)
+            return
+        staged = [item for item in good if item['error'] is None]
+
+        # The records go in before the files do, so if the metadata store
+        # can't take them, the staged files are thrown away and nothing's
+        # published.
+        data = pypi_data(self.application)
+        try:
+            with data.batch():
+                for item in staged:
+                    item['url'] = index.url_for(item['path'])
+                    data.store_pkg_file(
+                        item['name'], item['version'], item['filename'],
+                        filetype=item['filetype'], url=item['url'],
+                        path=item['path'], size=item['spooled']['filesize'],
+                        md5_digest=item['spooled']['filemd5'],
+                        sha256_digest=item['spooled']['filesha256'])
+                    if item['metadata']:
+                        data.update_pkg_metadata(item['name'],
+                                                 item['version'],
+                                                 **item['metadata'])
         except Exception as out:
-            logging.error("Whoops --> %s (%s)", type(out), out)
+            logging.exception("Recording batch upload failed: %s", out)
+            yield executor.submit(self.unstage_batch, staged)
+            for item in staged:
+                item['error'] = 'not stored: the metadata store failed'
+            self.report(500, items, atomic)
+            return
+
+        yield executor.submit(self.commit_batch, staged)
+        stored = [item for item in staged if item['error'] is None]
+        for item in staged:
+            if item['error'] is not None:
+                data.remove_pkg_file(item['name'], item['filename'])
+        for item in stored:
+            previous = item['previous']
+            if previous is not None and previous.path != item['path']:
+                # See upload().
+                yield executor.submit(storage.remove, previous.path)
+        yield self.index_files([(item['name'], item['path'], item['version'],
+                                 item['spooled']['filesha256'])
+                                for item in stored])
+
+        extractor = metadata_extractor(self.application)
+        if extractor is not None:
+            for item in stored:
+                extractor.update_release(data, item['name'], item['version'],
+                                         item['path'])
+        try:
+            exporter = static_export(self.application)
+            if exporter is not None:
+                for name in set(item['name'] for item in stored):
+                    exporter.update(name)
+        except (IOError, OSError) as out:
+            logging.error("Static index export after batch upload "
+                          "failed: %s", out)
+
+        self.report(200 if len(stored) == len(items) else 400, items, atomic)
+
+    def report(self, status, items, atomic):
+        files = [{'filename': item['filename'], 'name': item['name'],
+                  'version': item['version'],
+                  'stored': item['error'] is None,
+                  'url': item.get('url') if item['error'] is None else None,
+                  'error': item['error']}
+                 for item in items]
+        self.set_status(status)
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps({
+            'atomic': atomic,
+            'stored': sum(1 for f in files if f['stored']),
+            'failed': sum(1 for f in files if not f['stored']),
+            'files': files}, sort_keys=True))
+
+    def stage_batch(self, items, atomic):
+        """
+        Stage each of 'items' beside its destination, keeping what
+        commit_batch() needs in item['renames']. Not atomic, one that can't
+        be staged gets an error. Atomic, if one can't be, none are, and the
+        error's raised.
+
+        """
+        staged = []
+        try:
+            for item in items:
+                try:
+                    item['renames'] = self.stage(item)
+                except (IOError, OSError) as out:
+                    if atomic:
+                        raise
+                    logging.error("Storing %s failed: %s", item['path'], out)
+                    item['error'] = 'not stored: %s' % out
+                    continue
+                staged.append(item)
+        except Exception:
+            self.unstage_batch(staged)
+            raise
+
+    def commit_batch(self, items):
+        """
+        Rename the staged 'items' into place. One that can't be gets an
+        error.
+
+        """
+        for item in items:
+            try:
+                self.commit(item['renames'])
+            except (IOError, OSError) as out:
+                logging.error("Storing %s failed: %s", item['path'], out)
+                item['error'] = 'not stored: %s' % out
+                self.unstage(item['renames'])
+
+    def unstage_batch(self, items):
+        for item in items:
+            self.unstage(item['renames'])
+
+    def stage(self, item):
+        """
+        Put the file for 'item', and its metadata file if it's a wheel, in
+        temp files beside where they go. Returns [(temp, dest)] for
+        commit(), metadata file first; a temp of None means dest is to be
+        removed.
+
+        """
+        ftemp = item['spooled']['filetemp']
+        dest = item['path']
+        renames = []
+        try:
+            if dest.lower().endswith('.whl'):
+                renames.append((stage_metadata_file(dest, ftemp),
+                                dest + METADATA_SUFFIX))
+            store = blob_store(self.application)
+            if store is not None:
+                temp = store.stage(ftemp, item['spooled']['filesha256'], dest)
+            else:
+                makedirs_for(dest)
+                temp = temp_beside(dest)
+                os.chmod(ftemp, 0o644)
+                move_atomic(ftemp, temp)
+            renames.append((temp, dest))
+        except Exception:
+            self.unstage(renames)
+            raise
+        return renames
+
+    def commit(self, renames):
+        for temp, dest in renames:
+            if temp is not None:
+                os.rename(temp, dest)
+            elif os.path.exists(dest):
+                os.unlink(dest)
+
+    def unstage(self, renames):
+        for temp, dest in renames:
+            if temp is not None and os.path.exists(temp):
+                os.unlink(temp)
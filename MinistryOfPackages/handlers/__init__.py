@@ -1,3 +1,6 @@
-from SetupPy import SetupPyHandler
-from PyPI import PyPIHandler
+from SetupPy import SetupPyHandler, BatchUploadHandler
+from PyPI import PyPIHandler, SimpleIndexHandler, ProjectJSONHandler, \
+    SearchHandler
 from DirectoryListing import DirectoryListingHandler
+from Proxy import ProxyHandler, ProxyFileHandler
+from Metrics import MetricsHandler
@@ -0,0 +1,527 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Load test MinistryOfPackages the way pip uses it.
+
+'run' builds a synthetic PackageDirs tree (N projects with M releases
+each, file sizes drawn from a log-normal distribution), boots
+bin/ministry_server.py on it, and has a number of client processes hammer
+it over localhost with a mix of:
+
+    index     GET /simple/
+    project   GET /simple/<project>/
+    download  GET /packages/<project>/<file>
+    missing   GET /simple/<project that doesn't exist>/
+    upload    POST /pypi, a 'setup.py upload' style multipart body
+
+for a fixed time. It reports throughput and p50/p95/p99 latency overall
+and per kind of request, plus the peak RSS of every server process, and
+writes it all to a JSON file. Everything random is seeded, so two runs
+with the same options do the same work.
+
+'compare' lines up two or more of those JSON files.
+
+    bench/ministry_bench.py run --projects 500 --duration 30 -o new.json
+    bench/ministry_bench.py compare old.json new.json
+
+"""
+import hashlib
+import json
+import math
+import multiprocessing
+import optparse
+import os
+from os.path import dirname, realpath
+import platform
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+import yaml
+
+import tornado
+import tornado.gen
+import tornado.httpclient
+import tornado.ioloop
+
+REPO = realpath(dirname(dirname(realpath(__file__))))
+
+KINDS = ('index', 'project', 'download', 'missing', 'upload')
+DEFAULT_MIX = 'index=2,project=40,download=40,missing=15,upload=3'
+
+BOUNDARY = '--------------BenchBoundary7MA4YWxkTrZu0gW'
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(','):
+        kind, weight = item.split('=')
+        if kind not in KINDS:
+            raise ValueError('Unknown request kind %r' % kind)
+        mix[kind] = float(weight)
+    return mix
+
+
+def project_name(i):
+    return 'bench-project-%04d' % i
+
+
+def build_tree(base, projects, releases, median_size, seed):
+    """
+    Fill base/packages with projects*releases sdists. Contents are slices
+    of one block of random bytes; only the sizes matter.
+
+    """
+    rng = random.Random(seed)
+    block = os.urandom(1024 * 1024)
+    sigma = 1.0
+    files = []
+    for p in range(projects):
+        name = project_name(p)
+        directory = os.path.join(base, 'packages', name)
+        os.makedirs(directory)
+        for r in range(releases):
+            filename = '%s-1.%d.0.tar.gz' % (name, r)
+            size = int(min(max(rng.lognormvariate(math.log(median_size),
+                                                  sigma), 1024), 64 << 20))
+            with open(os.path.join(directory, filename), 'wb') as out:
+                written = 0
+                while written < size:
+                    chunk = block[:size - written]
+                    out.write(chunk)
+                    written += len(chunk)
+            files.append((name, filename, size))
+    return files
+
+
+def write_config(base, port, workers):
+    with open(os.path.join(REPO, 'etc', 'config.yaml')) as stream:
+        config = yaml.load(stream)
+
+    config['HTTPServer'].update(ports=[port], workers=workers,
+                                load_report_interval=0)
+    config['Logging'].update(directory=base, filename='server.log',
+                             level='error')
+    config['Logging'].pop('handler', None)
+
+    settings = config['Application']
+    settings.update(base_path=base,
+                    PackageDirs=['packages'],
+                    static_path=os.path.join(REPO, 'static'),
+                    template_path=os.path.join(REPO, 'templates'),
+                    upload_tmp_dir='tmp',
+                    blob_dir='var/blobs')
+    settings['MetadataStore'] = dict(settings.get('MetadataStore') or {},
+                                     backend='sqlite', path='var/ministry.db')
+    settings.pop('static_export_dir', None)
+    os.makedirs(os.path.join(base, 'tmp'))
+
+    path = os.path.join(base, 'config.yaml')
+    with open(path, 'w') as out:
+        yaml.safe_dump(config, out, default_flow_style=False)
+    return path
+
+
+class Server(object):
+    """
+    bin/ministry_server.py, daemonized, with its pid in base/server.pid.
+
+    """
+
+    def __init__(self, base, config_path, port):
+        self.base = base
+        self.port = port
+        self.pidfile = os.path.join(base, 'server.pid')
+        pythonpath = os.pathsep.join(
+            [REPO] + filter(None, [os.environ.get('PYTHONPATH')]))
+        subprocess.check_call([sys.executable,
+                               os.path.join(REPO, 'bin', 'ministry_server.py'),
+                               '-c', config_path, '-p', self.pidfile],
+                              env=dict(os.environ, PYTHONPATH=pythonpath))
+        self.pid = None
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            if self.pid is None and os.path.exists(self.pidfile):
+                with open(self.pidfile) as f:
+                    self.pid = int(f.read().strip() or 0) or None
+            try:
+                urllib2.urlopen(self.url('/simple/'), timeout=1).read()
+                if self.pid is not None:
+                    return
+            except (urllib2.URLError, socket.error):
+                pass
+            time.sleep(0.2)
+        raise RuntimeError('Server did not come up; see %s' %
+                           os.path.join(base, 'server.log'))
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.port, path)
+
+    def workers(self):
+        return [pid for pid in os.listdir('/proc') if pid.isdigit() and
+                proc_status(pid).get('PPid') == str(self.pid)]
+
+    def peak_rss(self):
+        """
+        {pid: peak RSS in KB} for the supervisor and each worker, from
+        /proc. Empty where there's no /proc.
+
+        """
+        peaks = {}
+        for pid in [str(self.pid)] + self.workers():
+            hwm = proc_status(pid).get('VmHWM')
+            if hwm:
+                peaks[int(pid)] = int(hwm.split()[0])
+        return peaks
+
+    def stop(self):
+        if self.pid is None:
+            return
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except OSError:
+            return
+        deadline = time.time() + 30
+        while time.time() < deadline and os.path.exists('/proc/%d' %
+                                                        self.pid):
+            time.sleep(0.1)
+
+
+def proc_status(pid):
+    try:
+        with open('/proc/%s/status' % pid) as f:
+            return dict(line.rstrip('\n').split(':\t', 1)
+                        for line in f if ':\t' in line)
+    except IOError:
+        return {}
+
+
+def upload_body(name, version, content):
+    fields = [(':action', 'file_upload'), ('protocol_version', '1'),
+              ('name', name), ('version', version), ('filetype', 'sdist'),
+              ('pyversion', 'source'), ('summary', 'A benchmark upload'),
+              ('md5_digest', hashlib.md5(content).hexdigest())]
+    parts = []
+    for k, v in fields:
+        parts.append('--%s\r\nContent-Disposition: form-data; name="%s"'
+                     '\r\n\r\n%s\r\n' % (BOUNDARY, k, v))
+    parts.append('--%s\r\nContent-Disposition: form-data; name="content"; '
+                 'filename="%s-%s.tar.gz"\r\n'
+                 'Content-Type: application/octet-stream\r\n\r\n' %
+                 (BOUNDARY, name, version))
+    parts.append(content)
+    parts.append('\r\n--%s--\r\n' % BOUNDARY)
+    return ''.join(parts)
+
+
+def client(number, base_url, files, projects, mix, concurrency, duration,
+           upload_size, seed, results):
+    """
+    One client process: 'concurrency' requests in flight at a time for
+    'duration' seconds. Puts a list of (kind, seconds, status, bytes) on
+    'results'.
+
+    """
+    rng = random.Random(seed * 1000 + number)
+    kinds = sorted(mix)
+    weights = [mix[k] for k in kinds]
+    total = sum(weights)
+    upload_content = os.urandom(upload_size)
+    samples = []
+    http = tornado.httpclient.AsyncHTTPClient(max_clients=concurrency)
+    counter = [0]
+
+    def choose():
+        x = rng.random() * total
+        for kind, weight in zip(kinds, weights):
+            x -= weight
+            if x < 0:
+                return kind
+        return kinds[-1]
+
+    def make_request(kind):
+        if kind == 'index':
+            return tornado.httpclient.HTTPRequest(base_url + '/simple/')
+        if kind == 'project':
+            return tornado.httpclient.HTTPRequest(
+                base_url + '/simple/%s/' % project_name(
+                    rng.randrange(projects)))
+        if kind == 'download':
+            name, filename, size = rng.choice(files)
+            return tornado.httpclient.HTTPRequest(
+                base_url + '/packages/%s/%s' % (name, filename))
+        if kind == 'missing':
+            return tornado.httpclient.HTTPRequest(
+                base_url + '/simple/no-such-project-%d/' %
+                rng.randrange(1 << 30))
+        counter[0] += 1
+        # Distinct contents, so the blob store can't dedup them away.
+        body = upload_body(project_name(rng.randrange(projects)),
+                           '9.%d.%d' % (number, counter[0]),
+                           str(counter[0]) + upload_content)
+        return tornado.httpclient.HTTPRequest(
+            base_url + '/pypi', method='POST', body=body,
+            headers={'Content-Type':
+                     'multipart/form-data; boundary=%s' % BOUNDARY})
+
+    @tornado.gen.coroutine
+    def loop(deadline):
+        while time.time() < deadline:
+            kind = choose()
+            request = make_request(kind)
+            request.request_timeout = 120
+            start = time.time()
+            try:
+                response = yield http.fetch(request, raise_error=False)
+                status = response.code
+                size = len(response.body or '')
+            except Exception:
+                status, size = 599, 0
+            samples.append((kind, time.time() - start, status, size))
+
+    @tornado.gen.coroutine
+    def run():
+        deadline = time.time() + duration
+        yield [loop(deadline) for i in range(concurrency)]
+
+    tornado.ioloop.IOLoop.current().run_sync(run)
+    results.put(samples)
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1,
+                       int(math.ceil(p / 100.0 * len(ordered))) - 1)]
+
+
+def summarize(samples, duration):
+    latencies = sorted(s[1] for s in samples)
+    expected = dict(index=(200,), project=(200,), download=(200,),
+                    missing=(404,), upload=(200,))
+    errors = sum(1 for kind, seconds, status, size in samples
+                 if status not in expected[kind])
+    return {'requests': len(samples),
+            'errors': errors,
+            'throughput': round(len(samples) / float(duration), 2),
+            'bytes': sum(s[3] for s in samples),
+            'p50_ms': ms(percentile(latencies, 50)),
+            'p95_ms': ms(percentile(latencies, 95)),
+            'p99_ms': ms(percentile(latencies, 99))}
+
+
+def ms(seconds):
+    if seconds is not None:
+        return round(seconds * 1000, 3)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=REPO).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def run(options):
+    mix = parse_mix(options.mix)
+    base = tempfile.mkdtemp(prefix='ministry-bench-')
+    port = options.port or free_port()
+    server = None
+    try:
+        sys.stderr.write('Building %d projects x %d releases in %s\n' %
+                         (options.projects, options.releases, base))
+        files = build_tree(base, options.projects, options.releases,
+                           options.median_size, options.seed)
+        config_path = write_config(base, port, options.workers)
+        server = Server(base, config_path, port)
+        workers = server.workers()
+        sys.stderr.write('Server up on port %d with %d workers; running %d '
+                         'clients x %d for %ds\n' %
+                         (port, len(workers), options.clients,
+                          options.concurrency, options.duration))
+
+        queue = multiprocessing.Queue()
+        clients = [multiprocessing.Process(
+            target=client,
+            args=(i, server.url(''), files, options.projects, mix,
+                  options.concurrency, options.duration, options.upload_size,
+                  options.seed, queue))
+            for i in range(options.clients)]
+        start = time.time()
+        for c in clients:
+            c.start()
+        samples = []
+        for c in clients:
+            samples.extend(queue.get())
+        for c in clients:
+            c.join()
+        elapsed = time.time() - start
+
+        peaks = server.peak_rss()
+    finally:
+        if server is not None:
+            server.stop()
+        if options.keep:
+            sys.stderr.write('Left the tree in %s\n' % base)
+        else:
+            shutil.rmtree(base, ignore_errors=True)
+
+    by_kind = {}
+    for kind in KINDS:
+        kind_samples = [s for s in samples if s[0] == kind]
+        if kind_samples:
+            by_kind[kind] = summarize(kind_samples, elapsed)
+
+    report = {
+        'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                 'revision': git_revision(),
+                 'python': platform.python_version(),
+                 'tornado': tornado.version,
+                 'host': platform.node(),
+                 'cpus': multiprocessing.cpu_count()},
+        'options': {'projects': options.projects,
+                    'releases': options.releases,
+                    'median_size': options.median_size,
+                    'upload_size': options.upload_size,
+                    'workers': options.workers,
+                    'clients': options.clients,
+                    'concurrency': options.concurrency,
+                    'duration': options.duration,
+                    'mix': mix,
+                    'seed': options.seed},
+        'elapsed': round(elapsed, 3),
+        'overall': summarize(samples, elapsed),
+        'by_kind': by_kind,
+        'peak_rss_kb': dict((str(pid), kb) for pid, kb in peaks.items()),
+        'supervisor_pid': server.pid,
+    }
+
+    output = options.output or 'bench-%s.json' % time.strftime(
+        '%Y%m%d-%H%M%S')
+    with open(output, 'w') as out:
+        json.dump(report, out, indent=2, sort_keys=True)
+    print_report([(output, report)])
+
+
+def print_report(reports):
+    """
+    A table with a column per report, the first being the baseline the
+    others are compared to.
+
+    """
+    rows = [('throughput', 'overall', 'throughput')]
+    for key in ('p50_ms', 'p95_ms', 'p99_ms', 'errors'):
+        rows.append((key, 'overall', key))
+    for kind in KINDS:
+        for key in ('throughput', 'p50_ms', 'p95_ms', 'p99_ms'):
+            rows.append(('%s %s' % (kind, key), kind, key))
+
+    # Room for a value and its change from the baseline.
+    width = max(len(os.path.basename(name)) for name, report in reports)
+    width = max(width, 20) + 2
+    print '%-22s' % '' + ''.join('%*s' % (width, os.path.basename(name))
+                                 for name, report in reports)
+    for label, section, key in rows:
+        values = []
+        for name, report in reports:
+            data = (report['overall'] if section == 'overall'
+                    else report['by_kind'].get(section, {}))
+            values.append(data.get(key))
+        if all(v is None for v in values):
+            continue
+        cells = []
+        for i, value in enumerate(values):
+            cell = '-' if value is None else str(value)
+            if i and value is not None and values[0]:
+                cell += ' (%+.1f%%)' % (100.0 * (value - values[0]) /
+                                        values[0])
+            cells.append('%*s' % (width, cell))
+        print '%-22s' % label + ''.join(cells)
+
+    for name, report in reports:
+        peaks = report['peak_rss_kb']
+        supervisor = str(report.get('supervisor_pid'))
+        workers = [kb for pid, kb in peaks.items() if pid != supervisor]
+        if workers:
+            print '%s: peak RSS per worker %d-%d KB (supervisor %s KB)' % (
+                os.path.basename(name), min(workers), max(workers),
+                peaks.get(supervisor, '-'))
+
+
+def compare(paths):
+    reports = []
+    for path in paths:
+        with open(path) as f:
+            reports.append((path, json.load(f)))
+    print_report(reports)
+
+
+def do_options():
+    usage = ("usage: %prog run [options]\n"
+             "       %prog compare <baseline.json> <other.json> ...")
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('--projects', type='int', default=200)
+    parser.add_option('--releases', type='int', default=5,
+                      help='Releases per project')
+    parser.add_option('--median-size', type='int', default=48 * 1024,
+                      dest='median_size',
+                      help='Median file size in bytes')
+    parser.add_option('--upload-size', type='int', default=256 * 1024,
+                      dest='upload_size')
+    parser.add_option('--workers', type='int', default=0,
+                      help='Server workers (default: one per CPU)')
+    parser.add_option('--clients', type='int', default=2,
+                      help='Client processes')
+    parser.add_option('--concurrency', type='int', default=16,
+                      help='Requests in flight per client process')
+    parser.add_option('--duration', type='int', default=20,
+                      help='Seconds to run for')
+    parser.add_option('--mix', default=DEFAULT_MIX,
+                      help='Relative weights of request kinds '
+                           '(default: %default)')
+    parser.add_option('--seed', type='int', default=1)
+    parser.add_option('--port', type='int', default=0)
+    parser.add_option('-o', '--output', default=None,
+                      help='Where to write the JSON results')
+    parser.add_option('--keep', action='store_true', default=False,
+                      help="Don't delete the synthetic tree afterwards")
+
+    options, args = parser.parse_args()
+    if not args or args[0] not in ('run', 'compare'):
+        parser.error('Specify run or compare')
+    if args[0] == 'compare' and len(args) < 3:
+        parser.error('compare needs at least two result files')
+    return options, args
+
+
+if __name__ == '__main__':
+    options, args = do_options()
+    if args[0] == 'run':
+        run(options)
+    else:
+        compare(args[1:])
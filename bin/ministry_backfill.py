@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Read the metadata out of distribution files under PackageDirs and record
+it, in parallel. By default that's only files the metadata store doesn't
+know about, such as ones copied in by hand, which get file records
+(digests included) as well. With --all, every file is read again and its
+metadata merged into its release's.
+
+Wheels without a PEP 658 metadata file beside them get one.
+
+The server does the same for files it finds while it's running; this is
+for getting through an existing tree in one go.
+
+"""
+import logging
+import multiprocessing
+import optparse
+import os
+from os.path import dirname, realpath
+import time
+import yaml
+
+from MinistryOfPackages.core.dao import PyPIData, make_backend
+from MinistryOfPackages.core.distmeta import (extract, record_file,
+                                              release_fields,
+                                              write_metadata_file)
+from MinistryOfPackages.core.index import METADATA_SUFFIX, PackageIndex
+
+# Results written to the metadata store per transaction.
+BATCH_SIZE = 500
+
+# Seconds between progress reports.
+PROGRESS_INTERVAL = 5
+
+
+def do_options():
+    usage = "usage: %prog -c <configfile> [options]"
+    parser = optparse.OptionParser(usage=usage)
+
+    parser.add_option("-c", "--config",
+                      action="store", dest="config",
+                      help="Specify the configuration file for use")
+
+    parser.add_option("-j", "--jobs",
+                      action="store", dest="jobs", type="int", default=None,
+                      help="Processes to read files with (default: one per "
+                           "CPU)")
+
+    parser.add_option("-a", "--all",
+                      action="store_true", dest="all", default=False,
+                      help="Re-read files the metadata store already knows "
+                           "about too")
+
+    options, args = parser.parse_args()
+
+    if options.config is None:
+        parser.error('Missing configuration file')
+
+    return options
+
+
+def extract_one(item):
+    path, digests = item
+    if not os.path.exists(path + METADATA_SUFFIX):
+        try:
+            write_metadata_file(path)
+        except (IOError, OSError) as out:
+            logging.error("Writing metadata file for %s: %s", path, out)
+    return extract(path, digests)
+
+
+def main(options):
+    application_base = realpath(dirname(dirname(realpath(__file__))))
+
+    with open(options.config) as stream:
+        settings = yaml.load(stream)['Application']
+    base_path = settings.get('base_path', application_base)
+
+    index = PackageIndex(base_path, settings['PackageDirs'])
+    data = PyPIData(make_backend(settings.get('MetadataStore') or {},
+                                 base_path), index)
+    index.scan()
+
+    # Unknown files have no sha256 in the store, so they need digests and
+    # file records; known ones just need their metadata read.
+    todo = {}
+    for project in index.projects.values():
+        for dist in project.files.values():
+            if (dist.sha256 is None or options.all or
+                    (dist.filename.endswith('.whl') and
+                     not dist.metadata_sha256)):
+                todo[dist.path] = (project.name, dist)
+    logging.info('%d files to read', len(todo))
+    if not todo:
+        return
+
+    items = [(path, dist.sha256 is None)
+             for path, (name, dist) in sorted(todo.items())]
+    pool = multiprocessing.Pool(options.jobs)
+    start = last_report = time.time()
+    done = errors = 0
+    try:
+        results = pool.imap_unordered(extract_one, items, chunksize=16)
+        while done < len(items):
+            with data.batch():
+                for result in results:
+                    done += 1
+                    project_name, dist = todo[result['path']]
+                    if result['error'] is not None:
+                        errors += 1
+                        logging.warning('%s: %s', result['path'],
+                                        result['error'])
+                    if 'sha256_digest' in result:
+                        record_file(data, project_name, dist, result)
+                    elif result['metadata']:
+                        data.update_pkg_metadata(
+                            project_name,
+                            result['metadata'].get('version') or dist.version,
+                            **release_fields(result['metadata']))
+                    if not done % BATCH_SIZE or done == len(items):
+                        break
+
+            now = time.time()
+            if now - last_report >= PROGRESS_INTERVAL or done == len(items):
+                last_report = now
+                logging.info('%d/%d files, %.0f/s, %d without metadata',
+                             done, len(items), done / (now - start), errors)
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(levelname)s   %(asctime)s %(message)s')
+    main(do_options())
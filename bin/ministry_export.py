@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Rebuild the static simple index export from scratch, rendering project
+pages in parallel. The server keeps the export up to date as packages are
+uploaded; this is for creating it in the first place, and for catching it
+up with files that were copied into PackageDirs by hand.
+
+"""
+import logging
+import optparse
+import os
+from os.path import dirname, realpath
+import sys
+import time
+import yaml
+
+from MinistryOfPackages.core.dao import PyPIData, make_backend
+from MinistryOfPackages.core.export import StaticExport
+from MinistryOfPackages.core.index import PackageIndex
+
+
+def do_options():
+    usage = "usage: %prog -c <configfile> [options]"
+    parser = optparse.OptionParser(usage=usage)
+
+    parser.add_option("-c", "--config",
+                      action="store", dest="config",
+                      help="Specify the configuration file for use")
+
+    parser.add_option("-j", "--jobs",
+                      action="store", dest="jobs", type="int", default=None,
+                      help="Processes to render pages with (default: one "
+                           "per CPU)")
+
+    parser.add_option("-o", "--output",
+                      action="store", dest="output", default=None,
+                      help="Export here instead of static_export_dir")
+
+    options, args = parser.parse_args()
+
+    if options.config is None:
+        parser.error('Missing configuration file')
+
+    return options
+
+
+def main(options):
+    application_base = realpath(dirname(dirname(realpath(__file__))))
+
+    with open(options.config) as stream:
+        settings = yaml.load(stream)['Application']
+
+    if options.output:
+        export_dir = os.path.abspath(options.output)
+    elif settings.get('static_export_dir'):
+        export_dir = os.path.join(application_base,
+                                  settings['static_export_dir'])
+    else:
+        sys.stderr.write('No static_export_dir in %s, and no --output\n' %
+                         options.config)
+        sys.exit(1)
+
+    index = PackageIndex(application_base, settings['PackageDirs'])
+    # For the files' sha256 digests.
+    PyPIData(make_backend(settings.get('MetadataStore') or {},
+                          application_base), index)
+    template_path = settings['template_path'].replace('__base_path__',
+                                                      application_base)
+    exporter = StaticExport(export_dir, template_path, index)
+
+    start = time.time()
+    count = exporter.rebuild(options.jobs)
+    logging.info('Exported %d projects to %s in %.1fs', count,
+                 exporter.simple_dir, time.time() - start)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(levelname)s   %(asctime)s %(message)s')
+    main(do_options())
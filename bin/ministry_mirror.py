@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Pull projects from another simple index, such as PyPI or another
+MinistryOfPackages, into PackageDirs: the projects listed under Mirror
+in the config file, or given with -p, or else everything upstream has.
+See core/mirror.py for how.
+
+Run it again to catch up; only projects whose pages have changed since
+the last run are looked at, and downloads that were cut off carry on
+where they stopped. A running server picks the files up as they arrive.
+
+"""
+import logging
+import optparse
+import os
+from os.path import dirname, realpath
+import sys
+import time
+import yaml
+
+import tornado.ioloop
+
+from MinistryOfPackages.core.blobs import DEFAULT_BLOB_DIR, BlobStore
+from MinistryOfPackages.core.dao import PyPIData, make_backend
+from MinistryOfPackages.core.index import DEFAULT_INDEX_FILE, PackageIndex
+from MinistryOfPackages.core.mirror import (DEFAULT_CHECKPOINT,
+                                            DEFAULT_MAX_CLIENTS,
+                                            DEFAULT_TMP_DIR, Mirror)
+from MinistryOfPackages.core.proxy import DEFAULT_UPSTREAM, UpstreamError
+from MinistryOfPackages.core.storage import (DEFAULT_STORAGE_LAYOUT,
+                                             ArtifactStorage)
+
+
+def do_options():
+    usage = "usage: %prog -c <configfile> [options]"
+    parser = optparse.OptionParser(usage=usage)
+
+    parser.add_option("-c", "--config",
+                      action="store", dest="config",
+                      help="Specify the configuration file for use")
+
+    parser.add_option("-u", "--upstream",
+                      action="store", dest="upstream", default=None,
+                      help="Simple index to mirror, instead of Mirror's "
+                           "upstream")
+
+    parser.add_option("-p", "--project",
+                      action="append", dest="projects", default=[],
+                      help="Mirror this project, instead of Mirror's "
+                           "projects (can be given more than once)")
+
+    parser.add_option("-j", "--jobs",
+                      action="store", dest="jobs", type="int", default=None,
+                      help="Upstream requests at once, instead of Mirror's "
+                           "max_clients")
+
+    parser.add_option("-f", "--full",
+                      action="store_true", dest="full", default=False,
+                      help="Look at every project, not just the ones that "
+                           "changed since the last run")
+
+    options, args = parser.parse_args()
+
+    if options.config is None:
+        parser.error('Missing configuration file')
+
+    return options
+
+
+def main(options):
+    application_base = realpath(dirname(dirname(realpath(__file__))))
+
+    with open(options.config) as stream:
+        settings = yaml.load(stream)['Application']
+    base_path = settings.get('base_path', application_base)
+    config = settings.get('Mirror') or {}
+
+    try:
+        storage = ArtifactStorage(base_path, settings['PackageDirs'],
+                                  settings.get('storage_layout',
+                                               DEFAULT_STORAGE_LAYOUT))
+    except ValueError as out:
+        sys.stderr.write('%s\n' % out)
+        sys.exit(1)
+    index = PackageIndex(base_path, settings['PackageDirs'])
+    data = PyPIData(make_backend(settings.get('MetadataStore') or {},
+                                 base_path), index)
+    index.scan()
+    blob_dir = settings.get('blob_dir', DEFAULT_BLOB_DIR)
+
+    mirror = Mirror(
+        options.upstream or config.get('upstream', DEFAULT_UPSTREAM),
+        storage, index, data,
+        os.path.join(base_path, config.get('tmp_dir', DEFAULT_TMP_DIR)),
+        os.path.join(base_path, config.get('checkpoint',
+                                           DEFAULT_CHECKPOINT)),
+        options.jobs or config.get('max_clients', DEFAULT_MAX_CLIENTS),
+        BlobStore(os.path.join(base_path, blob_dir)) if blob_dir else None)
+
+    start = time.time()
+    try:
+        counts = tornado.ioloop.IOLoop.current().run_sync(
+            lambda: mirror.run(options.projects or config.get('projects'),
+                               options.full))
+    except UpstreamError as out:
+        sys.stderr.write('%s\n' % out)
+        sys.exit(1)
+    logging.info('%d projects synced, %d unchanged, %d failed; %d files '
+                 'fetched (%.1fMB), %d already here, %d failed, in %.1fs',
+                 counts['projects'], counts['unchanged_projects'],
+                 counts['failed_projects'], counts['fetched_files'],
+                 counts['bytes'] / 1048576.0, counts['skipped_files'],
+                 counts['failed_files'], time.time() - start)
+
+    index_file = settings.get('index_file', DEFAULT_INDEX_FILE)
+    if index_file and counts['fetched_files']:
+        shared = PackageIndex(base_path, settings['PackageDirs'],
+                              os.path.join(base_path, index_file))
+        PyPIData(data.backend, shared)
+        shared.scan()
+
+    if counts['failed_projects'] or counts['failed_files']:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(levelname)s   %(asctime)s %(message)s')
+    main(do_options())
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Move every file under PackageDirs to where storage_layout says it
+belongs (see core/storage.py): after adding a disk to PackageDirs, or
+switching from the flat layout to the sharded one. To take a disk out,
+run this with --drain <its PackageDirs entry> to empty it, then take it
+out of PackageDirs.
+
+Each file is moved with its metadata file, one rename (or copy and
+rename, across disks) at a time, so the server can keep running: a file
+is always whole at one place or the other, and its record in the
+metadata store follows it. If the server shares an index_file, a fresh
+one is written at the end; otherwise the servers' own rescans catch up.
+
+A file already at home under the same name as one being moved wins if
+their contents differ; the one being moved is left where it is and
+reported.
+
+"""
+import hashlib
+import logging
+import optparse
+import os
+from os.path import dirname, realpath
+import sys
+import time
+import yaml
+
+from MinistryOfPackages.core.blobs import move_atomic
+from MinistryOfPackages.core.dao import PyPIData, make_backend
+from MinistryOfPackages.core.index import (DEFAULT_INDEX_FILE,
+                                           METADATA_SUFFIX, PackageIndex,
+                                           normalize_name)
+from MinistryOfPackages.core.storage import (DEFAULT_STORAGE_LAYOUT,
+                                             ArtifactStorage)
+
+# Files moved per metadata store transaction.
+BATCH_SIZE = 500
+
+# Seconds between progress reports.
+PROGRESS_INTERVAL = 5
+
+
+def do_options():
+    usage = "usage: %prog -c <configfile> [options]"
+    parser = optparse.OptionParser(usage=usage)
+
+    parser.add_option("-c", "--config",
+                      action="store", dest="config",
+                      help="Specify the configuration file for use")
+
+    parser.add_option("-n", "--dry-run",
+                      action="store_true", dest="dry_run", default=False,
+                      help="Say what would move, without moving anything")
+
+    parser.add_option("-d", "--drain",
+                      action="append", dest="drain", default=[],
+                      help="Move everything off this PackageDirs entry "
+                           "(can be given more than once)")
+
+    options, args = parser.parse_args()
+
+    if options.config is None:
+        parser.error('Missing configuration file')
+
+    return options
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def same_contents(a, b):
+    return (os.path.getsize(a) == os.path.getsize(b) and
+            file_sha256(a) == file_sha256(b))
+
+
+def move_file(storage, source, dest):
+    """
+    Move 'source' and its metadata file to 'dest'. Returns False if
+    there's a different file at 'dest' already.
+
+    """
+    if os.path.exists(dest):
+        if not same_contents(source, dest):
+            return False
+        storage.remove(source)
+        return True
+    # The metadata file goes first, so the file never shows up without it.
+    if os.path.exists(source + METADATA_SUFFIX):
+        move_atomic(source + METADATA_SUFFIX, dest + METADATA_SUFFIX)
+    move_atomic(source, dest)
+    storage.remove(source)
+    return True
+
+
+def file_records(data, todo):
+    """
+    {(normalized, filename): record} from the metadata store, for the
+    files in 'todo'.
+
+    """
+    records = {}
+    backend = data.read()
+    for normalized in set(normalize_name(item[0]) for item in todo):
+        for record in backend.get_files(normalized):
+            records[(normalized, record['filename'])] = record
+    return records
+
+
+def moved_record(data, project_name, record, path, url):
+    """
+    Point the metadata store's record of a file at its new place.
+
+    """
+    record = dict(record)
+    version = record.pop('version')
+    filename = record.pop('filename')
+    record.update(path=path, url=url)
+    data.store_pkg_file(project_name, version, filename, **record)
+
+
+def main(options):
+    application_base = realpath(dirname(dirname(realpath(__file__))))
+
+    with open(options.config) as stream:
+        settings = yaml.load(stream)['Application']
+    base_path = settings.get('base_path', application_base)
+
+    try:
+        storage = ArtifactStorage(base_path, settings['PackageDirs'],
+                                  settings.get('storage_layout',
+                                               DEFAULT_STORAGE_LAYOUT),
+                                  options.drain)
+    except ValueError as out:
+        sys.stderr.write('%s\n' % out)
+        sys.exit(1)
+    index = PackageIndex(base_path, settings['PackageDirs'])
+    data = PyPIData(make_backend(settings.get('MetadataStore') or {},
+                                 base_path))
+
+    # Root by root, so a file that's in more than one is seen in each.
+    todo = []
+    for root in settings['PackageDirs']:
+        projects = {}
+        index.scan_root(os.path.join(base_path, root), projects)
+        for project in projects.values():
+            for dist in project.files.values():
+                dest = storage.path_for(project.name, dist.filename)
+                if dist.path != dest:
+                    todo.append((project.name, dist.filename, dist.path,
+                                 dest))
+    todo.sort()
+    logging.info('%d files to move', len(todo))
+    if options.dry_run:
+        for project_name, filename, source, dest in todo:
+            logging.info('%s -> %s', source, dest)
+        return
+
+    start = last_report = time.time()
+    moved = left = 0
+    for i in range(0, len(todo), BATCH_SIZE):
+        chunk = todo[i:i + BATCH_SIZE]
+        records = file_records(data, chunk)
+        with data.batch():
+            for project_name, filename, source, dest in chunk:
+                try:
+                    if not move_file(storage, source, dest):
+                        left += 1
+                        logging.warning('Not moving %s: %s is different',
+                                        source, dest)
+                        continue
+                except (IOError, OSError) as out:
+                    left += 1
+                    logging.error('Moving %s: %s', source, out)
+                    continue
+                moved += 1
+                record = records.get((normalize_name(project_name),
+                                      filename))
+                if record is not None and record['path'] == source:
+                    moved_record(data, project_name, record, dest,
+                                 '/' + os.path.relpath(dest, base_path))
+
+        now = time.time()
+        if now - last_report >= PROGRESS_INTERVAL:
+            last_report = now
+            logging.info('%d/%d files, %.0f/s', moved + left, len(todo),
+                         (moved + left) / (now - start))
+    logging.info('Moved %d files in %.1fs, %d left where they were', moved,
+                 time.time() - start, left)
+
+    index_file = settings.get('index_file', DEFAULT_INDEX_FILE)
+    if index_file and moved:
+        # Digests come from the metadata store, by the files' new paths.
+        shared = PackageIndex(base_path, settings['PackageDirs'],
+                              os.path.join(base_path, index_file))
+        PyPIData(data.backend, shared)
+        shared.scan()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(levelname)s   %(asctime)s %(message)s')
+    main(do_options())
@@ -25,19 +25,32 @@ import optparse
 import os
 from os.path import dirname, realpath
 import signal
+import socket
 import sys
+import time
 import yaml
 
 # THIRD PARTY MODULES
 # Redis will be implemented later & hopefully made optional
 # import redis
 import tornado.httpserver
+import tornado.httputil
 import tornado.ioloop
+import tornado.netutil
 import tornado.options
 import tornado.web
 
 # OUR OWN MODULES
 from MinistryOfPackages.core.daemonize import daemonize
+from MinistryOfPackages.core.dao import PyPIData, make_backend, pypi_data
+from MinistryOfPackages.core.distmeta import metadata_extractor
+from MinistryOfPackages.core.index import (DEFAULT_INDEX_FILE,
+                                           DEFAULT_REFRESH_INTERVAL,
+                                           PackageIndex)
+from MinistryOfPackages.core.metrics import Metrics
+from MinistryOfPackages.core.scoreboard import Scoreboard, load_report
+from MinistryOfPackages.core.search import search_index
+from MinistryOfPackages.core.watcher import package_watcher
 
 __appname__ = 'MinistryOfPackages'
 __author__ = 'Brian K. Jones'
@@ -45,6 +58,33 @@ __email__ = 'bkjones@gmail.com'
 __since__ = '2010-11-18'
 __version__ = '0.5.3'
 
+# Seconds between the parent's per-worker load reports. 0 turns them off.
+DEFAULT_LOAD_REPORT_INTERVAL = 60
+
+# Seconds a worker told to stop gets to finish its requests in progress.
+DEFAULT_DRAIN_TIMEOUT = 30
+
+# A crashed worker is restarted after RESTART_BACKOFF seconds, doubling
+# with each crash in a row up to MAX_RESTART_BACKOFF. One that stays up for
+# STABLE_UPTIME seconds has its crash count reset.
+RESTART_BACKOFF = 1
+MAX_RESTART_BACKOFF = 60
+STABLE_UPTIME = 30
+
+# Seconds the new workers get to start accepting on a reload before it's
+# abandoned and the old ones are left running.
+STARTUP_TIMEOUT = 30
+
+# Seconds past its drain timeout before a stopping worker is killed.
+KILL_GRACE = 5
+
+# How often the supervisor checks on its workers, in seconds.
+SUPERVISE_INTERVAL = 0.5
+
+# The scoreboard needs room for a reload's new workers alongside the old
+# ones still draining.
+MIN_SCOREBOARD_SLOTS = 256
+
 # for tracking tornado processes
 children = []
 
@@ -80,8 +120,9 @@ class Application(tornado.web.Application):
         settings['version'] = __version__
 
         # The base directory for the main application. By default,
-        # should be /opt/MinistryOfPackages/
-        settings['base_path'] = application_base
+        # should be /opt/MinistryOfPackages/, the directory above this
+        # script, but the config can point it elsewhere.
+        settings.setdefault('base_path', application_base)
 
         # If we have a static_path
         if 'static_path' in settings:
@@ -100,28 +141,186 @@ class Application(tornado.web.Application):
         # Create our Application for this process
         tornado.web.Application.__init__(self, handlers, **settings)
 
+        # runapp hands us our slots on the parent's scoreboard and metrics.
+        self.worker_stats = None
+        self.worker_metrics = None
+        self.metrics = None
+        self.inflight = {}
+        self.add_transform(ResponseBytes)
+
+    def start_request(self, server_conn, request_conn):
+        delegate = tornado.web.Application.start_request(self, server_conn,
+                                                         request_conn)
+        if self.worker_stats is None:
+            return delegate
+        return RequestTracker(self, request_conn, delegate)
+
+    def get_handler_delegate(self, request, target_class, *args, **kwargs):
+        tracker = self.inflight.get(request.connection)
+        if tracker is not None:
+            tracker.routed(target_class.__name__)
+        return tornado.web.Application.get_handler_delegate(
+            self, request, target_class, *args, **kwargs)
+
+    def log_request(self, handler):
+        tornado.web.Application.log_request(self, handler)
+        tracker = self.inflight.pop(handler.request.connection, None)
+        if tracker is not None:
+            tracker.done(handler.get_status(),
+                         getattr(handler.request, 'response_bytes', 0))
+
+
+class ResponseBytes(tornado.web.OutputTransform):
+    """
+    Counts the response body bytes sent for a request, as
+    request.response_bytes, after any other transforms (like gzip).
 
-def runapp(port, config):
     """
-    This is responsible for launching the service proper.
+
+    def __init__(self, request):
+        self.request = request
+        request.response_bytes = 0
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        self.request.response_bytes += len(chunk)
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        self.request.response_bytes += len(chunk)
+        return chunk
+
+
+class RequestTracker(tornado.httputil.HTTPMessageDelegate):
+    """
+    Wraps the Application's per-request delegate to follow one request
+    through the worker, for the scoreboard and the metrics.
+
+    The request counts as in flight from when its headers arrive, and for
+    its handler once the Application has routed it. log_request counts it
+    off again, or on_connection_close does if the connection drops before
+    the handler finishes (an upload that's too large, say).
+
+    HTTPServer calls start_request whenever it's ready to read another
+    request from a connection, whether or not one ever comes, which is why
+    this doesn't count anything there.
 
     """
+
+    def __init__(self, application, request_conn, delegate):
+        self.application = application
+        self.request_conn = request_conn
+        self.delegate = delegate
+        self.start_time = None
+        self.handler_name = None
+        self.received = 0
+        self.body_start = None
+        self.body_end = None
+
+    def headers_received(self, start_line, headers):
+        self.start_time = time.time()
+        self.application.inflight[self.request_conn] = self
+        self.application.worker_stats.request_started()
+        return self.delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        if self.body_start is None:
+            self.body_start = time.time()
+        self.received += len(chunk)
+        return self.delegate.data_received(chunk)
+
+    def finish(self):
+        self.body_end = time.time()
+        self.delegate.finish()
+
+    def on_connection_close(self):
+        if self.application.inflight.get(self.request_conn) is self:
+            del self.application.inflight[self.request_conn]
+            self.done(None, 0)
+        self.delegate.on_connection_close()
+
+    def routed(self, handler_name):
+        self.handler_name = handler_name
+        self.application.worker_metrics.handler_started(handler_name)
+
+    def done(self, status, response_bytes):
+        now = time.time()
+        self.application.worker_stats.request_finished(now - self.start_time)
+        if self.handler_name is None:
+            return
+        if self.body_start is not None:
+            body_seconds = (self.body_end or now) - self.body_start
+        else:
+            body_seconds = 0
+        metrics = self.application.worker_metrics
+        metrics.handler_done(self.handler_name)
+        metrics.record(self.handler_name, status, now - self.start_time,
+                       response_bytes, self.received, body_seconds)
+
+
+def runapp(port, config, sockets, scoreboard, metrics, slot):
+    """
+    This is responsible for launching the service proper. It runs in a
+    worker process, accepting connections on 'sockets', which the parent
+    bound before forking and shares with this port's other workers. If
+    'sockets' is None, each worker binds its own with SO_REUSEPORT and the
+    kernel spreads connections between them.
+
+    SIGTERM makes the worker drain: it stops accepting and exits once the
+    requests it's working on are done, or the drain timeout runs out.
+
+    """
+    # Whatever the parent had spawned before forking us isn't ours to reap,
+    # and its signal handlers aren't ours either.
+    del children[:]
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+
     #create the app object that Tornado will run.
     app = Application(config)
 
     # Remember: runapp is called per port in the YAML config file. We set the
     # app's port explicitly so we can log the port a request came in on.
     app.port = port
+    stats = scoreboard.worker(slot)
+    app.worker_stats = stats
+    app.worker_metrics = metrics.worker(slot)
+    app.metrics = metrics
+
+    # The metadata processes are forked now, before there are any threads
+    # or sockets of ours for them to inherit.
+    extractor = metadata_extractor(app)
 
     # Run it!
     http_server = tornado.httpserver.HTTPServer(app,
                       xheaders=config['HTTPServer']['xheaders'],
                       no_keep_alive=config['HTTPServer']['no_keep_alive'])
 
-    http_server.listen(port)
+    if sockets is None:
+        sockets = tornado.netutil.bind_sockets(port, reuse_port=True)
+    http_server.add_sockets(sockets)
+
+    # Build the search index before taking requests, rather than on the
+    # first search.
+    search_index(app).refresh()
+
+    # Claiming the slot is what tells the supervisor we're accepting.
+    stats.claim(os.getpid(), port)
+
+    main_loop = tornado.ioloop.IOLoop.instance()
+    if extractor is not None:
+        main_loop.add_callback(extractor.watch, pypi_data(app))
+    watcher = package_watcher(app)
+    if watcher is not None:
+        main_loop.add_callback(watcher.start)
+    drain_timeout = config['HTTPServer'].get('drain_timeout',
+                                             DEFAULT_DRAIN_TIMEOUT)
+
+    def on_sigterm(sig, frame):
+        main_loop.add_callback_from_signal(drain, main_loop, http_server,
+                                           app, drain_timeout)
+    signal.signal(signal.SIGTERM, on_sigterm)
 
     try:
-        main_loop = tornado.ioloop.IOLoop.instance()
         logging.debug("MAIN IOLOOP: %s", main_loop)
         main_loop.start()
     except KeyboardInterrupt:
@@ -129,6 +328,53 @@ def runapp(port, config):
     except Exception as out:
         logging.error(out)
         shutdown()
+    finally:
+        # Anything the drain didn't get written, if it got that far.
+        try:
+            flush_metadata(app)
+        finally:
+            stats.release()
+            if extractor is not None:
+                extractor.shutdown()
+
+
+def drain(io_loop, http_server, app, timeout):
+    """
+    Stop accepting connections, then write out any queued metadata and
+    stop the IOLoop once the requests in progress have finished or
+    'timeout' seconds have passed.
+
+    """
+    if getattr(app, 'draining', False):
+        return
+    app.draining = True
+    logging.info('Draining, %d requests in flight', len(app.inflight))
+    http_server.stop()
+    deadline = io_loop.time() + timeout
+
+    def check():
+        if app.inflight and io_loop.time() < deadline:
+            io_loop.call_later(0.1, check)
+            return
+        if app.inflight:
+            logging.warning('Drain timed out with %d requests in flight',
+                            len(app.inflight))
+        # Metadata from requests that have had their response can still
+        # be waiting out its batch delay.
+        try:
+            flush_metadata(app)
+        finally:
+            io_loop.stop()
+    check()
+
+
+def flush_metadata(app):
+    """
+    Write out whatever the app's metadata store has queued, if it has one.
+
+    """
+    if getattr(app, 'pypi_data', None) is not None:
+        pypi_data(app).flush()
 
 
 def shutdown():
@@ -249,6 +495,14 @@ def do_options():
     return options
 
 
+def load_config(path):
+    stream = file(path, 'r')
+    try:
+        return yaml.load(stream)
+    finally:
+        stream.close()
+
+
 def do_config(options):
     """
     CLI options are really for specifying how the server daemon should start up
@@ -257,9 +511,7 @@ def do_config(options):
 
     """
     try:
-        stream = file(options.config, 'r')
-        config = yaml.load(stream)
-        stream.close()
+        config = load_config(options.config)
     except IOError as err:
         sys.stderr.write('Configuration file not found "%s"\n' %
             options.config)
@@ -276,17 +528,271 @@ def signal_handler(sig, frame):
     shutdown()
 
 
-def main(config):
-    for port in config['HTTPServer']['ports']:
-        logging.info('Spawning on port %i', port)
-        proc = multiprocessing.Process(target=runapp, args=(port, config))
-        proc.start()
-        children.append(proc)
+def handler_names(config):
+    names = set()
+    for dispatch_def in config['RequestHandlers']:
+        for handler in dispatch_def:
+            names.add(handler.rsplit('.', 1)[1])
+    return sorted(names)
+
+
+def prepare_index(config):
+    """
+    Bring the shared package index up to date before forking workers, so
+    all they have to do is map it, rather than all scanning PackageDirs
+    at once as they start.
+
+    """
+    settings = config['Application']
+    index_file = settings.get('index_file', DEFAULT_INDEX_FILE)
+    if not index_file:
+        return
+    base_path = settings.get('base_path', application_base)
+    index = PackageIndex(base_path, settings['PackageDirs'],
+                         os.path.join(base_path, index_file))
+    try:
+        # The metadata store is where the files' digests come from.
+        PyPIData(make_backend(settings.get('MetadataStore') or {}, base_path),
+                 index)
+        index.refresh(settings.get('index_refresh_interval',
+                                   DEFAULT_REFRESH_INTERVAL))
+    except (IOError, OSError) as err:
+        logging.error("Can't prepare the package index, leaving it to the "
+                      "workers: %s", err)
+
+
+class Worker(object):
+    """
+    One worker the supervisor keeps running: the port it serves, its
+    scoreboard slot, and its current process.
+
+    """
+
+    def __init__(self, port, slot):
+        self.port = port
+        self.slot = slot
+        self.proc = None
+        self.started = None
+        self.crashes = 0
+        self.restart_at = None
+
+
+class Supervisor(object):
+    """
+    Runs in the parent process. Keeps a generation of workers running as
+    the config describes, restarting any that die, and on SIGHUP swaps in
+    a new generation built from the re-read config file.
+
+    A reload starts the new workers first and waits for them to start
+    accepting before telling the old ones to drain. Listening sockets are
+    bound here once per port and kept across reloads, so connections queue
+    up on the same socket throughout and none are refused. (With reuse_port,
+    connections still queued on an old worker's own socket when it stops
+    are lost, so shared sockets are the better choice for reloads.)
+
+    """
 
-    # Handle signals. So if you kill the parent process, the children get
-    # cleaned up.
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+    def __init__(self, config_path, config):
+        self.config_path = config_path
+        self.config = config
+        self.sockets = {}
+        self.workers = []
+        self.draining = {}
+        self.reload_requested = False
+
+        server_config = config['HTTPServer']
+        slots = max(MIN_SCOREBOARD_SLOTS,
+                    2 * len(server_config['ports']) *
+                    (server_config.get('workers') or
+                     multiprocessing.cpu_count()))
+        self.scoreboard = Scoreboard(slots)
+        self.metrics = Metrics(slots, handler_names(config))
+        self.free_slots = range(slots)
+
+    def start_generation(self, config):
+        server_config = config['HTTPServer']
+        ports = server_config['ports']
+
+        # Workers per port. They share the port's listening socket, so
+        # adding workers (up to a core each) adds throughput.
+        count = server_config.get('workers') or multiprocessing.cpu_count()
+        if count * len(ports) > len(self.free_slots):
+            raise ValueError('No scoreboard room for %d more workers' %
+                             (count * len(ports)))
+
+        reuse_port = server_config.get('reuse_port', False)
+        if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+            logging.warning('SO_REUSEPORT not available, sharing one socket '
+                            'per port instead')
+            reuse_port = False
+
+        if not reuse_port:
+            for port in ports:
+                if port not in self.sockets:
+                    self.sockets[port] = tornado.netutil.bind_sockets(port)
+
+        workers = []
+        for port in ports:
+            logging.info('Spawning %i workers on port %i', count, port)
+            for n in range(count):
+                worker = Worker(port, self.free_slots.pop(0))
+                self.spawn(worker, config, reuse_port)
+                workers.append(worker)
+        return workers
+
+    def spawn(self, worker, config=None, reuse_port=None):
+        config = config or self.config
+        if reuse_port is None:
+            reuse_port = config['HTTPServer'].get('reuse_port', False)
+        sockets = None if reuse_port else self.sockets[worker.port]
+        worker.proc = multiprocessing.Process(
+            target=runapp,
+            args=(worker.port, config, sockets, self.scoreboard,
+                  self.metrics, worker.slot))
+        worker.proc.start()
+        worker.started = time.time()
+        children.append(worker.proc)
+
+    def reap(self, proc, slot):
+        proc.join()
+        if proc in children:
+            children.remove(proc)
+        # A worker that crashed never got to clear its own slot.
+        self.scoreboard.worker(slot).release()
+        self.metrics.worker(slot).reset_gauges()
+
+    def check_workers(self):
+        now = time.time()
+        for worker in self.workers:
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    worker.restart_at = None
+                    self.spawn(worker)
+                continue
+
+            if worker.proc.is_alive():
+                if worker.crashes and now - worker.started > STABLE_UPTIME:
+                    worker.crashes = 0
+                continue
+
+            self.reap(worker.proc, worker.slot)
+            worker.crashes += 1
+            delay = min(MAX_RESTART_BACKOFF,
+                        RESTART_BACKOFF * 2 ** (worker.crashes - 1))
+            worker.restart_at = now + delay
+            logging.error('Worker %d on port %d exited with %s, restarting '
+                          'in %ds', worker.proc.pid, worker.port,
+                          worker.proc.exitcode, delay)
+
+        for proc, (slot, deadline) in self.draining.items():
+            if not proc.is_alive():
+                self.reap(proc, slot)
+                self.free_slots.append(slot)
+                del self.draining[proc]
+            elif now > deadline:
+                logging.warning('Worker %d did not drain in time, killing it',
+                                proc.pid)
+                os.kill(proc.pid, signal.SIGKILL)
+
+    def stop(self, workers, drain_timeout):
+        """
+        Tell 'workers' to drain, and give them a little longer than they
+        give themselves before check_workers kills them.
+
+        """
+        deadline = time.time() + drain_timeout + KILL_GRACE
+        for worker in workers:
+            if worker.restart_at is None and worker.proc.is_alive():
+                worker.proc.terminate()
+                self.draining[worker.proc] = (worker.slot, deadline)
+            else:
+                if worker.restart_at is None:
+                    self.reap(worker.proc, worker.slot)
+                self.free_slots.append(worker.slot)
+
+    def started(self, workers):
+        """
+        Wait for every one of 'workers' to claim its scoreboard slot, which
+        it does once it's accepting. False if one dies or time runs out.
+
+        """
+        deadline = time.time() + STARTUP_TIMEOUT
+        while time.time() < deadline:
+            if not all(w.proc.is_alive() for w in workers):
+                return False
+            if all(self.scoreboard.read(w.slot)['pid'] == w.proc.pid
+                   for w in workers):
+                return True
+            time.sleep(0.1)
+        return False
+
+    def reload(self):
+        logging.info('Reloading %s', self.config_path)
+        try:
+            config = load_config(self.config_path)
+            prepare_index(config)
+            workers = self.start_generation(config)
+        except (IOError, ValueError, socket.error, yaml.YAMLError) as err:
+            logging.error('Reload failed, keeping the running workers: %s',
+                          err)
+            return
+
+        if not self.started(workers):
+            logging.error('New workers failed to start, keeping the running '
+                          'workers')
+            self.stop(workers, 0)
+            return
+
+        old, self.workers, self.config = self.workers, workers, config
+        self.stop(old, config['HTTPServer'].get('drain_timeout',
+                                                DEFAULT_DRAIN_TIMEOUT))
+
+        # Ports dropped from the config: the old workers have their own
+        # copies of these sockets to drain with.
+        ports = config['HTTPServer']['ports']
+        if config['HTTPServer'].get('reuse_port', False):
+            ports = []
+        for port in self.sockets.keys():
+            if port not in ports:
+                for sock in self.sockets.pop(port):
+                    sock.close()
+        logging.info('Reload complete, draining %d old workers', len(old))
+
+    def on_sighup(self, sig, frame):
+        self.reload_requested = True
+
+    def run(self):
+        prepare_index(self.config)
+        self.workers = self.start_generation(self.config)
+
+        # Handle signals. So if you kill the parent process, the children get
+        # cleaned up.
+        signal.signal(signal.SIGINT, signal_handler)
+        signal.signal(signal.SIGTERM, signal_handler)
+        signal.signal(signal.SIGHUP, self.on_sighup)
+
+        before = self.scoreboard.snapshot()
+        last_report = time.time()
+        while True:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            self.check_workers()
+
+            interval = self.config['HTTPServer'].get(
+                'load_report_interval', DEFAULT_LOAD_REPORT_INTERVAL)
+            now = time.time()
+            if interval and now - last_report >= interval:
+                after = self.scoreboard.snapshot()
+                for line in load_report(before, after, now - last_report):
+                    logging.info(line)
+                before, last_report = after, now
+
+            time.sleep(SUPERVISE_INTERVAL)
+
+
+def main(config, config_path):
+    Supervisor(config_path, config).run()
 
 if __name__ == "__main__":
     # daemonization causes realpath(__file__) to return '/', so we get the real
@@ -294,6 +800,8 @@ if __name__ == "__main__":
     application_base = realpath(dirname(dirname(realpath(__file__))))
     options = do_options()
     config = do_config(options)
+    # The supervisor re-reads it on SIGHUP, after daemonize has chdir'd.
+    options.config = os.path.abspath(options.config)
     if 'Logging' in config.keys():
         do_logging(config["Logging"], options)
     if not options.foreground:
@@ -304,4 +812,4 @@ if __name__ == "__main__":
             stderr='/dev/null',
             stdout = '/dev/null')
 
-    main(config)
+    main(config, options.config)
@@ -9,7 +9,7 @@ def read(fname):
 
 setup(name='MinistryOfPackages',
       version='0.9.5',
-      requires=['pyyaml', 'tornado'],
+      requires=['pyyaml', 'tornado (>=4.5)', 'futures', 'scandir'],
       description='A minimal PyPI implementation meant for use' +
                    'behind a firewall.',
       long_description=read("README.rst"),
@@ -19,9 +19,15 @@ setup(name='MinistryOfPackages',
       packages=['MinistryOfPackages', 'MinistryOfPackages.core',
                 'MinistryOfPackages.handlers'],
       data_files=[('/opt/MinistryOfPackages/etc', ['etc/config.yaml']),
-                  ('/opt/MinistryOfPackages/bin', ['bin/ministry_server.py']),
+                  ('/opt/MinistryOfPackages/bin', ['bin/ministry_server.py',
+                                                   'bin/ministry_export.py',
+                                                   'bin/ministry_backfill.py',
+                                                   'bin/ministry_rebalance.py',
+                                                   'bin/ministry_mirror.py']),
                   ('/opt/MinistryOfPackages/templates',
-                   ['templates/dlist.html']),
+                   ['templates/dlist.html',
+                    'templates/simple_index.html',
+                    'templates/simple_project.html']),
                   ('/var/log/MinistryOfPackages', ['README.rst']),
                   ('/etc/init.d', ['init/MinistryOfPackages'])],
       classifiers=[
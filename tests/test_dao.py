@@ -0,0 +1,170 @@
+"""
+core.dao's backends: batching, against the SQLite backend, and serials,
+against the Redis backend with fakeredis standing in for redis-server.
+
+"""
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+import tornado.gen
+import tornado.testing
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from MinistryOfPackages.core import dao
+from MinistryOfPackages.core.dao import PyPIData, make_backend
+
+
+class Busy(object):
+    """
+    Stands in for Backend.apply, failing the first 'failures' times it's
+    called as if the database were locked.
+
+    """
+
+    def __init__(self, apply, failures=1):
+        self.apply = apply
+        self.failures = failures
+
+    def __call__(self, ops):
+        self.thread = threading.current_thread()
+        if self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError('database is locked')
+        return self.apply(ops)
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.data = PyPIData(make_backend({}, self.base))
+        self.backend = self.data.backend
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def test_read_inside_batch(self):
+        self.data.store_pkg_metadata('foo', '1.0', {'summary': 'one'})
+        with self.assertRaises(ValueError):
+            with self.data.batch():
+                self.data.store_pkg_metadata('foo', '2.0', {})
+                # A read, which used to apply the batch so far.
+                self.data.update_pkg_metadata('foo', summary='latest')
+                raise ValueError
+        self.assertEqual(self.data.get_versions('foo'), ['1.0'])
+        self.assertEqual(self.data.get_pkg_meta_field('foo', 'summary',
+                                                      '1.0'), 'one')
+
+        with self.data.batch():
+            self.data.store_pkg_metadata('foo', '2.0', {})
+            self.data.store_pkg_metadata('bar', '1.0', {})
+            self.assertEqual(self.backend.get_versions('foo'), ['1.0'])
+        self.assertEqual(self.data.get_versions('foo'), ['2.0', '1.0'])
+        self.assertEqual(self.data.get_versions('bar'), ['1.0'])
+
+    def test_apply_failure(self):
+        self.backend.apply = Busy(self.backend.apply)
+        with self.assertRaises(sqlite3.OperationalError):
+            self.data.store_pkg_metadata('foo', '1.0', {})
+        # Kept, and written with the next flush.
+        self.assertEqual(len(self.backend.pending), 1)
+        self.data.store_pkg_metadata('foo', '2.0', {})
+        self.assertEqual(self.data.get_versions('foo'), ['2.0', '1.0'])
+
+    def test_apply_failure_in_batch(self):
+        self.backend.apply = Busy(self.backend.apply)
+        with self.assertRaises(sqlite3.OperationalError):
+            self.data.store_pkg_metadata('foo', '1.0', {})
+        self.backend.apply.failures = 1
+        with self.assertRaises(sqlite3.OperationalError):
+            with self.data.batch():
+                self.data.store_pkg_metadata('bar', '1.0', {})
+        # The batch is gone, but what was queued before it isn't.
+        self.assertEqual(self.backend.pending[0][1:4], ('foo', 'foo', '1.0'))
+        self.assertEqual(len(self.backend.pending), 1)
+        self.backend.flush()
+        self.assertEqual(self.data.get_versions('foo'), ['1.0'])
+        self.assertEqual(self.data.get_versions('bar'), [])
+
+
+class DelayedBatchTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(DelayedBatchTest, self).setUp()
+        self.base = tempfile.mkdtemp()
+        self.data = PyPIData(make_backend(
+            {'batch_delay': 0.01, 'retry_delay': 0.05}, self.base))
+        self.backend = self.data.backend
+
+    def tearDown(self):
+        self.backend.writer.shutdown()
+        shutil.rmtree(self.base)
+        super(DelayedBatchTest, self).tearDown()
+
+    @tornado.testing.gen_test
+    def test_retry(self):
+        self.backend.apply = Busy(self.backend.apply)
+        self.data.store_pkg_metadata('foo', '1.0', {})
+        # Nothing else is queued, and nothing reads, but it's written
+        # anyway once the retry comes round.
+        yield tornado.gen.sleep(0.3)
+        self.assertEqual(self.backend.pending, [])
+        self.assertIsNone(self.backend.writing)
+        self.assertEqual(self.backend.get_versions('foo'), ['1.0'])
+        self.assertIsNot(self.backend.apply.thread, threading.current_thread())
+
+    @tornado.testing.gen_test
+    def test_read_waits(self):
+        self.data.store_pkg_metadata('foo', '1.0', {})
+        self.backend.flush_later()
+        self.assertIsNotNone(self.backend.writing)
+        self.data.store_pkg_metadata('foo', '2.0', {})
+        # Both the batch on the writer thread and the one still queued.
+        self.assertEqual(self.data.get_versions('foo'), ['2.0', '1.0'])
+        self.assertIsNone(self.backend.writing)
+        yield tornado.gen.sleep(0.05)
+
+
+@unittest.skipIf(fakeredis is None, "needs fakeredis")
+class RedisSerialTest(unittest.TestCase):
+
+    def setUp(self):
+        server = fakeredis.FakeServer()
+        # Two processes' worth, sharing one server.
+        self.backends = []
+        for i in range(2):
+            backend = dao.RedisBackend()
+            backend.db = fakeredis.FakeStrictRedis(server=server)
+            self.backends.append(backend)
+
+    def test_concurrent_apply(self):
+        first, second = self.backends
+        apply_release = first.apply_release
+        interrupted = []
+        calls = []
+
+        def racing_apply_release(*args):
+            # Another process commits while this one is between WATCH
+            # and EXEC, the first time round.
+            if not interrupted:
+                interrupted.append(second.apply(
+                    [('release', 'bar', 'bar', '1.0', {}, 0)]))
+            calls.append(args)
+            apply_release(*args)
+        first.apply_release = racing_apply_release
+
+        changes = first.apply([('release', 'foo', 'foo', '1.0', {}, 0)])
+        self.assertEqual(interrupted, [{'bar': (None, 1)}])
+        # The first go was thrown away, and the serial it would have had
+        # went to the other process.
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(changes, {'foo': (None, 2)})
+        self.assertEqual(first.get_changed_projects(1), [('foo', 2)])
+        self.assertEqual(first.get_project('foo'), ('foo', 2))
@@ -0,0 +1,78 @@
+"""
+core.distmeta's MetadataExtractor when its pool processes fail.
+
+"""
+import os
+import shutil
+import tempfile
+
+import tornado.gen
+import tornado.testing
+
+from MinistryOfPackages.core import distmeta
+from MinistryOfPackages.core.index import DistFile, Project
+
+
+def die(path, digests=True):
+    os._exit(1)
+
+
+def fail(path, digests=True):
+    raise ValueError(path)
+
+
+class ExtractorTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(ExtractorTest, self).setUp()
+        self.base = tempfile.mkdtemp()
+        self.saved = (distmeta.extract, distmeta.EXTRACT_TIMEOUT,
+                      distmeta.EXTRACT_CHECK_INTERVAL)
+        distmeta.EXTRACT_TIMEOUT = 1
+        distmeta.EXTRACT_CHECK_INTERVAL = 0.1
+        self.extractor = None
+
+    def tearDown(self):
+        if self.extractor is not None:
+            self.extractor.shutdown()
+        (distmeta.extract, distmeta.EXTRACT_TIMEOUT,
+         distmeta.EXTRACT_CHECK_INTERVAL) = self.saved
+        shutil.rmtree(self.base)
+        super(ExtractorTest, self).tearDown()
+
+    def make_extractor(self, extract):
+        # The pool processes look extract() up when they're handed it.
+        distmeta.extract = extract
+        self.extractor = distmeta.MetadataExtractor(
+            1, os.path.join(self.base, 'scan.lock'))
+        return self.extractor
+
+    @tornado.testing.gen_test(timeout=10)
+    def test_raises(self):
+        extractor = self.make_extractor(fail)
+        with self.assertRaises(ValueError):
+            yield extractor.extract('x.tar.gz')
+        self.assertEqual(extractor.outstanding, {})
+
+    @tornado.testing.gen_test(timeout=10)
+    def test_dies(self):
+        extractor = self.make_extractor(die)
+        with self.assertRaises(RuntimeError):
+            yield extractor.extract('x.tar.gz')
+        self.assertEqual(extractor.outstanding, {})
+
+    @tornado.testing.gen_test(timeout=10)
+    def test_catch_up_lets_go(self):
+        extractor = self.make_extractor(die)
+        project = Project('foo')
+        project.files['foo-1.0.tar.gz'] = DistFile(
+            'foo-1.0.tar.gz', '1.0', os.path.join(self.base, 'foo-1.0.tar.gz'),
+            '/foo-1.0.tar.gz', 0, 0)
+        extractor.catch_up(None, {'foo': project})
+        self.assertEqual(extractor.scanning, 1)
+        while extractor.scanning:
+            yield tornado.gen.sleep(0.1)
+        # The scan lock's free for the next one.
+        lockfile = distmeta.try_lock(extractor.lock_path)
+        self.assertIsNotNone(lockfile)
+        lockfile.close()
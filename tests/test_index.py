@@ -0,0 +1,90 @@
+"""
+Rescanning core.index's PackageIndex while uploads are coming in, and
+off the IOLoop.
+
+"""
+import os
+import shutil
+import tempfile
+import threading
+
+import tornado.testing
+
+from MinistryOfPackages.core.executor import IOExecutor
+from MinistryOfPackages.core.index import PackageIndex
+
+
+class ScanTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(ScanTest, self).setUp()
+        self.base = tempfile.mkdtemp()
+        self.executor = IOExecutor(1)
+        self.index = PackageIndex(self.base, ['packages'])
+        self.add('old', 'old-1.0.tar.gz')
+        self.index.scan()
+
+    def tearDown(self):
+        self.executor.shutdown()
+        shutil.rmtree(self.base)
+        super(ScanTest, self).tearDown()
+
+    def add(self, name, filename):
+        path = os.path.join(self.base, 'packages', name, filename)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(filename)
+        return path
+
+    @tornado.testing.gen_test
+    def test_upload_during_scan(self):
+        # The walk is done before the upload, but the scan only finishes
+        # after it.
+        walked = threading.Event()
+        resume = threading.Event()
+        read_all = self.index.read_all
+
+        def slow_read_all():
+            scanned = read_all()
+            walked.set()
+            resume.wait()
+            return scanned
+        self.index.read_all = slow_read_all
+
+        scanning = self.index.scan_on(self.executor)
+        walked.wait()
+        self.index.add_file('new', self.add('new', 'new-1.0.tar.gz'))
+        self.index.remove_file('old', 'old-1.0.tar.gz')
+        resume.set()
+        yield scanning
+        self.assertIsNotNone(self.index.find('new'))
+        self.assertIsNone(self.index.find('old'))
+        self.assertIsNone(self.index.journal)
+
+    @tornado.testing.gen_test
+    def test_shared_scan_off_loop(self):
+        index = PackageIndex(self.base, ['packages'],
+                             os.path.join(self.base, 'var', 'index.bin'))
+        index.scan()
+        path = self.add('new', 'new-1.0.tar.gz')
+        threads = []
+
+        def digests(normalized, flush):
+            threads.append((threading.current_thread(), flush))
+            return {path: 'ab' * 32}
+        index.digest_source = digests
+        publish = index.publish
+
+        def recording_publish(*args):
+            threads.append((threading.current_thread(), None))
+            return publish(*args)
+        index.publish = recording_publish
+
+        yield index.scan_on(self.executor)
+        self.assertEqual(index.find('new').files['new-1.0.tar.gz'].sha256,
+                         'ab' * 32)
+        self.assertEqual(len(threads), 2)
+        for thread, flush in threads:
+            self.assertIsNot(thread, threading.current_thread())
+            self.assertIn(flush, (False, None))
@@ -0,0 +1,141 @@
+"""
+core.mirror against a stand-in upstream index, served from the test's own
+IOLoop. Run with python -m unittest discover tests.
+
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+
+import tornado.testing
+import tornado.web
+
+from MinistryOfPackages.core.dao import PyPIData, make_backend
+from MinistryOfPackages.core.index import PackageIndex
+from MinistryOfPackages.core.mirror import Mirror
+from MinistryOfPackages.core.storage import ArtifactStorage
+
+CONTENT = 'not really a tarball\n' * 100
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class PageHandler(tornado.web.RequestHandler):
+
+    def initialize(self, pages):
+        self.pages = pages
+
+    def get(self, path):
+        if path not in self.pages:
+            raise tornado.web.HTTPError(404)
+        self.write(self.pages[path])
+
+
+class AnythingHandler(tornado.web.RequestHandler):
+
+    def get(self, path):
+        self.write(CONTENT)
+
+
+class MirrorTest(tornado.testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.served = os.path.join(self.base, 'served')
+        os.mkdir(self.served)
+        os.mkdir(os.path.join(self.base, 'packages'))
+        with open(os.path.join(self.served, 'good-1.0.tar.gz'), 'wb') as f:
+            f.write(CONTENT)
+        self.pages = {}
+        super(MirrorTest, self).setUp()
+
+    def tearDown(self):
+        super(MirrorTest, self).tearDown()
+        shutil.rmtree(self.base)
+
+    def get_app(self):
+        return tornado.web.Application([
+            (r'/simple/(.*)', PageHandler, {'pages': self.pages}),
+            (r'/any/(.*)', AnythingHandler),
+            (r'/files/(.*)', tornado.web.StaticFileHandler,
+             {'path': self.served})])
+
+    def make_mirror(self):
+        storage = ArtifactStorage(self.base, ['packages'])
+        index = PackageIndex(self.base, ['packages'])
+        data = PyPIData(make_backend({}, self.base), index)
+        index.scan()
+        return Mirror(self.get_url('/simple/'), storage, index, data,
+                      os.path.join(self.base, 'var/mirror/partial'),
+                      os.path.join(self.base, 'var/mirror/checkpoint.json'),
+                      max_clients=2)
+
+    def files_under(self, top):
+        found = set()
+        for dirpath, dirnames, filenames in os.walk(top):
+            found.update(os.path.relpath(os.path.join(dirpath, f), top)
+                         for f in filenames)
+        return found
+
+    @tornado.testing.gen_test
+    def test_sync(self):
+        self.pages[''] = '<a href="good/">good</a>'
+        self.pages['good/'] = (
+            '<a href="/files/good-1.0.tar.gz#sha256=%s">good-1.0.tar.gz</a>'
+            % sha256(CONTENT))
+        counts = yield self.make_mirror().run()
+        self.assertEqual(counts['fetched_files'], 1)
+        self.assertIn('packages/good/good-1.0.tar.gz',
+                      self.files_under(self.base))
+
+        # Nothing's changed, so the second run fetches nothing.
+        counts = yield self.make_mirror().run()
+        self.assertEqual(counts['fetched_files'], 0)
+        self.assertEqual(counts['unchanged_projects'], 1)
+
+    @tornado.testing.gen_test
+    def test_resume(self):
+        self.pages['good/'] = (
+            '<a href="/files/good-1.0.tar.gz#sha256=%s">good-1.0.tar.gz</a>'
+            % sha256(CONTENT))
+        mirror = self.make_mirror()
+        part = os.path.join(mirror.tmp_dir, 'good', 'good-1.0.tar.gz.part')
+        os.makedirs(os.path.dirname(part))
+        with open(part, 'wb') as f:
+            f.write(CONTENT[:1000])
+        with open(part + '.validator', 'w') as f:
+            f.write('"anything"')
+        counts = yield mirror.run(['good'])
+        self.assertEqual(counts['fetched_files'], 1)
+        self.assertEqual(counts['bytes'], len(CONTENT) - 1000)
+        with open(os.path.join(self.base,
+                               'packages/good/good-1.0.tar.gz')) as f:
+            self.assertEqual(f.read(), CONTENT)
+
+    @tornado.testing.gen_test
+    def test_hostile_names(self):
+        # Upstream isn't to be trusted with where things go, and names
+        # that are unquoted on the way in can point anywhere.
+        outside = os.path.join(self.base, 'outside')
+        self.pages[''] = ''.join(
+            '<a href="%s/">%s</a>' % (name, name)
+            for name in ('good', '..', '.hidden', '..%2F..%2Fevil'))
+        self.pages['good/'] = ''.join(
+            '<a href="/any/%s">%s</a>' % (href, href)
+            for href in ('good-1.0.tar.gz',
+                         '..%2F..%2F..%2F..%2F..%2Foutside%2Fup-1.0.tar.gz',
+                         outside.replace('/', '%2F') + '%2Fabs-1.0.tar.gz',
+                         '.hidden-1.0.tar.gz'))
+        counts = yield self.make_mirror().run()
+        self.assertEqual(counts['projects'], 1)
+        self.assertEqual(counts['fetched_files'], 1)
+        self.assertEqual(counts['failed_files'], 0)
+        self.assertFalse(os.path.exists(outside))
+        self.assertEqual(
+            set(f for f in self.files_under(self.base)
+                if not f.startswith('var/ministry.db')),
+            set(['served/good-1.0.tar.gz', 'packages/good/good-1.0.tar.gz',
+                 'var/mirror/checkpoint.json']))
@@ -0,0 +1,185 @@
+"""
+core.multipart's MultipartStreamParser, fed the same bodies in pieces of
+every size the network might hand it. Run with python -m unittest discover
+tests.
+
+"""
+import hashlib
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from MinistryOfPackages.core import multipart
+from MinistryOfPackages.core.multipart import (MultipartError,
+                                               MultipartStreamParser,
+                                               get_boundary)
+
+BOUNDARY = '--------------GHSKFJDLGDS7543FJKLFHRE75642756743254'
+
+# Line endings and a near-miss of the delimiter inside the file, to be
+# sure only a whole delimiter on its own line ends a part.
+CONTENT = ('not really a tarball\r\n' * 50 + '--' + BOUNDARY[:-1] + '\r\n'
+           + '\n--not the boundary\n' + 'ends in a CR\r')
+
+FIELDS = [(':action', 'file_upload'), ('name', 'foo'), ('version', '1.0'),
+          ('classifiers', 'Programming Language :: Python'),
+          ('classifiers', 'Topic :: Utilities'), ('description', '')]
+
+
+def multipart_body(fields, filename=None, content=None, newline='\r\n'):
+    out = ['preamble to be ignored', newline]
+    for name, value in fields:
+        out.extend(['--', BOUNDARY, newline,
+                    'Content-Disposition: form-data; name="%s"' % name,
+                    newline, newline, value, newline])
+    if filename is not None:
+        out.extend(['--', BOUNDARY, newline,
+                    'Content-Disposition: form-data; name="content"; '
+                    'filename="%s"' % filename, newline,
+                    'Content-Type: application/octet-stream', newline,
+                    newline, content, newline])
+    out.extend(['--', BOUNDARY, '--', newline, 'epilogue to be ignored'])
+    return ''.join(out)
+
+
+def chunked(data, sizes):
+    """
+    Split data into pieces, taking their sizes from 'sizes' in turn.
+
+    """
+    pieces = []
+    start = 0
+    while start < len(data):
+        size = next(sizes)
+        pieces.append(data[start:start + size])
+        start += size
+    return pieces
+
+
+def fixed(size):
+    while True:
+        yield size
+
+
+def randomly(seed, largest):
+    rand = random.Random(seed)
+    while True:
+        yield rand.randint(1, largest)
+
+
+class MultipartTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def parse(self, pieces):
+        parser = MultipartStreamParser(BOUNDARY, self.tmp_dir)
+        for piece in pieces:
+            parser.feed(piece)
+        return parser, parser.close()
+
+    def assertParsed(self, args, content=CONTENT):
+        self.assertEqual(args[':action'], 'file_upload')
+        self.assertEqual(args['name'], 'foo')
+        self.assertEqual(args['version'], '1.0')
+        self.assertEqual(args['description'], '')
+        self.assertEqual(args['classifiers'],
+                         ['Programming Language :: Python',
+                          'Topic :: Utilities'])
+        self.assertEqual(args['filename'], 'foo-1.0.tar.gz')
+        self.assertEqual(args['filesize'], len(content))
+        self.assertEqual(args['filemd5'], hashlib.md5(content).hexdigest())
+        self.assertEqual(args['filesha256'],
+                         hashlib.sha256(content).hexdigest())
+        with open(args['filetemp'], 'rb') as f:
+            self.assertEqual(f.read(), content)
+        os.unlink(args['filetemp'])
+
+    def check_chunkings(self, body, content=CONTENT):
+        chunkings = [('whole', [body]),
+                     ('1 byte', chunked(body, fixed(1))),
+                     ('2 bytes', chunked(body, fixed(2))),
+                     ('delimiter length',
+                      chunked(body, fixed(len(BOUNDARY) + 2)))]
+        for seed in range(20):
+            chunkings.append(('random %d' % seed, chunked(
+                body, randomly(seed, len(BOUNDARY) * 2))))
+        for how, pieces in chunkings:
+            parser, args = self.parse(pieces)
+            self.assertParsed(args, content)
+            self.assertEqual(len(parser.files), 1, how)
+
+    def test_crlf(self):
+        self.check_chunkings(multipart_body(FIELDS, 'foo-1.0.tar.gz',
+                                            CONTENT))
+
+    def test_lf(self):
+        # Old distutils only ever sent bare LFs. A file ending in a CR
+        # can't be told apart from a CRLF before the delimiter then.
+        content = CONTENT[:-1]
+        self.check_chunkings(multipart_body(FIELDS, 'foo-1.0.tar.gz',
+                                            content, newline='\n'),
+                             content)
+
+    def test_delimiter_split(self):
+        body = multipart_body(FIELDS, 'foo-1.0.tar.gz', CONTENT)
+        # Split at every point in the file's closing delimiter.
+        end = body.index(CONTENT) + len(CONTENT)
+        for split in range(end - 2, end + len(BOUNDARY) + 6):
+            parser, args = self.parse([body[:split], body[split:]])
+            self.assertParsed(args)
+
+    def test_several_files(self):
+        body = multipart_body(FIELDS, 'foo-1.0.tar.gz', CONTENT)
+        closing = '--%s--' % BOUNDARY
+        other = ('--%s\r\nContent-Disposition: form-data; name="content"; '
+                 'filename="foo-1.0.zip"\r\n\r\nzipped\r\n' % BOUNDARY)
+        body = body.replace(closing, other + closing)
+        parser, args = self.parse(chunked(body, fixed(1)))
+        self.assertEqual([f['filename'] for f in parser.files],
+                         ['foo-1.0.tar.gz', 'foo-1.0.zip'])
+        self.assertEqual([f['filesize'] for f in parser.files],
+                         [len(CONTENT), len('zipped')])
+        self.assertEqual(args['filename'], 'foo-1.0.zip')
+
+    def test_field_too_large(self):
+        value = 'x' * (multipart.MAX_FIELD_SIZE + 1)
+        body = multipart_body([('description', value)])
+        parser = MultipartStreamParser(BOUNDARY, self.tmp_dir)
+        with self.assertRaises(MultipartError):
+            for piece in chunked(body, fixed(64 * 1024)):
+                parser.feed(piece)
+
+    def test_field_at_limit(self):
+        value = 'x' * multipart.MAX_FIELD_SIZE
+        body = multipart_body([('description', value)])
+        parser, args = self.parse(chunked(body, fixed(64 * 1024)))
+        self.assertEqual(len(args['description']), multipart.MAX_FIELD_SIZE)
+
+    def test_file_not_limited(self):
+        content = 'x' * (multipart.MAX_FIELD_SIZE + 1)
+        body = multipart_body([], 'big-1.0.tar.gz', content)
+        parser, args = self.parse(chunked(body, fixed(64 * 1024)))
+        self.assertEqual(args['filesize'], len(content))
+        os.unlink(args['filetemp'])
+
+    def test_truncated(self):
+        body = multipart_body(FIELDS, 'foo-1.0.tar.gz', CONTENT)
+        parser = MultipartStreamParser(BOUNDARY, self.tmp_dir)
+        parser.feed(body[:body.index(CONTENT) + 10])
+        with self.assertRaises(MultipartError):
+            parser.close()
+        # The half-written file doesn't outlive the request.
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+    def test_get_boundary(self):
+        self.assertEqual(get_boundary(
+            'multipart/form-data; boundary=%s' % BOUNDARY), BOUNDARY)
+        self.assertEqual(get_boundary(
+            'multipart/form-data; boundary="%s"' % BOUNDARY), BOUNDARY)
+        self.assertIsNone(get_boundary('multipart/form-data'))
@@ -0,0 +1,174 @@
+"""
+core.proxy and ProxyFileHandler against a stand-in upstream index, served
+from the test's own IOLoop. Run with python -m unittest discover tests.
+
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+import tornado.gen
+import tornado.httpclient
+import tornado.testing
+import tornado.web
+
+from MinistryOfPackages.core.executor import IOExecutor
+from MinistryOfPackages.core.proxy import DiskCache
+from MinistryOfPackages.handlers.Proxy import ProxyFileHandler
+
+CHUNK_SIZE = 1024
+
+CONTENT = 'not really a tarball\n' * 1000
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class PageHandler(tornado.web.RequestHandler):
+
+    def initialize(self, pages):
+        self.pages = pages
+
+    def get(self, path):
+        if path not in self.pages:
+            raise tornado.web.HTTPError(404)
+        self.write(self.pages[path])
+
+
+class SlowFileHandler(tornado.web.RequestHandler):
+    """
+    Sends a file in a few pieces, with a pause between them, so the proxy
+    is still fetching it while other requests come in.
+
+    """
+
+    def initialize(self, files, hits):
+        self.files = files
+        self.hits = hits
+
+    @tornado.gen.coroutine
+    def get(self, filename):
+        self.hits.append(filename)
+        content = self.files[filename]
+        self.set_header('Content-Length', len(content))
+        step = len(content) // 4 + 1
+        for start in range(0, len(content), step):
+            self.write(content[start:start + step])
+            yield self.flush()
+            yield tornado.gen.sleep(0.05)
+
+
+class ProxyTest(tornado.testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.pages = {}
+        self.files = {}
+        self.hits = []
+        super(ProxyTest, self).setUp()
+
+    def tearDown(self):
+        super(ProxyTest, self).tearDown()
+        executor = getattr(self._app, 'io_executor', None)
+        if executor is not None:
+            executor.shutdown()
+        shutil.rmtree(self.base)
+
+    def get_http_client(self):
+        # Not the IOLoop's shared client, which the proxy's upstream
+        # requests would have to queue for behind ours.
+        return tornado.httpclient.AsyncHTTPClient(force_instance=True,
+                                                  max_clients=10)
+
+    def get_app(self):
+        return tornado.web.Application([
+            (r'/upstream/files/(.*)', SlowFileHandler,
+             {'files': self.files, 'hits': self.hits}),
+            (r'/upstream/(.*)', PageHandler, {'pages': self.pages}),
+            (r'/proxy/files/(?P<package>[^/]+)/(?P<filename>[^/]+)',
+             ProxyFileHandler)],
+            base_path=self.base, PackageDirs=['packages'],
+            download_chunk_size=CHUNK_SIZE,
+            Proxy={'upstream': self.get_url('/upstream/')})
+
+    def serve(self, filename, content, digest=None):
+        self.files[filename] = content
+        self.pages['foo/'] = (
+            '<a href="/upstream/files/%s#sha256=%s">%s</a>'
+            % (filename, digest or sha256(content), filename))
+
+    def cached(self):
+        found = []
+        for dirpath, dirnames, filenames in os.walk(
+                os.path.join(self.base, 'var/proxy-cache/files')):
+            found.extend(filenames)
+        return found
+
+    @tornado.testing.gen_test
+    def test_one_fetch(self):
+        self.serve('foo-1.0.tar.gz', CONTENT)
+        responses = yield [
+            self.http_client.fetch(self.get_url(
+                '/proxy/files/foo/foo-1.0.tar.gz'))
+            for i in range(5)]
+        for response in responses:
+            self.assertEqual(response.code, 200)
+            self.assertEqual(response.body, CONTENT)
+        self.assertEqual(self.hits, ['foo-1.0.tar.gz'])
+        self.assertEqual(self.cached(), ['foo-1.0.tar.gz'])
+
+    @tornado.testing.gen_test
+    def test_sha256_mismatch(self):
+        self.serve('foo-1.0.tar.gz', 'x' * (CHUNK_SIZE // 2),
+                   digest=sha256('something else'))
+        response = yield self.http_client.fetch(
+            self.get_url('/proxy/files/foo/foo-1.0.tar.gz'),
+            raise_error=False)
+        self.assertEqual(response.code, 502)
+        self.assertEqual(self.cached(), [])
+        self.assertEqual(os.listdir(
+            os.path.join(self.base, 'var/proxy-cache/.tmp')), [])
+
+    @tornado.testing.gen_test
+    def test_sha256_mismatch_part_way(self):
+        # Too big to hold back entirely, so the client is cut off short.
+        self.serve('foo-1.0.tar.gz', CONTENT,
+                   digest=sha256('something else'))
+        response = yield self.http_client.fetch(
+            self.get_url('/proxy/files/foo/foo-1.0.tar.gz'),
+            raise_error=False)
+        self.assertNotEqual(response.body, CONTENT)
+        self.assertEqual(self.cached(), [])
+
+
+class DiskCacheTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(DiskCacheTest, self).setUp()
+        self.base = tempfile.mkdtemp()
+        self.executor = IOExecutor(1)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        shutil.rmtree(self.base)
+        super(DiskCacheTest, self).tearDown()
+
+    @tornado.testing.gen_test
+    def test_eviction(self):
+        cache = DiskCache(self.base, 250, self.executor)
+        now = time.time()
+        for i, key in enumerate(('a', 'b', 'c')):
+            tmp_file, tmp_path = cache.temp_file()
+            with tmp_file:
+                tmp_file.write('x' * 100)
+            path = cache.store(key, tmp_path)
+            # Least recently used first.
+            os.utime(path, (now - 100 + i, now - 100 + i))
+            yield cache.sweep_on()
+        self.assertEqual(set(cache.entries), set(['b', 'c']))
+        self.assertEqual(cache.total, 200)
+        self.assertFalse(os.path.exists(os.path.join(self.base, 'a')))
+        self.assertIsNotNone(cache.lookup('c'))
@@ -0,0 +1,96 @@
+"""
+handlers.DirectoryListing's parse_range_header, table-tested against a
+1000 byte file. Run with python -m unittest discover tests.
+
+"""
+import unittest
+
+from MinistryOfPackages.handlers.DirectoryListing import (MAX_RANGES,
+                                                          parse_range_header)
+
+SIZE = 1000
+
+# Header value, and what it should come out as: a list of (start, end)
+# pairs with end exclusive, [] for a 416, or None to ignore the header.
+CASES = [
+    # Plain ranges.
+    ('bytes=0-99', [(0, 100)]),
+    ('bytes=0-0', [(0, 1)]),
+    ('bytes=999-999', [(999, 1000)]),
+    ('bytes=500-', [(500, 1000)]),
+    ('bytes=0-', [(0, 1000)]),
+    ('bytes=900-5000', [(900, 1000)]),
+    (' bytes = 10-19 ', [(10, 20)]),
+
+    # Suffix ranges: the last N bytes.
+    ('bytes=-100', [(900, 1000)]),
+    ('bytes=-1', [(999, 1000)]),
+    ('bytes=-1000', [(0, 1000)]),
+    ('bytes=-5000', [(0, 1000)]),
+
+    # Several, sorted and with overlapping or adjacent ones merged.
+    ('bytes=20-29,0-9', [(0, 10), (20, 30)]),
+    ('bytes=0-9,5-19', [(0, 20)]),
+    ('bytes=0-9,10-19', [(0, 20)]),
+    ('bytes=0-9,11-19', [(0, 10), (11, 20)]),
+    ('bytes=0-99,10-19', [(0, 100)]),
+    ('bytes=0-9, -10', [(0, 10), (990, 1000)]),
+    ('bytes=-100,950-', [(900, 1000)]),
+    ('bytes=0-,-10', [(0, 1000)]),
+    ('bytes=0-9,5-14,12-29,40-49', [(0, 30), (40, 50)]),
+
+    # Unsatisfiable pieces are dropped; if that's all of them, a 416.
+    ('bytes=0-9,1000-1009', [(0, 10)]),
+    ('bytes=1000-', []),
+    ('bytes=1000-1999', []),
+    ('bytes=-0', []),
+    ('bytes=-0,2000-', []),
+
+    # Malformed, or not bytes: ignored.
+    ('items=0-9', None),
+    ('bytes', None),
+    ('bytes=', None),
+    ('bytes=5', None),
+    ('bytes=-', None),
+    ('bytes=9-0', None),
+    ('bytes=a-9', None),
+    ('bytes=0-9,x', None),
+    ('bytes=0-9,,20-29', None),
+    ('bytes=--5', None),
+    ('bytes=+5-9', None),
+    ('bytes=0-+9', None),
+    ('bytes=0 -9', None),
+]
+
+
+class RangeHeaderTest(unittest.TestCase):
+
+    def test_cases(self):
+        for value, expected in CASES:
+            self.assertEqual(parse_range_header(value, SIZE), expected,
+                             value)
+
+    def test_empty_file(self):
+        for value in ('bytes=0-', 'bytes=0-0', 'bytes=-10'):
+            self.assertEqual(parse_range_header(value, 0), [], value)
+
+    def test_max_ranges(self):
+        ranges = ['%d-%d' % (i * 10, i * 10) for i in range(MAX_RANGES)]
+        self.assertEqual(
+            parse_range_header('bytes=' + ','.join(ranges), SIZE),
+            [(i * 10, i * 10 + 1) for i in range(MAX_RANGES)])
+        ranges.append('%d-%d' % (MAX_RANGES * 10, MAX_RANGES * 10))
+        self.assertIsNone(
+            parse_range_header('bytes=' + ','.join(ranges), SIZE))
+
+    def test_max_ranges_before_merging(self):
+        # The cutoff is on what was asked for, so a pile of overlapping
+        # ranges doesn't get merged first.
+        value = 'bytes=' + ','.join(['0-9'] * (MAX_RANGES + 1))
+        self.assertIsNone(parse_range_header(value, SIZE))
+
+    def test_max_ranges_counts_satisfiable(self):
+        ranges = ['%d-%d' % (i, i) for i in range(MAX_RANGES)]
+        ranges.append('5000-5009')
+        self.assertEqual(
+            len(parse_range_header('bytes=' + ','.join(ranges), SIZE)), 1)
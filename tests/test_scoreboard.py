@@ -0,0 +1,33 @@
+"""
+core.scoreboard's load reports across workers reusing a slot.
+
+"""
+import unittest
+
+from MinistryOfPackages.core.scoreboard import Scoreboard, load_report
+
+
+class LoadReportTest(unittest.TestCase):
+
+    def test_restarted_worker(self):
+        scoreboard = Scoreboard(1)
+        stats = scoreboard.worker(0)
+        stats.claim(100, 8080)
+        for i in range(1000):
+            stats.request_started()
+            stats.request_finished(0.5)
+        before = scoreboard.snapshot()
+
+        # The worker's replaced, and the new one serves 10 requests.
+        stats.release()
+        stats.claim(200, 8080)
+        for i in range(10):
+            stats.request_started()
+            stats.request_finished(0.1)
+        self.assertEqual(load_report(before, scoreboard.snapshot(), 10),
+                         ['port 8080 slot 0 pid 200: 1.0 req/s, 0 in flight, '
+                          '10% busy'])
+        # And the same if the slot was empty at the last report.
+        self.assertEqual(load_report({}, scoreboard.snapshot(), 10),
+                         ['port 8080 slot 0 pid 200: 1.0 req/s, 0 in flight, '
+                          '10% busy'])
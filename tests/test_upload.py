@@ -0,0 +1,85 @@
+"""
+setup.py uploads through SetupPyHandler, against a scratch PackageDirs.
+Run with python -m unittest discover tests.
+
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+
+import tornado.testing
+import tornado.web
+
+from MinistryOfPackages.handlers.SetupPy import SetupPyHandler
+
+BOUNDARY = '--------------GHSKFJDLGDS7543FJKLFHRE75642756743254'
+
+CONTENT = 'not really a tarball\n' * 100
+
+
+def multipart(fields, filename, content):
+    out = []
+    for name, value in fields:
+        out.append('--%s\r\nContent-Disposition: form-data; name="%s"'
+                   '\r\n\r\n%s\r\n' % (BOUNDARY, name, value))
+    out.append('--%s\r\nContent-Disposition: form-data; name="content"; '
+               'filename="%s"\r\n\r\n%s\r\n' % (BOUNDARY, filename, content))
+    out.append('--%s--\r\n' % BOUNDARY)
+    return ''.join(out)
+
+
+class UploadTest(tornado.testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.base = os.path.join(self.top, 'a', 'b', 'base')
+        os.makedirs(os.path.join(self.base, 'packages'))
+        super(UploadTest, self).setUp()
+
+    def tearDown(self):
+        super(UploadTest, self).tearDown()
+        shutil.rmtree(self.top)
+
+    def get_app(self):
+        return tornado.web.Application(
+            [(r'/dist', SetupPyHandler)], base_path=self.base,
+            PackageDirs=['packages'], index_file='', blob_dir='',
+            metadata_processes=0, index_refresh_interval=0)
+
+    def upload(self, name, filename):
+        fields = [(':action', 'file_upload'), ('name', name),
+                  ('version', '1.0'), ('filetype', 'sdist'),
+                  ('md5_digest', hashlib.md5(CONTENT).hexdigest())]
+        return self.fetch(
+            '/dist', method='POST',
+            body=multipart(fields, filename, CONTENT),
+            headers={'Content-Type':
+                     'multipart/form-data; boundary=%s' % BOUNDARY})
+
+    def files_under(self, top):
+        found = set()
+        for dirpath, dirnames, filenames in os.walk(top):
+            found.update(os.path.relpath(os.path.join(dirpath, f), top)
+                         for f in filenames)
+        return found
+
+    def test_upload(self):
+        response = self.upload('good', 'good-1.0.tar.gz')
+        self.assertEqual(response.code, 200)
+        with open(os.path.join(self.base,
+                               'packages/good/good-1.0.tar.gz')) as f:
+            self.assertEqual(f.read(), CONTENT)
+
+    def test_hostile_names(self):
+        # The name is a directory under PackageDirs and the filename a
+        # file in it; neither is to be trusted with where things go.
+        for name, filename in (('../../escaped', 'evil-1.0.tar.gz'),
+                               ('good', '../../../escaped2-1.0.tar.gz'),
+                               ('good', '.hidden-1.0.tar.gz'),
+                               ('good', 'good-1.0.txt')):
+            response = self.upload(name, filename)
+            self.assertEqual(response.code, 400, (name, filename))
+        self.assertEqual(
+            set(f for f in self.files_under(self.top)
+                if not f.startswith('a/b/base/var/')), set())
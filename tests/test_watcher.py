@@ -0,0 +1,83 @@
+"""
+core.watcher's PackageWatcher, against a scratch PackageDirs with a
+per-process index.
+
+"""
+import os
+import shutil
+import tempfile
+import threading
+
+import tornado.gen
+import tornado.testing
+
+from MinistryOfPackages.core.dao import PyPIData, make_backend
+from MinistryOfPackages.core.executor import IOExecutor
+from MinistryOfPackages.core.index import PackageIndex
+from MinistryOfPackages.core.watcher import PackageWatcher
+
+
+class WatcherTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(WatcherTest, self).setUp()
+        self.base = tempfile.mkdtemp()
+        self.executor = IOExecutor(1)
+        self.path = self.add('foo', 'foo-1.0.tar.gz')
+        index = PackageIndex(self.base, ['packages'])
+        index.scan()
+        self.data = PyPIData(make_backend({}, self.base), index)
+        self.data.store_pkg_file('foo', '1.0', 'foo-1.0.tar.gz',
+                                 path=self.path)
+        self.watcher = PackageWatcher(
+            self.data, self.executor, None, 0.01, 0,
+            os.path.join(self.base, 'var', 'watcher.lock'))
+        self.watcher.io_loop = self.io_loop
+
+    def tearDown(self):
+        if self.watcher.inotify is not None:
+            self.io_loop.remove_handler(self.watcher.inotify.fd)
+            self.watcher.inotify.close()
+        self.executor.shutdown()
+        shutil.rmtree(self.base)
+        super(WatcherTest, self).tearDown()
+
+    def add(self, name, filename):
+        path = os.path.join(self.base, 'packages', name, filename)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(filename)
+        return path
+
+    @tornado.testing.gen_test
+    def test_watch_off_loop(self):
+        threads = []
+        add_watches = self.watcher.add_watches
+
+        def recording_add_watches():
+            threads.append(threading.current_thread())
+            add_watches()
+        self.watcher.add_watches = recording_add_watches
+        yield self.watcher.watch()
+        if self.watcher.inotify is None:
+            self.skipTest("no inotify here")
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+        self.assertIn(os.path.dirname(self.path),
+                      self.watcher.inotify.paths.values())
+
+        self.add('bar', 'bar-1.0.tar.gz')
+        for i in range(50):
+            yield tornado.gen.sleep(0.02)
+            if self.data.index.find('bar') is not None:
+                break
+        self.assertIsNotNone(self.data.index.find('bar'))
+
+    @tornado.testing.gen_test
+    def test_overflow_forgets_deleted_files(self):
+        os.unlink(self.path)
+        self.watcher.rescan = True
+        yield self.watcher.apply()
+        self.assertIsNone(self.data.index.find('foo'))
+        self.assertEqual(self.data.get_pkg_files('foo'), [])